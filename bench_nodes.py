@@ -0,0 +1,253 @@
+"""
+NODE_CLASS_MAPPINGS の全てのノードの処理速度とメモリ使用量を計測するベンチマーク。
+utils/wd-*-tagger-*.csv のタグを count の重みで選んで、実際に近いプロンプトを作る。
+
+    python bench_nodes.py                                  # 10/100/1000 タグで全ノードを計測
+    python bench_nodes.py --nodes "TagSelector*" "TagFilter" --sizes 100 1000
+    python bench_nodes.py --save bench_baseline.json       # 結果を保存
+    python bench_nodes.py --compare bench_baseline.json    # 保存した結果と比較 (遅くなったノードがあれば終了コード 1)
+
+ops/s は1秒あたりに処理できたプロンプトの数 (Batch ノードは1回の呼び出しで --batch 件処理する)。
+peak_kib は1回の呼び出しで tracemalloc が記録したメモリのピーク。
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import fnmatch
+import argparse
+import platform
+import tracemalloc
+from itertools import accumulate
+
+from nodes import NODE_CLASS_MAPPINGS, TagPipeIn, parse_tags_cache_clear
+from tag_db import load_tag_counts
+
+
+def load_vocab(code_dir: str) -> tuple:
+    """wd-*-tagger-*.csv のタグと count を読み込む (レーティングのタグは除く)。複数の CSV にあるタグは大きい方の count を使う。"""
+    counts = load_tag_counts(sorted(glob.glob(os.path.join(code_dir, "utils", "wd-*-tagger-*.csv"))))
+    vocab = sorted(counts, key=lambda tag: -counts[tag])
+    return vocab, list(accumulate(counts[tag] for tag in vocab))
+
+
+class PromptMaker:
+    def __init__(self, vocab: list, cum_weights: list, seed):
+        self.vocab = vocab
+        self.cum_weights = cum_weights
+        self.myrand = random.Random(seed)
+
+    def tags(self, size: int) -> list:
+        # よく使われるタグほど出やすく、1つのプロンプトの中では重複しない
+        size = min(size, len(self.vocab))
+        selected = {}
+        while len(selected) < size:
+            for tag in self.myrand.choices(self.vocab, cum_weights=self.cum_weights, k=size - len(selected)):
+                selected[tag] = None
+        return list(selected)
+
+    def prompt(self, size: int) -> str:
+        result = []
+        for tag in self.tags(size):
+            if self.myrand.random() < 0.5:
+                tag = tag.replace("_", " ")
+            tag = tag.replace("(", "\\(").replace(")", "\\)")
+            r = self.myrand.random()
+            if r < 0.1:
+                tag = f"({tag}:{self.myrand.choice([0.5, 0.8, 1.2, 1.35])})"
+            elif r < 0.15:
+                tag = f"(({tag}))"
+            result.append(tag)
+        return ", ".join(result)
+
+    def text(self, size: int) -> str:
+        # TagDetector 用の文章
+        words = ["a", "with", "and", "the", "is", "wearing", "in"]
+        parts = []
+        for tag in self.tags(size):
+            parts.append(tag.replace("_", " "))
+            parts.append(self.myrand.choice(words))
+        return " ".join(parts) + "."
+
+
+def _tagset(make: PromptMaker, size: int):
+    return TagPipeIn().tag(key1="k1", value1=make.prompt(size), key2="k2", value2=make.prompt(size),
+                           key3="", value3="", key4="", value4="", key5="", value5="", key6="", value6="")[0]
+
+
+# ノードの設定にあたる入力。ここに無い STRING 入力には size 個のタグのプロンプトを渡す
+INPUT_OVERRIDES = {
+    "TagSwitcher": lambda make, size: {"tags1": make.prompt(3), "tags2": make.prompt(3), "tags3": make.prompt(3), "tags4": make.prompt(3)},
+    "TagFilter": lambda make, size: {"include_categories": "clothing, hair", "exclude_categories": "color"},
+    "TagReplace": lambda make, size: {"replace_tags": make.prompt(20)},
+    "TagRemover": lambda make, size: {"exclude_tags": make.prompt(200)},
+    "TagIf": lambda make, size: {"find": make.prompt(3), "output1": "a", "output2": "b", "output3": "c",
+                                 "else_output1": "d", "else_output2": "e", "else_output3": "f"},
+    "TagSelector": lambda make, size: {"categorys": "pose, hair, clothing", "flexible_filter": True},
+    "TagEnhance": lambda make, size: {"enhance_tags": make.prompt(10)},
+    "TagCategoryEnhance": lambda make, size: {"enhance_category": "hair, clothing"},
+    "TagWildcardFilter": lambda make, size: {"wildcard": "*hair*, long*, *_eyes", "exclude_wildcard": "*ribbon*"},
+    "TagRandomCategory": lambda make, size: {"category": "hair, clothing, location", "negative_category": "color",
+                                             "count": min(size, 100)},
+    "TagPipeIn": lambda make, size: {"key1": "k1", "key2": "k2", "key3": "k3", "key4": "", "key5": "", "key6": ""},
+    "TagPipeOut": lambda make, size: {"key1": "k1", "key2": "k2", "key3": "", "key4": "", "key5": "", "key6": ""},
+    "TagPipeUpdate": lambda make, size: {"key": "k1"},
+    "TagPipeOutOne": lambda make, size: {"key1": "k2"},
+    "TagRandom": lambda make, size: {"count_min": max(1, size // 4), "count_max": max(1, size // 2)},
+    "TagDetector": lambda make, size: {"tags": make.text(size)},
+    "TagColorChanger": lambda make, size: {"skin": "all", "hair": "all", "eyes": "all", "clothing": "all",
+                                           "accessories": "all", "background": "all", "other": "all"},
+}
+
+
+def make_inputs(node_name: str, node_class, make: PromptMaker, size: int) -> dict:
+    input_types = node_class.INPUT_TYPES()
+    inputs = {**input_types.get("required", {}), **input_types.get("optional", {})}
+    overrides = INPUT_OVERRIDES.get(node_name, lambda make, size: {})(make, size)
+
+    kwargs = {}
+    for name, input_type in inputs.items():
+        kind = input_type[0]
+        options = input_type[1] if len(input_type) > 1 else {}
+        if name in overrides:
+            kwargs[name] = overrides[name]
+        elif isinstance(kind, list):
+            kwargs[name] = kind[0]
+        elif kind == "STRING":
+            kwargs[name] = make.prompt(size)
+        elif kind == "TAGSET":
+            kwargs[name] = _tagset(make, size)
+        elif kind in ("BOOLEAN", "INT", "FLOAT"):
+            kwargs[name] = options.get("default", {"BOOLEAN": False, "INT": 1, "FLOAT": 1.0}[kind])
+        else:
+            kwargs[name] = kind.lower()  # IMAGE などはそのまま受け渡されるだけ
+    return kwargs
+
+
+def make_batch_inputs(node_name: str, node_class, make: PromptMaker, size: int, batch: int) -> dict:
+    base_name = node_name[:-len("Batch")]
+    items = [make_inputs(base_name, node_class, make, size) for _ in range(batch)]
+    # 設定の入力は1件だけ渡して、プロンプトの入力だけ件数分渡す
+    settings = INPUT_OVERRIDES.get(base_name, lambda make, size: {})(make, size)
+    return {name: [items[0][name]] if name in settings else [item[name] for item in items] for name in items[0]}
+
+
+def bench_node(function, kwargs_list: list, items: int, min_time: float, min_calls: int) -> float:
+    """キャッシュを消した状態で呼び出しを繰り返して、1秒あたりの処理件数を返す"""
+    # 初回だけ作られる索引 (TagDetector のトライ木など) は計測に含めない
+    function(**kwargs_list[0])
+    elapsed = 0.0
+    calls = 0
+    while elapsed < min_time or calls < min_calls:
+        kwargs = kwargs_list[calls % len(kwargs_list)]
+        parse_tags_cache_clear()
+        start = time.perf_counter()
+        function(**kwargs)
+        elapsed += time.perf_counter() - start
+        calls += 1
+    return calls * items / elapsed
+
+
+def peak_memory(function, kwargs: dict) -> float:
+    parse_tags_cache_clear()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        function(**kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return max(0, peak - before) / 1024
+
+
+def run(node_patterns: list, sizes: list, batch: int, variants: int, min_time: float, min_calls: int, seed: int, quiet: bool) -> dict:
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    vocab, cum_weights = load_vocab(code_dir)
+
+    results = {}
+    for node_name, node_class in NODE_CLASS_MAPPINGS.items():
+        if not any(fnmatch.fnmatchcase(node_name, pattern) for pattern in node_patterns):
+            continue
+        node = node_class()
+        function = getattr(node, node_class.FUNCTION)
+        is_batch = node_name.endswith("Batch")
+        results[node_name] = {}
+        for size in sizes:
+            # ノードとサイズごとに同じプロンプトになるようにする
+            make = PromptMaker(vocab, cum_weights, f"{seed}:{node_name}:{size}")
+            if is_batch:
+                kwargs_list = [make_batch_inputs(node_name, node_class, make, size, batch) for _ in range(variants)]
+            else:
+                kwargs_list = [make_inputs(node_name, node_class, make, size) for _ in range(variants)]
+            ops = bench_node(function, kwargs_list, batch if is_batch else 1, min_time, min_calls)
+            peak = peak_memory(function, kwargs_list[0])
+            results[node_name][str(size)] = {"ops": ops, "peak_kib": peak}
+            if not quiet:
+                print(f"{node_name:<28} {size:>6} {ops:>12.1f} ops/s {peak:>10.1f} KiB", flush=True)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """baseline より threshold の割合以上遅くなった (メモリが増えた) ものの一覧"""
+    regressions = []
+    for node_name, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(node_name, {}).get(size)
+            if not base:
+                continue
+            speed = result["ops"] / base["ops"] if base["ops"] else 1.0
+            if speed < 1.0 - threshold:
+                regressions.append(f"{node_name} size={size}: {base['ops']:.1f} -> {result['ops']:.1f} ops/s ({speed:.2f}x)")
+            if base["peak_kib"] > 16 and result["peak_kib"] > base["peak_kib"] * (1.0 + threshold):
+                regressions.append(f"{node_name} size={size}: peak {base['peak_kib']:.1f} -> {result['peak_kib']:.1f} KiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every node in NODE_CLASS_MAPPINGS")
+    parser.add_argument("--nodes", nargs="+", default=["*"], help="node name patterns (fnmatch)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--batch", type=int, default=8, help="prompts per call for Batch nodes")
+    parser.add_argument("--variants", type=int, default=4, help="different prompts per node and size")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each node and size")
+    parser.add_argument("--min-calls", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file saved with --save")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown / memory growth ratio")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args.nodes, args.sizes, args.batch, args.variants, args.min_time, args.min_calls, args.seed, args.quiet)
+
+    if args.save:
+        data = {
+            "meta": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "sizes": args.sizes,
+                "batch": args.batch,
+                "seed": args.seed,
+            },
+            "results": results,
+        }
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+        print("no regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
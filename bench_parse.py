@@ -0,0 +1,73 @@
+"""
+parse_tags -> tagdata_to_string のスループットを計測するベンチマーク。
+変更前の実装 (tag_parser_reference.py) と nodes.py の実装を長いプロンプトで比較する。
+
+    python bench_parse.py
+    python bench_parse.py --sizes 100 1000 10000 --repeat 5
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+
+import tag_parser_reference
+from nodes import parse_tags, parse_tags_cache_clear, tagdata_to_string
+
+
+def make_prompt(vocab: list, size: int, myrand: random.Random) -> str:
+    tags = []
+    for _ in range(size):
+        tag = myrand.choice(vocab)
+        if myrand.random() < 0.5:
+            tag = tag.replace("_", " ")
+        tag = tag.replace("(", "\\(").replace(")", "\\)")
+        r = myrand.random()
+        if r < 0.1:
+            tag = f"({tag}:{myrand.choice([0.5, 0.8, 1.2, 1.35])})"
+        elif r < 0.2:
+            tag = "(" * myrand.randint(1, 3) + tag + ")" * myrand.randint(1, 3)
+        tags.append(tag)
+    return ", ".join(tags)
+
+
+def bench(func, prompt: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        # キャッシュに当たらない状態で計測する
+        parse_tags_cache_clear()
+        start = time.perf_counter()
+        func(prompt)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parse_tags throughput benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(code_dir, "tag_category_v2.json"), encoding="utf-8-sig") as f:
+        vocab = list(json.load(f).keys())
+
+    myrand = random.Random(args.seed)
+    print(f"{'tags':>8} {'reference':>14} {'parse_tags':>14} {'speedup':>8}")
+    for size in args.sizes:
+        prompt = make_prompt(vocab, size, myrand)
+
+        expected = tag_parser_reference.tagdata_to_string(tag_parser_reference.parse_tags(prompt))
+        actual = tagdata_to_string(parse_tags(prompt))
+        if expected != actual:
+            raise SystemExit(f"parse_tags result mismatch (size={size})")
+
+        ref_time = bench(lambda p: tag_parser_reference.tagdata_to_string(tag_parser_reference.parse_tags(p)), prompt, args.repeat)
+        new_time = bench(lambda p: tagdata_to_string(parse_tags(p)), prompt, args.repeat)
+        print(f"{size:>8} {size / ref_time:>10.0f} t/s {size / new_time:>10.0f} t/s {ref_time / new_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+parse_tags / tagdata_to_string / エスケープ処理の差分ファジング。
+ランダムなプロンプト (エスケープ、入れ子の括弧、:重み、対応しない括弧など) を作って、
+基準の実装 (tag_parser_reference.py) と候補の実装 (nodes.py) の結果を比べる。
+違いが見つかった場合は、違いが出る最小の入力に縮めて表示する。最後に処理速度の比を表示する。
+
+    python fuzz_parse.py
+    python fuzz_parse.py --cases 100000 --seed 42
+    python fuzz_parse.py --candidate my_fast_parser     # parse_tags などを持つ別のモジュールを試す
+
+基準・候補のモジュールには parse_tags, tagdata_to_string, escape_tag_special_chars,
+unescape_tag_special_chars が必要。
+"""
+
+import sys
+import time
+import random
+import argparse
+import importlib
+
+
+ESCAPES = ["\\(", "\\)", "\\:", "\\,", "\\\\"]
+PLACEHOLDERS = ["__escape_kakko_start__", "__escape_kakko_end__", "__escape_colon__", "__escape_comma__", "__escape_backslash__"]
+WEIGHTS = ["1.2", "0.5", "1", "1.0", "1.", ".5", "-1", "0", "-0", "1e3", "1.2345", "nan", "inf", "x", "", " 1.3 ", "1,2"]
+WORDS = ["1girl", "long hair", "long_hair", "smile", "2b", "nier", "automata", "C.C.", ":3", "^_^", "a", "b", "x y", "ハート"]
+NOISE = "ab_ ():,\\.1x\n\t"
+
+
+class PromptGenerator:
+    def __init__(self, seed: int):
+        self.myrand = random.Random(seed)
+
+    def word(self) -> str:
+        r = self.myrand.random()
+        if r < 0.6:
+            return self.myrand.choice(WORDS)
+        if r < 0.8:
+            return self.myrand.choice(WORDS) + self.myrand.choice(ESCAPES) + self.myrand.choice(WORDS)
+        if r < 0.9:
+            return self.myrand.choice(PLACEHOLDERS)
+        return "".join(self.myrand.choice(NOISE) for _ in range(self.myrand.randint(1, 6)))
+
+    def tag(self, depth: int = 0) -> str:
+        r = self.myrand.random()
+        if depth < 3 and r < 0.15:
+            # 括弧の中に複数のタグ
+            inner = ", ".join(self.tag(depth + 1) for _ in range(self.myrand.randint(1, 3)))
+            return f"({inner})"
+        if depth < 3 and r < 0.3:
+            return "(" * self.myrand.randint(1, 3) + self.tag(depth + 1) + ")" * self.myrand.randint(1, 3)
+        if r < 0.45:
+            return f"({self.word()}:{self.myrand.choice(WEIGHTS)})"
+        if r < 0.5:
+            # 対応しない括弧
+            return self.myrand.choice(["(", ")", "((", "))", ")("]) + self.word()
+        if r < 0.55:
+            return self.word() + ":" + self.myrand.choice(WEIGHTS)
+        return self.word()
+
+    def prompt(self) -> str:
+        if self.myrand.random() < 0.2:
+            # 文字をランダムに並べただけの入力
+            return "".join(self.myrand.choice(NOISE) for _ in range(self.myrand.randint(0, 30)))
+        separators = [", ", ",", " , ", ",\n", ",,", "\n"]
+        tags = [self.tag() for _ in range(self.myrand.randint(0, 12))]
+        result = ""
+        for i, tag in enumerate(tags):
+            if i:
+                result += self.myrand.choice(separators)
+            result += tag
+        return result
+
+
+def _result_key(module, tag_string: str):
+    """比較に使う結果。例外の場合は例外の型にする。"""
+    try:
+        tags = module.parse_tags(tag_string)
+        return (
+            [(t.tag, str(t.weight), t.format, t.format_escape, t.format_unescape,
+              t.text(), t.text(underscore=True), t.text(format=True)) for t in tags],
+            module.tagdata_to_string(tags),
+            module.tagdata_to_string(tags, underscore=True),
+            module.escape_tag_special_chars(tag_string),
+            module.unescape_tag_special_chars(tag_string),
+        )
+    except Exception as e:
+        return ("error", type(e).__name__)
+
+
+def diverges(reference, candidate, tag_string: str) -> bool:
+    return _result_key(reference, tag_string) != _result_key(candidate, tag_string)
+
+
+def minimize(reference, candidate, tag_string: str) -> str:
+    """違いが出る状態を保ったまま、文字を取り除いて入力を縮める (delta debugging)"""
+    chunk = max(1, len(tag_string) // 2)
+    while chunk >= 1:
+        i = 0
+        reduced = False
+        while i < len(tag_string):
+            trial = tag_string[:i] + tag_string[i + chunk:]
+            if diverges(reference, candidate, trial):
+                tag_string = trial
+                reduced = True
+            else:
+                i += chunk
+        if not reduced:
+            chunk //= 2
+    return tag_string
+
+
+def _clear_cache(module):
+    clear = getattr(module, "parse_tags_cache_clear", None)
+    if clear is not None:
+        clear()
+
+
+def throughput(module, cases: list, repeat: int) -> float:
+    """1秒あたりに parse_tags -> tagdata_to_string できた入力の数 (キャッシュは使わない)"""
+    best = float("inf")
+    for _ in range(repeat):
+        _clear_cache(module)
+        start = time.perf_counter()
+        for case in cases:
+            module.tagdata_to_string(module.parse_tags(case))
+        best = min(best, time.perf_counter() - start)
+        _clear_cache(module)
+    return len(cases) / best if best else float("inf")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Differential fuzzing of parse_tags implementations")
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--reference", default="tag_parser_reference")
+    parser.add_argument("--candidate", default="nodes")
+    parser.add_argument("--max-report", type=int, default=5, help="number of minimized divergences to show")
+    parser.add_argument("--repeat", type=int, default=3, help="throughput runs (best is used)")
+    args = parser.parse_args(argv)
+
+    reference = importlib.import_module(args.reference)
+    candidate = importlib.import_module(args.candidate)
+
+    generator = PromptGenerator(args.seed)
+    cases = [generator.prompt() for _ in range(args.cases)]
+
+    divergences = 0
+    reported = set()
+    for case in cases:
+        if not diverges(reference, candidate, case):
+            continue
+        divergences += 1
+        if len(reported) >= args.max_report:
+            continue
+        minimized = minimize(reference, candidate, case)
+        if minimized in reported:
+            continue
+        reported.add(minimized)
+        print(f"divergence: {minimized!r} (from {case!r})")
+        print(f"  {args.reference}: {_result_key(reference, minimized)!r}")
+        print(f"  {args.candidate}: {_result_key(candidate, minimized)!r}")
+
+    print(f"{len(cases)} cases, {divergences} divergences")
+
+    ref_ops = throughput(reference, cases, args.repeat)
+    cand_ops = throughput(candidate, cases, args.repeat)
+    print(f"{args.reference}: {ref_ops:.0f} prompts/s, {args.candidate}: {cand_ops:.0f} prompts/s ({cand_ops / ref_ops:.2f}x)")
+    return 1 if divergences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
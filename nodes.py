@@ -1,51 +1,207 @@
 import os
-import json
 import sys
 import decimal
-from typing import List, Dict
+import functools
+from typing import List, Dict, Optional
 import random
 import math
+import re
+import glob
+import fnmatch
+
+
+try:
+    from .tag_db import (
+        TagCategoryDB, LayeredTagCategory, TagCategoryStore, TagAliasStore, ALIASES_ENV, AliasTable, load_tag_counts,
+        normalize_tag, tokenize_text,
+    )
+    from . import tag_metrics
+except ImportError:
+    from tag_db import (
+        TagCategoryDB, LayeredTagCategory, TagCategoryStore, TagAliasStore, ALIASES_ENV, AliasTable, load_tag_counts,
+        normalize_tag, tokenize_text,
+    )
+    import tag_metrics
+
+
+# バージョンごとのタグカテゴリ DB。ファイルが変更されたら読み込み直す
+TAG_CATEGORY_FILES = {
+    1: "tag_category.json",
+    2: "tag_category_v2.json",
+    3: "tag_category_v3.json",
+}
+tag_category_stores: Dict[int, TagCategoryStore] = {}
+
+
+def get_tag_category(version=3) -> TagCategoryDB:
+    """
+    タグカテゴリ DB を返す。overlays/ フォルダ (と環境変数 COMFYUI_TAG_FILTER_OVERLAYS) に
+    オーバーレイの JSON がある場合は、DB の上に重ねた LayeredTagCategory を返す。
+    """
+    if version not in TAG_CATEGORY_FILES:
+        version = 3
+    store = tag_category_stores.get(version)
+    if store is None:
+        code_dir = os.path.dirname(os.path.realpath(__file__))
+        # v3 は utils/categolize_tags4.py が作るファイルなので、無ければ v2 を使う
+        fallback = os.path.join(code_dir, TAG_CATEGORY_FILES[2]) if version == 3 else None
+        store = tag_category_stores.setdefault(version, TagCategoryStore(
+            os.path.join(code_dir, TAG_CATEGORY_FILES[version]), os.path.join(code_dir, "overlays"),
+            fallback_path=fallback))
+    return store.get()
+
+
+# tag_alias.py で作るエイリアス表。環境変数 COMFYUI_TAG_FILTER_ALIASES で別のファイルを指定できる
+TAG_ALIAS_FILE = "tag_alias.json"
+tag_alias_store: Optional[TagAliasStore] = None
+
+
+def get_tag_aliases() -> Dict[str, str]:
+    """別名 -> 正規のタグ名。エイリアス表のファイルが無ければ空"""
+    global tag_alias_store
+    store = tag_alias_store
+    if store is None:
+        path = os.environ.get(ALIASES_ENV) or os.path.join(os.path.dirname(os.path.realpath(__file__)), TAG_ALIAS_FILE)
+        store = tag_alias_store = TagAliasStore(path)
+    return store.get()
+
+
+def canonical_tag(tag_text: str, tag_category) -> str:
+    """tag_category に無いタグがエイリアス表にあれば、正規のタグ名を返す (それ以外はそのまま)"""
+    aliases = get_tag_aliases()
+    if not aliases:
+        return tag_text
+    canonical = aliases.get(tag_text)
+    if canonical is None:
+        return tag_text
+    return tag_text if tag_text in tag_category else canonical
 
 
-tag_category1: Dict[str, List[str]] = {}
-tag_category2: Dict[str, List[str]] = {}
-tag_category3: Dict[str, List[str]] = {}
+def format_category(categories: str) -> list:
+    return list(_format_category(categories))
 
 
-def get_tag_category(version=3) -> dict:
-    global tag_category1, tag_category2, tag_category3
-    code_dir = os.path.dirname(os.path.realpath(__file__))
-    if version == 1:
-        if not tag_category1:
-            with open(os.path.join(code_dir, "tag_category.json"), encoding="utf-8-sig") as f: # file encoding is utf-8
-                tag_category1 = json.load(f)
-        return tag_category1
-    elif version == 2:
-        if not tag_category2:
-            with open(os.path.join(code_dir, "tag_category_v2.json"), encoding="utf-8-sig") as f: # file encoding is utf-8
-                tag_category2 = json.load(f)
-        return tag_category2
-    else:
-        if not tag_category3:
-            with open(os.path.join(code_dir, "tag_category_v3.json"), encoding="utf-8-sig") as f: # file encoding is utf-8
-                tag_category3 = json.load(f)
-        return tag_category3
+@functools.lru_cache(maxsize=256)
+def _format_category(categories: str) -> tuple:
+    return tuple(category.lower().strip().replace(" ", "_") for category in categories.replace("\n",",").replace(".",",").split(","))
 
 
-def format_category(categories: str) -> list:
-    return [category.lower().strip().replace(" ", "_") for category in categories.replace("\n",",").replace(".",",").split(",")]
+def _parse_weight(weight) -> tuple:
+    """
+    強度を (1/1000 単位の整数, 小数点以下の表示桁数, Decimal) に変換する。
+    表示は以前の decimal.Decimal(str(round(weight, 3))) と同じになるように桁数も持つ。
+    整数で表せない値 (nan, inf, 指数表記, -0.0) は Decimal のまま持つ。
+    """
+    if weight.__class__ is float:
+        if weight == 1.0:
+            return 1000, 1, None
+        if weight:
+            # 0.0 と -0.0 は同じキーになるのでキャッシュしない
+            return _parse_float_weight(weight)
+    return _parse_weight_text(str(round(weight, 3)))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_float_weight(weight:float) -> tuple:
+    return _parse_weight_text(str(round(weight, 3)))
+
+
+def _parse_weight_text(text:str) -> tuple:
+    int_part, dot, frac_part = text.partition('.')
+    digits = int_part[1:] if int_part.startswith('-') else int_part
+    if digits.isdigit() and len(frac_part) <= 3 and (frac_part.isdigit() or not dot):
+        milli = int(digits) * 1000 + int(frac_part.ljust(3, '0'))
+        if int_part.startswith('-'):
+            if not milli:
+                return None, 0, decimal.Decimal(text)
+            milli = -milli
+        return milli, len(frac_part), None
+    return None, 0, decimal.Decimal(text)
 
 
 class TagData:
+    # parse_tags の結果はキャッシュして共有するので、作成後は変更できない。
+    # 強度を変える場合は with_weight() / add_weight() で新しい TagData を作る。
+    # format / format_escape / format_unescape は使われた時に計算する
+    __slots__ = ("_tag", "_milli", "_scale", "_exact", "_format", "_format_escape", "_format_unescape")
+
     def __init__(self, tag:str, weight:float):
-        self.tag:str = tag
-        self.weight:decimal.Decimal = decimal.Decimal(str(round(weight, 3)))
-        self.format:str = tag.lower().strip().replace(' ', '_')
-        self.format_escape:str = escape_tag_special_chars(self.format)
-        self.format_unescape:str = remove_escape(unescape_tag_special_chars(self.format_escape))
-    
-    def get_categores(self):
-        return get_tag_category().get(self.format_unescape, [])
+        self._tag = tag
+        self._milli, self._scale, self._exact = _parse_weight(weight)
+        self._format = None
+        self._format_escape = None
+        self._format_unescape = None
+
+    @property
+    def tag(self) -> str:
+        return self._tag
+
+    @property
+    def weight(self) -> decimal.Decimal:
+        if self._milli is None:
+            return self._exact
+        return decimal.Decimal(self._weight_text())
+
+    @property
+    def weight_milli(self):
+        """強度の 1/1000 単位の整数値。整数で表せない強度の場合は None"""
+        return self._milli
+
+    @property
+    def format(self) -> str:
+        if self._format is None:
+            self._format = normalize_tag(self._tag)
+        return self._format
+
+    @property
+    def format_escape(self) -> str:
+        if self._format_escape is None:
+            self._format_escape = escape_tag_special_chars(self.format)
+        return self._format_escape
+
+    @property
+    def format_unescape(self) -> str:
+        if self._format_unescape is None:
+            self._format_unescape = remove_escape(unescape_tag_special_chars(self.format_escape))
+        return self._format_unescape
+
+    def canonical(self, tag_category) -> str:
+        """format_unescape をエイリアス表で正規のタグ名にしたもの (tag_category でカテゴリを検索する時に使う)"""
+        return canonical_tag(self.format_unescape, tag_category)
+
+    def _copy(self, milli, scale, exact) -> "TagData":
+        tag = TagData.__new__(TagData)
+        tag._tag = self._tag
+        tag._milli = milli
+        tag._scale = scale
+        tag._exact = exact
+        tag._format = self._format
+        tag._format_escape = self._format_escape
+        tag._format_unescape = self._format_unescape
+        return tag
+
+    def with_weight_of(self, other:"TagData") -> "TagData":
+        """other と同じ重みにしたタグ (重みの表記も other のまま)"""
+        return self._copy(other._milli, other._scale, other._exact)
+
+    def with_weight(self, weight:float) -> "TagData":
+        return self._copy(*_parse_weight(weight))
+
+    def add_weight(self, weight:float) -> "TagData":
+        milli, scale, exact = _parse_weight(weight)
+        if milli is None or self._milli is None:
+            return self._copy(None, 0, self.weight + (exact if milli is None else decimal.Decimal(_weight_text(milli, scale))))
+        return self._copy(self._milli + milli, max(self._scale, scale), None)
+
+    def _weight_text(self) -> str:
+        if self._milli is None:
+            return str(self._exact)
+        return _weight_text(self._milli, self._scale)
+
+    def get_categores(self, tag_category=None):
+        if tag_category is None:
+            tag_category = get_tag_category()
+        return tag_category.get(self.canonical(tag_category), [])
     
     def __str__(self):
         return self.format
@@ -62,7 +218,7 @@ class TagData:
         return hash(self.format)
     
     def text(self, format=False, underscore=False):
-        tag_text = self.tag
+        tag_text = self._tag
         if format:
             tag_text = self.format
         if underscore:
@@ -70,115 +226,123 @@ class TagData:
 
         tag_text = unescape_tag_special_chars(tag_text)
         
-        if self.weight != decimal.Decimal("1.0"):
-            return f"({tag_text}:{self.weight})"
+        if self._milli != 1000 and (self._milli is not None or self._exact != _WEIGHT_ONE):
+            return f"({tag_text}:{self._weight_text()})"
         return tag_text
 
 
+_WEIGHT_ONE = decimal.Decimal("1.0")
+
+
+def _weight_text(milli:int, scale:int) -> str:
+    integer, fraction = divmod(abs(milli), 1000)
+    text = str(integer)
+    if scale:
+        text += '.' + f"{fraction:03d}"[:scale]
+    return '-' + text if milli < 0 else text
+
+
+def _clean_tag(tag:str) -> str:
+    # Remove any leading/trailing whitespace and parentheses
+    tag = tag.strip()
+    if tag.startswith(('(', ')')) or tag.endswith(('(', ')')):
+        tag = tag.strip('()')
+    return tag.strip()
+
+
+def _split_groups(tag_string:str) -> list[str]:
+    # カッコの外側にあるカンマでグループに分ける。
+    # カンマで区切った断片ごとに str.count でカッコの深さを数えるので、1文字ずつのループや文字列の連結はしない
+    groups = []
+    pieces = []
+    depth = 0
+    for piece in tag_string.split(','):
+        pieces.append(piece)
+        if '(' in piece or ')' in piece:
+            depth += piece.count('(') - piece.count(')')
+        if depth == 0:
+            group = ','.join(pieces).strip(',').strip()
+            if group:
+                groups.append(group)
+            pieces = []
+    if pieces:
+        group = ','.join(pieces).strip(',').strip()
+        if group:
+            groups.append(group)
+    return groups
+
+
+PARSE_TAGS_CACHE_SIZE = 1024
+
+
 def parse_tags(tag_string:str) -> list[TagData]:
     if tag_string is None:
         return []
     if not tag_string:
         return []
+    # 同じ入力を複数のノードで parse するので、結果をキャッシュして使い回す
+    return list(_parse_tags_cached(tag_string))
+
+
+def parse_tags_cache_info():
+    """parse_tags のキャッシュの hits / misses / maxsize / currsize"""
+    return _parse_tags_cached.cache_info()
+
+
+def parse_tags_cache_clear():
+    _parse_tags_cached.cache_clear()
+
+
+@functools.lru_cache(maxsize=PARSE_TAGS_CACHE_SIZE)
+def _parse_tags_cached(tag_string:str) -> tuple[TagData, ...]:
     tag_string = tag_string.strip()
     if not tag_string:
-        return []
+        return ()
     
     tag_string = escape_tag_special_chars(tag_string)
-    #print(tag_string)
 
-    def clean_tag(tag):
-        # Remove any leading/trailing whitespace and parentheses
-        tag = tag.strip()
-        while tag.startswith(('(', ')')) or tag.endswith(('(', ')')):
-            tag = tag.strip('()')
-        return tag.strip()
+    result = []
+    for group in _split_groups(tag_string):
+        # Count the number of opening/closing parentheses at the start/end
+        opening_count = len(group) - len(group.lstrip('('))
+        closing_count = len(group) - len(group.rstrip(')'))
+
+        # Get the actual parentheses pairs count (use the minimum to ensure matching pairs)
+        paren_pairs = min(opening_count, closing_count)
 
-    def get_weight_and_tags(group):
-        group = clean_tag(group)
+        group = _clean_tag(group)
+        weight = 1.0
         if ':' in group:
             tags_part, weight_part = group.split(':', 1)
             try:
                 weight = float(weight_part)
+                group = tags_part
             except ValueError:
                 weight = 1.0
-                tags_part = group
-            tags = [t.strip() for t in tags_part.split(',')]
-        else:
-            tags = [t.strip() for t in group.split(',')]
-            weight = 1.0
-        return tags, weight
-
-    result = []
-    paren_count = 0
-    
-    # First pass: split into proper groups
-    groups = []
-    current = ''
-    for char in tag_string:
-        if char == '(':
-            paren_count += 1
-        elif char == ')':
-            paren_count -= 1
-        
-        current += char
-        
-        if paren_count == 0 and char == ',':
-            if current.strip(',').strip():
-                groups.append(current.strip(',').strip())
-            current = ''
-    if current.strip(',').strip():
-        groups.append(current.strip(',').strip())
-
-    # Second pass: process each group
-    for group in groups:
-        group = group.strip()
-        if not group:
-            continue
-
-        # Count the number of opening parentheses at the start
-        opening_count = 0
-        for char in group:
-            if char == '(':
-                opening_count += 1
-            else:
-                break
-
-        # Count the number of closing parentheses at the end
-        closing_count = 0
-        for char in reversed(group):
-            if char == ')':
-                closing_count += 1
-            else:
-                break
 
-        # Get the actual parentheses pairs count (use the minimum to ensure matching pairs)
-        paren_pairs = min(opening_count, closing_count)
-
-        tags, custom_weight = get_weight_and_tags(group)
-        
         # Set weight based on parentheses pairs
-        if custom_weight != 1.0:
-            weight = custom_weight
-        else:
-            if paren_pairs == 0:
-                weight = 1.0
-            else:
-                weight = 1.0 + (paren_pairs * 0.1)
+        if weight == 1.0 and paren_pairs:
+            weight = 1.0 + (paren_pairs * 0.1)
 
         # Add each tag with its weight
-        for tag in tags:
-            tag = clean_tag(tag)
+        for tag in group.split(','):
+            tag = _clean_tag(tag)
             if tag:
                 result.append(TagData(tag, weight))
     
-    return result
+    return tuple(result)
 
 
 def remove_duplicates(lst):
     return list(dict.fromkeys(lst))
 
 
+@functools.lru_cache(maxsize=64)
+def tag_format_set(tag_string:str) -> frozenset:
+    """タグ文字列に含まれるタグ (TagData.format) の集合。除外リストなど何度も使う入力用にキャッシュする"""
+    return frozenset(tag.format for tag in parse_tags(tag_string))
+
+
 def tagdata_to_string(tags:list[TagData], underscore=False) -> str:
     return ", ".join([tag.text(underscore=underscore) for tag in tags])
 
@@ -194,18 +358,26 @@ ESCAPE_MAP = {
 
 UNESCAPE_MAP = {v: k for k, v in ESCAPE_MAP.items()}
 
+_ESCAPE_ITEMS = sorted(ESCAPE_MAP.items(), key=lambda x: -len(x[0]))
+
 def escape_tag_special_chars(s: str) -> str:
+    if '\\' not in s:
+        return s
     # バックスラッシュは一番最後に処理するため、順番を工夫
-    for orig, repl in sorted(ESCAPE_MAP.items(), key=lambda x: -len(x[0])):
+    for orig, repl in _ESCAPE_ITEMS:
         s = s.replace(orig, repl)
     return s
 
 def unescape_tag_special_chars(s: str) -> str:
+    if '__escape_' not in s:
+        return s
     for repl, orig in UNESCAPE_MAP.items():
         s = s.replace(repl, orig)
     return s
 
 def remove_escape(s: str) -> str:
+    if '\\' not in s:
+        return s
     return s.replace('\\\\', '\\').replace('\\(', '(').replace('\\)', ')').replace('\\:', ':').replace('\\,', ',')
 
 
@@ -361,8 +533,10 @@ class TagColorChanger:
 
         replaced_tags = []
 
+        # 1回の呼び出しの間は同じスナップショットを使う
+        db = get_tag_category()
         for tag in tags:
-            tag_category = tag.get_categores()
+            tag_category = tag.get_categores(db)
             if 'skin_color' in tag_category and skin != 'skip':
                 tag = TagData(self.choice_color(skin, myrand) + "_skin", tag.weight)
             elif 'hair_color' in tag_category and hair != 'skip':
@@ -722,16 +896,22 @@ class TagRemover:
 
     def tag(self, tags:str, exclude_tags:str=""):
         tag_data = parse_tags(tags)
-        exclude_tag_data = parse_tags(exclude_tags)
+        exclude_formats = tag_format_set(exclude_tags or "")
 
-        uniq_tags = [tag for tag in tag_data if tag not in exclude_tag_data]
+        uniq_tags = [tag for tag in tag_data if tag.format not in exclude_formats]
         
         return (tagdata_to_string(uniq_tags) ,)
 
 
-class TagReplace:
-    # TODO: use TagData class
+def _popcount_fallback(value:int) -> int:
+    return bin(value).count("1")
+
+
+# int.bit_count は Python 3.10 から
+_popcount = getattr(int, "bit_count", _popcount_fallback)
 
+
+class TagReplace:
     def __init__(self):
         pass
 
@@ -754,55 +934,70 @@ class TagReplace:
 
     OUTPUT_NODE = True
 
-    def _get_categories(self, tag: str) -> set:
-        """タグのカテゴリーを取得する"""
-        tag_category = get_tag_category()
-        return set(tag_category.get(tag, []))
-
-    def _category_match_percentage(self, categories1: set, categories2: set) -> float:
-        """2つのカテゴリセット間の一致度(%)を計算する"""
-        if not categories1 or not categories2:
-            return 0
-        intersection = categories1.intersection(categories2)
-        union = categories1.union(categories2)
-        return len(intersection) / len(union)
+    def _match_replace_tags(self, tag_mask:int, replace_masks:list) -> tuple:
+        """
+        タグのカテゴリのビット列と、置換候補のカテゴリのビット列の Jaccard 係数を全部計算して
+        (一番一致した候補の番号, 一致度, 途中で一番になった候補の番号のリスト) を返す
+        """
+        best_index = None
+        best_percentage = 0
+        leaders = []
+        if not tag_mask:
+            return best_index, best_percentage, leaders
+
+        tag_count = _popcount(tag_mask)
+        for k, (replace_mask, replace_count) in enumerate(replace_masks):
+            if not replace_mask:
+                continue
+            intersection = _popcount(tag_mask & replace_mask)
+            if not intersection:
+                continue
+            match_percentage = intersection / (tag_count + replace_count - intersection)
+            if match_percentage > best_percentage:
+                best_percentage = match_percentage
+                best_index = k
+                leaders.append(k)
+        return best_index, best_percentage, leaders
 
     def tag(self, tags:str, replace_tags:str="", match:float=0.3):
-        tags = [tag.strip() for tag in tags.replace("\n",",").split(",")]
-        tags_normalized = [tag.replace(" ", "_").lower().strip() for tag in tags]
-
-        replace_tags = [tag.strip() for tag in replace_tags.replace("\n",",").split(",")]
-        replace_tags_normalized = [tag.replace(" ", "_").lower().strip() for tag in replace_tags]
-        replace_tags_used = {tag:False for tag in replace_tags_normalized}
-
+        tag_category = get_tag_category()
+        # 以前と同じく、改行もタグの区切りとして扱う
+        tag_list = parse_tags(tags.replace("\n", ","))
+
+        # 同じタグが複数ある場合は最初のものを使う
+        replace_list = list(dict.fromkeys(parse_tags(replace_tags.replace("\n", ","))))
+        replace_masks = []
+        for replace_tag in replace_list:
+            replace_mask = tag_category.tag_mask(replace_tag.canonical(tag_category)) or 0
+            replace_masks.append((replace_mask, _popcount(replace_mask)))
+        replace_tags_used = [False] * len(replace_list)
+
+        # 同じカテゴリの組み合わせのタグは置換先も同じなので、ビット列ごとに1回だけ計算する
+        matches = {}
         result = []
-        for i, tag in enumerate(tags_normalized):
-            tag_categories = self._get_categories(tag)
-            best_match_tag = None
-            best_match_tag_id = None
-            best_match_percentage = 0
-
-            for k, replace_tag in enumerate(replace_tags_normalized):
-                replace_categories = self._get_categories(replace_tag)
-                match_percentage = self._category_match_percentage(tag_categories, replace_categories)
-
-                if match_percentage and match_percentage > best_match_percentage:
-                    best_match_percentage = match_percentage
-                    best_match_tag = replace_tag
-                    replace_tags_used[replace_tag] = True
-                    best_match_tag_id = k
-
-            
-            if best_match_tag and best_match_percentage >= match:
-                result.append(replace_tags[best_match_tag_id])
+        for tag in tag_list:
+            tag_mask = tag_category.tag_mask(tag.canonical(tag_category)) or 0
+            found = matches.get(tag_mask)
+            if found is None:
+                found = matches[tag_mask] = self._match_replace_tags(tag_mask, replace_masks)
+            best_index, best_percentage, leaders = found
+
+            # 途中で一番になった候補は、最終的に選ばれなくても使用済みとして扱う
+            for k in leaders:
+                replace_tags_used[k] = True
+
+            if best_index is not None and best_percentage >= match:
+                # 置換したタグには元のタグの重みを引き継ぐ
+                result.append(replace_list[best_index].with_weight_of(tag))
             else:
-                result.append(tags[i])
+                result.append(tag)
 
-        # replace_tags の中から、tags に存在しないタグを追加
-        extra_tags = [replace_tag for replace_tag, used in replace_tags_used.items() if not used]
-        result.extend(extra_tags)
-        
-        return (", ".join(result),)
+        # replace_tags の中から、tags に存在しないタグを追加 (以前と同じく小文字・"_" 区切りにする)
+        texts = [tag.text() for tag in result]
+        texts.extend(replace_tag.text(format=True)
+                     for replace_tag, used in zip(replace_list, replace_tags_used) if not used)
+
+        return (", ".join(texts),)
 
 
 def tag_flexible_category(tag_text:str, tag_category:dict):
@@ -811,6 +1006,13 @@ def tag_flexible_category(tag_text:str, tag_category:dict):
 
     if tag_text in tag_category:
         return tag_text
+
+    # 空のトークンや空白を含まないタグは、DB の末尾トークンの索引を1回辿るだけで求まる
+    longest_suffix = getattr(tag_category, "longest_suffix", None)
+    if (longest_suffix is not None and '__' not in tag_text
+            and not tag_text.startswith('_') and not tag_text.endswith('_')
+            and tag_text.split() == [tag_text]):
+        return longest_suffix(tag_text)
         
     while tag_text_alt is None:
         tag_text_split = org_tag_text.split("_")
@@ -857,10 +1059,11 @@ class TagSelector:
         tag_list = parse_tags(tags)
         tag_category = get_tag_category()
         target_category = format_category(categorys)
+        target_mask = tag_category.category_mask(target_category)
 
         result = []
         for i, tag in enumerate(tag_list):
-            tag_text = tag.format_unescape
+            tag_text = tag.canonical(tag_category)
             tag_text_alt = None
 
             if flexible_filter and tag_text not in tag_category:
@@ -870,19 +1073,16 @@ class TagSelector:
 
             #print("tag_text_alt", f"{tag_text} == {tag_text_alt}")
 
-            if (tag_text in tag_category) or (flexible_filter and tag_text_alt and tag_text_alt in tag_category):
+            tag_mask = tag_category.tag_mask(tag_text)
+            if tag_mask is None and flexible_filter and tag_text_alt:
+                tag_mask = tag_category.tag_mask(tag_text_alt)
+
+            if tag_mask is not None:
                 if '*' == categorys:
                     result.append(tag)
                     continue
-                
-                category_list = tag_category.get(tag_text, tag_category.get(tag_text_alt, []))
-                #print("    category_list", category_list)
-
-                tag_is_taget_category = False
-                for category in category_list:
-                    if category in target_category:
-                        tag_is_taget_category = True
-                        break
+
+                tag_is_taget_category = bool(tag_mask & target_mask)
                 #print(f"        tag_is_taget_category tag={tag} in={tag_is_taget_category}")
                 if tag_is_taget_category:
                     if exclude:
@@ -929,14 +1129,69 @@ class TagComparator:
     def tag(self, tags1:str, tags2:str):
         tag_list1 = parse_tags(tags1)
         tag_list2 = parse_tags(tags2)
+        formats1 = tag_format_set(tags1 or "")
+        formats2 = tag_format_set(tags2 or "")
 
-        tags1_unique = [tag for tag in tag_list1 if tag not in tag_list2]
-        tags2_unique = [tag for tag in tag_list2 if tag not in tag_list1]
-        common_tags = [tag for tag in tag_list1 if tag in tag_list2]
+        tags1_unique = [tag for tag in tag_list1 if tag.format not in formats2]
+        tags2_unique = [tag for tag in tag_list2 if tag.format not in formats1]
+        common_tags = [tag for tag in tag_list1 if tag.format in formats2]
 
         return (tagdata_to_string(tags1_unique), tagdata_to_string(tags2_unique), tagdata_to_string(common_tags))
 
 
+class TagMultiComparator:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "optional": {
+                "tags1": ("STRING",),
+                "tags2": ("STRING",),
+                "tags3": ("STRING",),
+                "tags4": ("STRING",),
+                "tags5": ("STRING",),
+                "tags6": ("STRING",),
+            }
+        }
+
+    RETURN_TYPES = ("STRING", "STRING", "STRING",)
+    RETURN_NAMES = ("unique_tags", "common_tags", "all_tags",)
+
+    FUNCTION = "tag"
+
+    CATEGORY = "text"
+
+    OUTPUT_NODE = True
+
+    def tag(self, tags1:str=None, tags2:str=None, tags3:str=None, tags4:str=None, tags5:str=None, tags6:str=None):
+        """
+        空でない入力を比較して、1つの入力にだけあるタグ、全ての入力にあるタグ、いずれかの入力にあるタグを返す。
+        タグの順番と重みは最初に出てきたものを使う。
+        """
+        # format -> [最初の TagData, 含まれている入力の数, 最後に数えた入力の番号]
+        counts = {}
+        inputs = 0
+        for tag_list in map(parse_tags, (tags1, tags2, tags3, tags4, tags5, tags6)):
+            if not tag_list:
+                continue
+            inputs += 1
+            for tag in tag_list:
+                entry = counts.get(tag.format)
+                if entry is None:
+                    counts[tag.format] = [tag, 1, inputs]
+                elif entry[2] != inputs:
+                    entry[1] += 1
+                    entry[2] = inputs
+
+        unique_tags = [tag for tag, count, _ in counts.values() if count == 1]
+        common_tags = [tag for tag, count, _ in counts.values() if count == inputs]
+        all_tags = [tag for tag, _, _ in counts.values()]
+
+        return (tagdata_to_string(unique_tags), tagdata_to_string(common_tags), tagdata_to_string(all_tags))
+
+
 class TagFilter:
     def __init__(self):
         pass
@@ -1004,29 +1259,22 @@ class TagFilter:
 
         result = []
         tag_category = get_tag_category()
+        target_mask = tag_category.category_mask(targets)
+        exclude_mask = tag_category.category_mask(exclude_targets)
 
         for i, tag in enumerate(tag_list):
-            tag_text = tag.format_unescape
-            if tag_text in tag_category:
-                category_list = tag_category.get(tag_text, tag_category.get(tag.format_unescape, []))
+            tag_mask = tag_category.tag_mask(tag.canonical(tag_category))
+            if not tag_mask:
+                # not in tag_category or no category
+                continue
 
-                if not category_list:
-                    continue
+            if tag_mask & exclude_mask:
+                # not include this tag
+                continue
 
-                for category in category_list:
-                    if category in exclude_targets:
-                        # not include this tag
-                        break
-                else:
-                    if '*' == include_categories:
-                        # include all tags
-                        result.append(tag)
-                    else:
-                        for category in category_list:
-                            if category in targets:
-                                # include this tag
-                                result.append(tag)
-                                break
+            if '*' == include_categories or tag_mask & target_mask:
+                # include this tag
+                result.append(tag)
 
         return (tagdata_to_string(result),)
 
@@ -1062,9 +1310,9 @@ class TagEnhance:
         for i, tag in enumerate(tag_list):
             if tag in enhance_tag_list:
                 if add_strength:
-                    tag.weight += decimal.Decimal(str(round(strength, 3)))
+                    tag = tag.add_weight(strength)
                 else:
-                    tag.weight = decimal.Decimal(str(round(strength, 3)))
+                    tag = tag.with_weight(strength)
             result.append(tag)
         
         return (tagdata_to_string(result),)
@@ -1094,16 +1342,16 @@ class TagCategoryEnhance:
 
     def tag(self, tags:str, enhance_category:str, strength:float=1.2, add_strength:bool=False):
         tag_list = parse_tags(tags)
-        categories = format_category(enhance_category)
+        tag_category = get_tag_category()
+        category_mask = tag_category.category_mask(format_category(enhance_category))
 
         result = []
         for i, tag in enumerate(tag_list):
-            tag_category = tag.get_categores()
-            if tag_category and any(c in tag_category for c in categories):
+            if (tag_category.tag_mask(tag.canonical(tag_category)) or 0) & category_mask:
                 if add_strength:
-                    tag.weight += decimal.Decimal(str(round(strength, 3)))
+                    tag = tag.add_weight(strength)
                 else:
-                    tag.weight = decimal.Decimal(str(round(strength, 3)))
+                    tag = tag.with_weight(strength)
             result.append(tag)
         
         return (tagdata_to_string(result),)
@@ -1137,7 +1385,7 @@ class TagCategory:
         
         result = []
         for tag in tag_list:
-            tag_text = tag.format_unescape
+            tag_text = tag.canonical(tag_category)
             category = []
             if flexible_filter:
                 flex_tag_text = tag_flexible_category(tag_text, tag_category)
@@ -1153,6 +1401,41 @@ class TagCategory:
 
 
 
+class WildcardMatcher:
+    """
+    複数のワイルドカードを1つの正規表現にまとめたもの。
+    * ? [abc] [!abc] を含むパターンはタグ全体と一致するか、含まないパターンはタグのどこかに含まれるかで判定する。
+    """
+    __slots__ = ("patterns", "regex")
+
+    def __init__(self, patterns:tuple):
+        self.patterns = patterns
+        alternatives = []
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                alternatives.append(r'\A' + fnmatch.translate(pattern))
+            else:
+                alternatives.append(re.escape(pattern))
+        self.regex = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def __bool__(self):
+        return self.regex is not None
+
+    def match(self, text:str) -> bool:
+        return self.regex is not None and self.regex.search(text) is not None
+
+
+@functools.lru_cache(maxsize=256)
+def compile_wildcard(wildcard:str) -> WildcardMatcher:
+    """カンマ・改行区切りのワイルドカードをまとめてコンパイルする (結果はキャッシュされる)"""
+    patterns = []
+    for pattern in wildcard.replace("\n", ",").split(","):
+        pattern = pattern.lower().strip().replace(' ', '_')
+        if pattern and pattern not in patterns:
+            patterns.append(pattern)
+    return WildcardMatcher(tuple(patterns))
+
+
 class TagWildcardFilter:
     def __init__(self):
         pass
@@ -1164,6 +1447,9 @@ class TagWildcardFilter:
                 "tags": ("STRING", ),
                 "wildcard": ("STRING", {"default": ""}),
             },
+            "optional": {
+                "exclude_wildcard": ("STRING", {"default": ""}),
+            },
         }
 
     RETURN_TYPES = ("STRING", "BOOLEAN")
@@ -1173,34 +1459,62 @@ class TagWildcardFilter:
     CATEGORY = "text"
     OUTPUT_NODE = True
 
-    def tag(self, tags:str, wildcard:str) -> tuple:
-        if not tags or not wildcard:
-            return (tags,)
+    def tag(self, tags:str, wildcard:str, exclude_wildcard:str="") -> tuple:
+        include = compile_wildcard(wildcard or "")
+        exclude = compile_wildcard(exclude_wildcard or "")
+        if not tags or not (include or exclude):
+            return (tags, len(parse_tags(tags)) > 0)
         
         tag_list = parse_tags(tags)
-        
-        wildcard = wildcard.lower().strip().replace(' ', '_')
-
-        regex_on = False
-        if '*' in wildcard:
-            wildcard = wildcard.replace('*', '.*')
-            wildcard = f"^{wildcard}$"
-            regex_on = True
-            import re
 
         result = []
         for tag in tag_list:
-            if regex_on:
-                if re.match(wildcard, tag.format_unescape):
-                    result.append(tag)
-            else:    
-                if wildcard in tag.format_unescape:
-                    result.append(tag)
+            tag_text = tag.format_unescape
+            if include and not include.match(tag_text):
+                continue
+            if exclude and exclude.match(tag_text):
+                continue
+            result.append(tag)
         
         return (tagdata_to_string(result), len(result) > 0)
 
 
 
+@functools.lru_cache(maxsize=1)
+def tag_post_counts() -> Dict[str, int]:
+    """utils/wd-*-tagger-*.csv の タグ -> count (投稿数)"""
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    return load_tag_counts(sorted(glob.glob(os.path.join(code_dir, "utils", "wd-*-tagger-*.csv"))))
+
+
+# DB のスナップショットごとの (カテゴリ, 除くカテゴリ) -> AliasTable。DB が読み込み直されたら作り直す
+_alias_tables = (None, {})
+_ALIAS_TABLES_MAX = 256
+
+
+def category_alias_table(tag_category, category: str, negative_categories: tuple = ()) -> Optional[AliasTable]:
+    """category のタグの位置を、投稿数の重みで選ぶ表 (CSV に無いタグは CSV の最小の投稿数とする)"""
+    global _alias_tables
+    owner, tables = _alias_tables
+    if owner is not tag_category or len(tables) >= _ALIAS_TABLES_MAX:
+        owner, tables = _alias_tables = (tag_category, {})
+    key = (category, negative_categories)
+    if key not in tables:
+        positions = tag_category.category_tags(category)
+        if negative_categories:
+            negative_tags = tag_category.tags_in_categories(negative_categories)
+            positions = [position for position in positions if position not in negative_tags]
+        counts = tag_post_counts()
+        default_count = min(counts.values(), default=1)
+        weights = [counts.get(tag_category.tag_at(position), default_count) for position in positions]
+        tables[key] = AliasTable(positions, weights) if positions else None
+    return tables[key]
+
+
+# 除くカテゴリのタグを引き直す回数の上限 (count の何倍か)。超えたら除いた表を作って引く
+_REJECTION_LIMIT = 8
+
+
 class TagRandomCategory:
     def __init__(self):
         pass
@@ -1214,6 +1528,9 @@ class TagRandomCategory:
                 "count": ("INT", {"default": 1, "min": 1, "max": 100}),
                 "seed": ("INT", {"default": 1234, "min": 0, "max": sys.maxsize}),
             },
+            "optional": {
+                "popularity_weighted": ("BOOLEAN", {"default": False}),
+            },
         }
 
     RETURN_TYPES = ("STRING",)
@@ -1223,37 +1540,65 @@ class TagRandomCategory:
     CATEGORY = "text"
     OUTPUT_NODE = True
 
-    def tag(self, category:str, negative_category:str, count:int=1, seed:int=1234) -> tuple:
+    def tag(self, category:str, negative_category:str, count:int=1, seed:int=1234, popularity_weighted:bool=False) -> tuple:
         category_list = format_category(category)
         negative_category_list = format_category(negative_category)
         if not category_list:
             return ("",)
-        tag_category:Dict[str, List[str]] = get_tag_category()
-
-        
+        tag_category = get_tag_category()
+        negative_tags = tag_category.tags_in_categories(negative_category_list)
 
         selected_tags = []
         for cat in category_list:
             if not cat:
                 continue
 
-            cat_select_tags = []
-            for tag, cats in tag_category.items():
-                if cat in cats:
-                    if negative_category_list and any(neg_cat in cats for neg_cat in negative_category_list):
-                        continue
-                    cat_select_tags.append(tag.replace("(", "\\(").replace(")", "\\)").replace(":", "\\:").replace(",", "\\,"))
+            if popularity_weighted:
+                for tag in self.weighted_choices(tag_category, cat, negative_category_list, negative_tags, count, seed):
+                    tag = tag_category.tag_at(tag)
+                    selected_tags.append(tag.replace("(", "\\(").replace(")", "\\)").replace(":", "\\:").replace(",", "\\,"))
+                continue
+
+            cat_select_tags = tag_category.category_tags(cat)
+            if negative_tags:
+                cat_select_tags = [tag for tag in cat_select_tags if tag not in negative_tags]
 
             if not cat_select_tags:
                 continue
 
             myrand = random.Random(seed)
-            selected_tags += myrand.choices(cat_select_tags, k=count)
+            for tag in myrand.choices(cat_select_tags, k=count):
+                tag = tag_category.tag_at(tag)
+                selected_tags.append(tag.replace("(", "\\(").replace(")", "\\)").replace(":", "\\:").replace(",", "\\,"))
 
         selected_tags = remove_duplicates(parse_tags(", ".join(selected_tags)))
 
         return (tagdata_to_string(selected_tags),)
 
+    @staticmethod
+    def weighted_choices(tag_category, cat: str, negative_category_list: list, negative_tags, count: int, seed: int) -> list:
+        """cat のタグの位置を投稿数の重みで count 個選ぶ (重複あり)"""
+        table = category_alias_table(tag_category, cat)
+        if table is None:
+            return []
+        myrand = random.Random(seed)
+        if not negative_tags:
+            return [table.sample(myrand) for _ in range(count)]
+
+        # 除くタグが少なければ、引いたタグを捨てて引き直すだけで済む
+        selected = []
+        for _ in range(count * _REJECTION_LIMIT):
+            position = table.sample(myrand)
+            if position not in negative_tags:
+                selected.append(position)
+                if len(selected) == count:
+                    return selected
+        table = category_alias_table(tag_category, cat, tuple(sorted(set(negative_category_list))))
+        if table is None:
+            return []
+        selected.extend(table.sample(myrand) for _ in range(count - len(selected)))
+        return selected
+
 
 class TagPipeIn:
     def __init__(self):
@@ -1432,44 +1777,19 @@ class TagDetector:
     OUTPUT_NODE = True
 
     def tag(self, tags:str, max_join:int=4) -> tuple:
-        keys = [",", "_", ";", "|", "&", "*", "?", "!", "@", "#", "$", "%", "^", "(", ")", "[", "]", "{", "}", "<", ">", "/", "\\", "`", "\n", "\r", "\t"]
-
-        def split_tags(target:str, mykey:str, result:set):
-            if not target:
-                return
-            mysplits = target.split(mykey)
-            for mysplit in mysplits:
-                mysplit = mysplit.strip()
-                if not mysplit:
-                    continue
-                key_in = False
-                for key in keys:
-                    if key in mysplit:
-                        split_tags(mysplit, key, result)
-                        key_in = True
-
-                if not key_in:
-                    if mysplit not in result:
-                        result.append(mysplit)
-
-        result = []
-        
-        split_tags(tags, " ", result)
-
-        merge_tags = []
-        for i in range(len(result)):
-            for j in range(max_join):
-                merge_tag = "_".join(result[i:i+j+1])
-                if merge_tag not in merge_tags:
-                    merge_tags.append(merge_tag)
-
-
         tag_category = get_tag_category()
-
-        result_tags = []
-        for tag in merge_tags:
-            if tag in tag_category:
-                result_tags.append(tag)
+        tokens = tokenize_text(tags)
+
+        # 先頭から最長一致でタグを探し、見つかったらその後ろから続ける
+        result_tags = {}
+        i = 0
+        while i < len(tokens):
+            found = tag_category.longest_match(tokens, i, max_join)
+            if found is None:
+                i += 1
+                continue
+            i, tag = found
+            result_tags[tag] = None
 
         return (tagdata_to_string(parse_tags(",".join(result_tags))),)
 
@@ -1502,6 +1822,34 @@ class TagEmpty:
         return (tagdata_to_string(tag_list), False)
 
 
+def batch_node(node_class):
+    """
+    node_class をリストで受け取ってリストで返すノード (INPUT_IS_LIST / OUTPUT_IS_LIST) にする。
+    入力の長さが違う場合、短い入力は最後の値を繰り返す (ComfyUI と同じ)。
+    カテゴリ指定などの設定から作るものはキャッシュされるので、一覧の2件目以降は作り直さない。
+    """
+    class BatchNode(node_class):
+        INPUT_IS_LIST = True
+        OUTPUT_IS_LIST = tuple(True for _ in node_class.RETURN_TYPES)
+        FUNCTION = "tag_batch"
+
+        def tag_batch(self, **kwargs):
+            outputs = tuple([] for _ in node_class.RETURN_TYPES)
+            if any(len(values) == 0 for values in kwargs.values()):
+                return outputs
+
+            size = max((len(values) for values in kwargs.values()), default=0)
+            function = getattr(self, node_class.FUNCTION)
+            for i in range(size):
+                result = function(**{key: values[min(i, len(values) - 1)] for key, values in kwargs.items()})
+                for output, value in zip(outputs, result):
+                    output.append(value)
+            return outputs
+
+    BatchNode.__name__ = BatchNode.__qualname__ = node_class.__name__ + "Batch"
+    return BatchNode
+
+
 NODE_CLASS_MAPPINGS = {
     "TagSwitcher": TagSwitcher,
     "TagMerger": TagMerger,
@@ -1511,6 +1859,7 @@ NODE_CLASS_MAPPINGS = {
     "TagIf": TagIf,
     "TagSelector": TagSelector,
     "TagComparator": TagComparator,
+    "TagMultiComparator": TagMultiComparator,
     "TagEnhance": TagEnhance,
     "TagCategoryEnhance": TagCategoryEnhance,
     "TagCategory": TagCategory,
@@ -1540,6 +1889,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "TagIf": "TagIf",
     "TagSelector": "TagSelector",
     "TagComparator": "TagComparator",
+    "TagMultiComparator": "TagMultiComparator",
     "TagEnhance": "TagEnhance",
     "TagCategoryEnhance": "TagCategoryEnhance",
     "TagCategory": "TagCategory",
@@ -1558,3 +1908,13 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "TagEmpty": "TagEmpty",
     "TagColorChanger": "TagColorChanger",
 }
+
+
+# 全てのノードにリスト（バッチ）処理版を追加する
+for _name in list(NODE_CLASS_MAPPINGS.keys()):
+    NODE_CLASS_MAPPINGS[_name + "Batch"] = batch_node(NODE_CLASS_MAPPINGS[_name])
+    NODE_DISPLAY_NAME_MAPPINGS[_name + "Batch"] = NODE_DISPLAY_NAME_MAPPINGS[_name] + " (Batch)"
+
+
+# 環境変数 COMFYUI_TAG_FILTER_METRICS=1 の場合だけ、ノードの処理時間を計測する
+tag_metrics.enable_from_env(sys.modules[__name__], (TagCategoryDB, LayeredTagCategory))
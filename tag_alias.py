@@ -0,0 +1,106 @@
+"""
+Danbooru のタグのエイリアス (別名 -> 正規のタグ名) の一覧から、ノードが使うエイリアス表 tag_alias.json を作る。
+
+    python tag_alias.py tag_aliases.ndjson
+    python tag_alias.py tag_aliases.json tags.csv --output tag_alias.json
+
+読み込めるのは
+- Danbooru の tag_aliases.json の形式 (antecedent_name, consequent_name, status) の NDJSON か JSON の配列
+  (status があるものは active だけを使う)
+- CSV: 「別名,正規のタグ名」の行か、a1111-sd-webui-tagcomplete の「タグ,カテゴリ,件数,"別名1,別名2"」の行
+タグ名はノードと同じ形 (小文字、空白は "_") にしてから、エイリアスの連鎖 (a -> b -> c) を最後のタグにまとめる。
+DB にあるタグはそのままカテゴリを引けるので、既定では「別名が DB に無く、正規のタグ名が DB にある」ものだけを書き出す。
+"""
+
+import sys
+import csv
+import argparse
+from typing import Dict, Iterable, Iterator, Tuple
+
+try:
+    from .tag_db import load_tag_db, normalize_tag, write_json_atomic
+    from .tag_diff import iter_dump
+except ImportError:
+    from tag_db import load_tag_db, normalize_tag, write_json_atomic
+    from tag_diff import iter_dump
+
+
+def _iter_csv(path: str) -> Iterator[Tuple[str, str]]:
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            row = [cell.strip() for cell in row]
+            if len(row) == 2 and row[0] and row[1]:
+                yield row[0], row[1]
+            elif len(row) >= 4 and row[0]:
+                # tagcomplete の形式: 4列目が別名のリスト
+                for alias in row[3].split(","):
+                    alias = alias.strip()
+                    if alias:
+                        yield alias, row[0]
+
+
+def iter_aliases(path: str) -> Iterator[Tuple[str, str]]:
+    """エイリアスの一覧のファイルから (別名, 正規のタグ名) を1件ずつ返す"""
+    if path.lower().endswith(".csv"):
+        yield from _iter_csv(path)
+        return
+    for record in iter_dump(path):
+        if record.get("status", "active") != "active":
+            continue
+        antecedent = record.get("antecedent_name")
+        consequent = record.get("consequent_name")
+        if antecedent and consequent:
+            yield antecedent, consequent
+
+
+def resolve_aliases(pairs: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    別名 -> 正規のタグ名 の表を作る。タグ名は normalize_tag で揃え、
+    連鎖は最後のタグにまとめ、循環しているものは捨てる
+    """
+    aliases = {}
+    for antecedent, consequent in pairs:
+        antecedent = normalize_tag(antecedent)
+        consequent = normalize_tag(consequent)
+        # 同じ別名が何度もある場合は最初のものを使う
+        if antecedent != consequent:
+            aliases.setdefault(antecedent, consequent)
+
+    resolved = {}
+    for antecedent in aliases:
+        seen = {antecedent}
+        tag = aliases[antecedent]
+        while tag in aliases and tag not in seen:
+            seen.add(tag)
+            tag = aliases[tag]
+        if tag not in seen:
+            resolved[antecedent] = tag
+    return resolved
+
+
+def build(alias_paths: list, db=None) -> Dict[str, str]:
+    """db を渡した場合は、別名が db に無く正規のタグ名が db にあるものだけを返す"""
+    pairs = (pair for path in alias_paths for pair in iter_aliases(path))
+    aliases = resolve_aliases(pairs)
+    if db is not None:
+        aliases = {alias: tag for alias, tag in aliases.items() if alias not in db and tag in db}
+    return dict(sorted(aliases.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the tag alias table used by the nodes")
+    parser.add_argument("aliases", nargs="+", help="alias lists (Danbooru tag_aliases NDJSON / JSON array, or CSV)")
+    parser.add_argument("--db", default="tag_category_v3.json")
+    parser.add_argument("--output", default="tag_alias.json")
+    parser.add_argument("--all", action="store_true", help="keep aliases regardless of the tag category DB")
+    args = parser.parse_args(argv)
+
+    db = None if args.all else load_tag_db(args.db)
+    aliases = build(args.aliases, db)
+    write_json_atomic(args.output, aliases)
+    print(f"エイリアスの数: {len(aliases)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+フォルダ内のキャプションファイル (.txt) をノードで一括処理するコマンドラインツール。
+
+    python tag_captions.py dataset/ --step "TagSelector categorys=pose exclude=true" --step "TagRemover exclude_tags=watermark"
+    python tag_captions.py dataset/ --output cleaned/ --workers 8 --step "TagFilter include_categories=* exclude_categories=color"
+
+--step には「ノード名 入力名=値 ...」を指定し、指定した順番に処理します。
+キャプションはノードの最初の STRING 入力 (tags など) に渡され、最初の出力が次のステップに渡されます。
+--output を省略した場合はファイルを上書きします。書き込みは一時ファイルからの置き換えで行います。
+"""
+
+import os
+import sys
+import time
+import shlex
+import inspect
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from nodes import NODE_CLASS_MAPPINGS
+from tag_db import write_atomic
+
+
+def _convert_value(name: str, value: str, input_type):
+    kind = input_type[0]
+    if kind == "BOOLEAN":
+        lowered = value.lower()
+        if lowered in ("true", "1", "yes", "on"):
+            return True
+        if lowered in ("false", "0", "no", "off"):
+            return False
+        raise ValueError(f"{name}: invalid boolean '{value}'")
+    if kind == "INT":
+        return int(value)
+    if kind == "FLOAT":
+        return float(value)
+    if isinstance(kind, list) and value not in kind:
+        raise ValueError(f"{name}: '{value}' is not one of {kind}")
+    return value
+
+
+def parse_step(step: str) -> tuple:
+    """'TagRemover exclude_tags=a,b' を (ノード名, キャプションの入力名, 設定) に変換する"""
+    words = shlex.split(step)
+    if not words:
+        raise ValueError("empty step")
+    node_name = words[0]
+    # 実行するのはバッチ版なので、バッチ版のノード名 (xxxBatch) は受け付けない
+    if node_name not in NODE_CLASS_MAPPINGS or node_name + "Batch" not in NODE_CLASS_MAPPINGS:
+        raise ValueError(f"unknown node: {node_name}")
+
+    node_class = NODE_CLASS_MAPPINGS[node_name]
+    input_types = node_class.INPUT_TYPES()
+    inputs = {**input_types.get("required", {}), **input_types.get("optional", {})}
+    string_inputs = [name for name, input_type in inputs.items() if input_type[0] == "STRING"]
+    if not string_inputs:
+        raise ValueError(f"{node_name} has no STRING input")
+
+    settings = {}
+    for word in words[1:]:
+        name, sep, value = word.partition("=")
+        if not sep or name not in inputs:
+            raise ValueError(f"{node_name}: invalid input '{word}'")
+        settings[name] = _convert_value(name, value, inputs[name])
+
+    # 関数に既定値の無い必須の入力は、INPUT_TYPES の既定値を使う (どちらも無ければエラー)
+    parameters = inspect.signature(getattr(node_class, node_class.FUNCTION)).parameters
+    for name, input_type in input_types.get("required", {}).items():
+        parameter = parameters.get(name)
+        if name == string_inputs[0] or name in settings or (parameter is not None and parameter.default is not parameter.empty):
+            continue
+        options = input_type[1] if len(input_type) > 1 else {}
+        if "default" not in options:
+            raise ValueError(f"{node_name}: missing required input '{name}'")
+        settings[name] = options["default"]
+    return node_name, string_inputs[0], settings
+
+
+_steps = []
+
+
+def _init_worker(steps: list):
+    global _steps
+    _steps = []
+    for node_name, input_name, settings in steps:
+        node = NODE_CLASS_MAPPINGS[node_name + "Batch"]()
+        _steps.append((getattr(node, node.FUNCTION), input_name, {key: [value] for key, value in settings.items()}))
+
+
+def apply_steps(captions: list) -> list:
+    for function, input_name, settings in _steps:
+        captions = function(**settings, **{input_name: captions})[0]
+    return captions
+
+
+def process_chunk(chunk: list) -> tuple:
+    """(入力ファイル, 出力ファイル) のリストを処理して (処理数, 変更数, エラー) を返す"""
+    errors = []
+    jobs = []
+    captions = []
+    for src, dst in chunk:
+        try:
+            with open(src, encoding="utf-8-sig") as f:
+                captions.append(f.read().strip())
+            jobs.append((src, dst))
+        except (OSError, UnicodeDecodeError) as e:
+            errors.append(f"{src}: {e}")
+
+    try:
+        results = apply_steps(captions)
+    except Exception as e:
+        # ノードのエラーはこのチャンクのファイルのエラーとして報告し、他のチャンクの処理は続ける
+        errors.extend(f"{src}: {e!r}" for src, _ in jobs)
+        return len(jobs), 0, errors
+
+    changed = 0
+    for (src, dst), before, after in zip(jobs, captions, results):
+        if src == dst and before == after:
+            continue
+        try:
+            os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+            write_atomic(dst, after.encode("utf-8"), ".txt")
+            changed += 1
+        except OSError as e:
+            errors.append(f"{dst}: {e}")
+    return len(jobs), changed, errors
+
+
+def iter_chunks(input_dir: str, output_dir: str, suffix: str, chunk_size: int):
+    chunk = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(suffix):
+                continue
+            src = os.path.join(root, name)
+            dst = os.path.join(output_dir, os.path.relpath(src, input_dir)) if output_dir else src
+            chunk.append((src, dst))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress:
+    def __init__(self, quiet: bool = False, interval: float = 1.0):
+        self.quiet = quiet
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last = 0.0
+        self.files = 0
+        self.changed = 0
+        self.errors = 0
+
+    def update(self, files: int, changed: int, errors: list, force: bool = False):
+        self.files += files
+        self.changed += changed
+        self.errors += len(errors)
+        for error in errors:
+            print(f"error: {error}", file=sys.stderr)
+
+        now = time.perf_counter()
+        if self.quiet or (not force and now - self.last < self.interval):
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        print(f"\r{self.files} files ({self.changed} written, {self.errors} errors) "
+              f"{self.files / elapsed:.0f} files/s", end="\n" if force else "", file=sys.stderr, flush=True)
+
+
+def run(input_dir: str, steps: list, output_dir: str = None, workers: int = None, chunk_size: int = 256,
+        suffix: str = ".txt", quiet: bool = False) -> Progress:
+    workers = workers or os.cpu_count() or 1
+    progress = Progress(quiet)
+    chunks = iter_chunks(input_dir, output_dir, suffix, chunk_size)
+
+    if workers <= 1:
+        _init_worker(steps)
+        for chunk in chunks:
+            progress.update(*process_chunk(chunk))
+    else:
+        # ファイル一覧を全部メモリに載せないように、実行中のチャンク数を制限しながら投入する
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(steps,)) as executor:
+            pending = set()
+            for chunk in chunks:
+                pending.add(executor.submit(process_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        progress.update(*future.result())
+            for future in pending:
+                progress.update(*future.result())
+
+    progress.update(0, 0, [], force=True)
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process caption files with comfyui_tag_filter nodes.", fromfile_prefix_chars="@")
+    parser.add_argument("input_dir")
+    parser.add_argument("--step", action="append", required=True, help='node and inputs, e.g. "TagRemover exclude_tags=a,b"')
+    parser.add_argument("--output", default=None, help="output directory (default: overwrite input files)")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=256, help="files per work unit")
+    parser.add_argument("--suffix", default=".txt")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    try:
+        steps = [parse_step(step) for step in args.step]
+    except ValueError as e:
+        parser.error(str(e))
+
+    progress = run(args.input_dir, steps, args.output, args.workers, args.chunk_size, args.suffix, args.quiet)
+    return 1 if progress.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,988 @@
+"""
+tag_category*.json をコンパイルしたバイナリ形式 (.tagdb) を mmap で開き、
+dict と同じ API (in / get / [] / items) で参照するためのモジュール。
+
+    python tag_db.py                 # tag_category*.json を全てコンパイル
+    python tag_db.py tag_category_v2.json
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import mmap
+import glob
+import struct
+import functools
+import threading
+import time
+from array import array
+from collections.abc import Mapping, ItemsView
+from typing import Dict, List, Optional, Tuple
+
+
+_MAGIC = b"TAGCATDB"
+_FORMAT_VERSION = 2
+_BYTEORDER = 1 if sys.byteorder == "little" else 2
+
+# セクションはこの順番で 8 バイト境界に並べる
+_SECTIONS = (
+    "cat_offsets",      # I[n_cats + 1]  カテゴリ名の cat_blob 内オフセット
+    "cat_blob",         # カテゴリ名 (utf-8)
+    "tag_offsets",      # I[n_tags + 1]  ソート済みタグ名の tag_blob 内オフセット
+    "tag_blob",         # タグ名 (utf-8, バイト順ソート)
+    "tag_order",        # I[n_tags]      JSON の並び順 -> ソート済みインデックス
+    "tag_cat_offsets",  # I[n_tags + 1]  タグごとのカテゴリ ID 列のオフセット
+    "tag_cat_ids",      # H[...]         カテゴリ ID (JSON の並び順のまま)
+    "cat_tag_offsets",  # I[n_cats + 1]  カテゴリごとのタグ位置リストのオフセット
+    "cat_tag_ids",      # I[...]         カテゴリ -> タグの JSON 上の位置 (昇順)
+)
+_HEADER = struct.Struct("<8sIIIIQQ" + "Q" * (len(_SECTIONS) + 1))
+
+DB_SUFFIX = ".tagdb"
+
+
+def _align(buf: bytearray, size: int = 8):
+    buf.extend(b"\0" * (-len(buf) % size))
+
+
+def compile_tag_category(tag_category: Dict[str, List[str]], src_size: int = 0, src_mtime_ns: int = 0) -> bytes:
+    # カテゴリ名は出現順に ID を振る
+    cat_ids: Dict[str, int] = {}
+    for categories in tag_category.values():
+        for category in categories:
+            if category not in cat_ids:
+                cat_ids[category] = len(cat_ids)
+    if len(cat_ids) > 0xFFFF:
+        raise ValueError(f"too many categories: {len(cat_ids)}")
+
+    tags = list(tag_category.keys())
+    sorted_tags = sorted(range(len(tags)), key=lambda i: tags[i].encode("utf-8"))
+    sorted_index = [0] * len(tags)
+    for index, i in enumerate(sorted_tags):
+        sorted_index[i] = index
+
+    def string_table(strings):
+        offsets = array("I", [0])
+        blob = bytearray()
+        for s in strings:
+            blob += s.encode("utf-8")
+            offsets.append(len(blob))
+        return offsets.tobytes(), bytes(blob)
+
+    cat_offsets, cat_blob = string_table(cat_ids.keys())
+    tag_offsets, tag_blob = string_table(tags[i] for i in sorted_tags)
+
+    tag_cat_offsets = array("I", [0])
+    tag_cat_ids = array("H")
+    for i in sorted_tags:
+        tag_cat_ids.extend(cat_ids[category] for category in tag_category[tags[i]])
+        tag_cat_offsets.append(len(tag_cat_ids))
+
+    # カテゴリ -> タグ (JSON 上の位置) の転置インデックス
+    postings: List[List[int]] = [[] for _ in cat_ids]
+    for position, tag in enumerate(tags):
+        for category_id in sorted({cat_ids[category] for category in tag_category[tag]}):
+            postings[category_id].append(position)
+    cat_tag_offsets = array("I", [0])
+    cat_tag_ids = array("I")
+    for posting in postings:
+        cat_tag_ids.extend(posting)
+        cat_tag_offsets.append(len(cat_tag_ids))
+
+    sections = {
+        "cat_offsets": cat_offsets,
+        "cat_blob": cat_blob,
+        "tag_offsets": tag_offsets,
+        "tag_blob": tag_blob,
+        "tag_order": array("I", sorted_index).tobytes(),
+        "tag_cat_offsets": tag_cat_offsets.tobytes(),
+        "tag_cat_ids": tag_cat_ids.tobytes(),
+        "cat_tag_offsets": cat_tag_offsets.tobytes(),
+        "cat_tag_ids": cat_tag_ids.tobytes(),
+    }
+
+    body = bytearray(b"\0" * _HEADER.size)
+    _align(body)
+    offsets = []
+    for name in _SECTIONS:
+        offsets.append(len(body))
+        body += sections[name]
+        _align(body)
+    offsets.append(len(body))
+
+    _HEADER.pack_into(body, 0, _MAGIC, _FORMAT_VERSION, _BYTEORDER, len(tags), len(cat_ids), src_size, src_mtime_ns, *offsets)
+    return bytes(body)
+
+
+_SUFFIX_LEAF = {None: True}
+
+# 文章をタグのトークンに分ける区切り文字 (空白と "_" を含む)
+_TOKEN_RE = re.compile(r"[^\s,_;|&*?!@#$%^()\[\]{}<>/\\`]+")
+# 文末の "." や ":" は別のトークンにする (blue eyes. -> blue, eyes, .)
+_TRAILING_PUNCT_RE = re.compile(r"(.*\w)([.:]+)$")
+_PUNCT_CHARS = ".:"
+
+
+def normalize_tag(tag: str) -> str:
+    """タグ名を小文字にして、前後の空白を除き、空白を "_" にする (ノードのタグと同じ形)"""
+    return tag.lower().strip().replace(" ", "_")
+
+
+def tokenize_text(text: str) -> List[str]:
+    """文章を小文字にしてタグのトークン列に分ける"""
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        match = _TRAILING_PUNCT_RE.match(token)
+        if match:
+            tokens.append(match[1])
+            tokens.append(match[2])
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def _build_suffix_trie(items) -> dict:
+    # タグ名を "_" で区切り、末尾のトークンから辿る木。カテゴリの無いタグは含めない。
+    # 末端の節はすべて同じ dict (_SUFFIX_LEAF) を共有してメモリを節約する
+    root = {}
+    for tag, categories in items:
+        if not categories:
+            continue
+        node = root
+        for token in reversed(tag.split("_")):
+            child = node.get(token)
+            if child is None or child is _SUFFIX_LEAF:
+                child = dict(child) if child is not None else {}
+                node[token] = child
+            node = child
+        node[None] = True
+    # 子の無い節を共有の末端に置き換える
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for token, child in node.items():
+            if token is None:
+                continue
+            if len(child) == 1 and None in child:
+                node[token] = _SUFFIX_LEAF
+            else:
+                stack.append(child)
+    return root
+
+
+def _match_suffix_trie(trie: dict, tag: str) -> Optional[str]:
+    tokens = tag.split("_")
+    node = trie
+    best = 0
+    for i in range(len(tokens) - 1, 0, -1):
+        node = node.get(tokens[i])
+        if node is None:
+            break
+        if None in node:
+            best = i
+    if not best:
+        return None
+    return "_".join(tokens[best:])
+
+
+def _build_token_trie(tags) -> dict:
+    # tokenize_text で分けたトークンを先頭から辿る木。末端の節の None にタグ名を入れる。
+    # "_" 以外の区切り文字を含むタグは文章のトークンからは作れないので含めない
+    root = {}
+    for tag in tags:
+        if "_".join(_TOKEN_RE.findall(tag)) != tag:
+            continue
+        node = root
+        for token in tokenize_text(tag):
+            node = node.setdefault(token, {})
+        node.setdefault(None, tag)
+    return root
+
+
+def _match_token_trie(trie: dict, tokens: List[str], start: int, max_words: int) -> Optional[tuple]:
+    node = trie
+    found = None
+    words = 0
+    for i in range(start, len(tokens)):
+        token = tokens[i]
+        if token.strip(_PUNCT_CHARS):
+            words += 1
+            if words > max_words:
+                break
+        node = node.get(token)
+        if node is None:
+            break
+        if None in node:
+            found = (i + 1, node[None])
+    return found
+
+
+class _TagCategoryItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._iter_items()
+
+
+class TagCategoryDB(Mapping):
+    """コンパイル済みのタグカテゴリ DB。dict[str, list[str]] と同じように使える。"""
+
+    def __init__(self, buffer, path: Optional[str] = None):
+        header = _HEADER.unpack_from(buffer, 0)
+        magic, version, byteorder, n_tags, n_cats, src_size, src_mtime_ns = header[:7]
+        if magic != _MAGIC or version != _FORMAT_VERSION or byteorder != _BYTEORDER:
+            raise ValueError("unsupported tag category db format")
+
+        self.path = path
+        self.src_size = src_size
+        self.src_mtime_ns = src_mtime_ns
+        self._buffer = buffer
+        self._n_tags = n_tags
+        self._n_cats = n_cats
+
+        view = memoryview(buffer)
+        offsets = header[7:]
+        section = {name: view[offsets[i]:offsets[i + 1]] for i, name in enumerate(_SECTIONS)}
+        self._cat_offsets = section["cat_offsets"][:(n_cats + 1) * 4].cast("I")
+        self._cat_blob_start = offsets[_SECTIONS.index("cat_blob")]
+        self._tag_offsets = section["tag_offsets"][:(n_tags + 1) * 4].cast("I")
+        self._tag_blob_start = offsets[_SECTIONS.index("tag_blob")]
+        self._tag_order = section["tag_order"][:n_tags * 4].cast("I")
+        self._tag_cat_offsets = section["tag_cat_offsets"][:(n_tags + 1) * 4].cast("I")
+        n_ids = self._tag_cat_offsets[n_tags] if n_tags else 0
+        self._tag_cat_ids = section["tag_cat_ids"][:n_ids * 2].cast("H")
+        self._cat_tag_offsets = section["cat_tag_offsets"][:(n_cats + 1) * 4].cast("I")
+        n_postings = self._cat_tag_offsets[n_cats] if n_cats else 0
+        self._cat_tag_ids = section["cat_tag_ids"][:n_postings * 4].cast("I")
+
+        self._cat_names: List[Optional[str]] = [None] * n_cats
+        self._cat_ids: Optional[Dict[str, int]] = None
+        self._suffix_trie: Optional[dict] = None
+        self._token_trie: Optional[dict] = None
+        self._tag_positions: Optional[array] = None
+        self._find = functools.lru_cache(maxsize=65536)(self._find_index)
+        self._mask = functools.lru_cache(maxsize=None)(self._index_mask)
+        # ノードの設定 (カテゴリ指定) から作るものは呼び出しごとに作り直さない
+        self._category_mask = functools.lru_cache(maxsize=256)(self._category_mask_uncached)
+        self._tags_in_categories = functools.lru_cache(maxsize=64)(self._tags_in_categories_uncached)
+
+    def _tag_bytes(self, index: int) -> bytes:
+        start = self._tag_blob_start
+        return self._buffer[start + self._tag_offsets[index]:start + self._tag_offsets[index + 1]]
+
+    def _find_index(self, tag: str) -> int:
+        key = tag.encode("utf-8")
+        lo, hi = 0, self._n_tags
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tag_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_tags and self._tag_bytes(lo) == key:
+            return lo
+        return -1
+
+    def _index(self, tag) -> int:
+        if not isinstance(tag, str):
+            return -1
+        return self._find(tag)
+
+    def category_name(self, category_id: int) -> str:
+        name = self._cat_names[category_id]
+        if name is None:
+            start = self._cat_blob_start
+            name = self._buffer[start + self._cat_offsets[category_id]:start + self._cat_offsets[category_id + 1]].decode("utf-8")
+            self._cat_names[category_id] = name
+        return name
+
+    def category_names(self) -> List[str]:
+        return [self.category_name(i) for i in range(self._n_cats)]
+
+    def category_id(self, category: str) -> int:
+        if self._cat_ids is None:
+            self._cat_ids = {name: i for i, name in enumerate(self.category_names())}
+        return self._cat_ids.get(category, -1)
+
+    def category_mask(self, categories) -> int:
+        """カテゴリ名のリストをビットマスク (ビット位置 = カテゴリ ID) に変換する。DB に無いカテゴリは無視する。"""
+        return self._category_mask(tuple(categories))
+
+    def _category_mask_uncached(self, categories: tuple) -> int:
+        mask = 0
+        for category in categories:
+            category_id = self.category_id(category)
+            if category_id >= 0:
+                mask |= 1 << category_id
+        return mask
+
+    def _index_mask(self, index: int) -> int:
+        mask = 0
+        for category_id in self._tag_cat_ids[self._tag_cat_offsets[index]:self._tag_cat_offsets[index + 1]]:
+            mask |= 1 << category_id
+        return mask
+
+    def tag_mask(self, tag) -> Optional[int]:
+        """タグのカテゴリのビットマスク。DB に無いタグは None。"""
+        index = self._index(tag)
+        if index < 0:
+            return None
+        return self._mask(index)
+
+    def category_tags(self, category: str):
+        """カテゴリに属するタグの位置 (JSON 上の並び順、昇順) の列。位置は tag_at() でタグ名に戻す。"""
+        category_id = self.category_id(category)
+        if category_id < 0:
+            return ()
+        return self._cat_tag_ids[self._cat_tag_offsets[category_id]:self._cat_tag_offsets[category_id + 1]]
+
+    def tags_in_categories(self, categories) -> frozenset:
+        """いずれかのカテゴリに属するタグの位置の集合。"""
+        return self._tags_in_categories(tuple(categories))
+
+    def _tags_in_categories_uncached(self, categories: tuple) -> frozenset:
+        positions = set()
+        for category in categories:
+            positions.update(self.category_tags(category))
+        return frozenset(positions)
+
+    def tag_at(self, position: int) -> str:
+        return self._tag_bytes(self._tag_order[position]).decode("utf-8")
+
+    def longest_suffix(self, tag: str) -> Optional[str]:
+        """
+        tag を "_" で区切った後ろ側の部分 (tag 自身は除く) のうち、カテゴリのある最長のタグを返す。
+        例: crazy_long_hair -> long_hair
+        """
+        if self._suffix_trie is None:
+            self._suffix_trie = _build_suffix_trie(self._iter_items())
+        return _match_suffix_trie(self._suffix_trie, tag)
+
+    def longest_match(self, tokens: List[str], start: int = 0, max_words: int = 4) -> Optional[tuple]:
+        """
+        tokens[start:] の先頭から一致する最長のタグを探して (終わりの位置, タグ名) を返す。
+        max_words は "." と ":" を除いたトークン数の上限。
+        """
+        if self._token_trie is None:
+            self._token_trie = _build_token_trie(self)
+        return _match_token_trie(self._token_trie, tokens, start, max_words)
+
+    def built_indexes(self) -> set:
+        """作成済みの索引の名前 (warm_up に渡せる)"""
+        built = set()
+        if self._cat_ids is not None:
+            built.add("category_ids")
+        if self._suffix_trie is not None:
+            built.add("suffix_trie")
+        if self._token_trie is not None:
+            built.add("token_trie")
+        if self._tag_positions is not None:
+            built.add("positions")
+        return built
+
+    def warm_up(self, indexes=None):
+        """必要になった時に作る索引を先に作っておく。indexes を省略すると全て作る。"""
+        if indexes is None:
+            indexes = {"category_ids", "suffix_trie", "token_trie", "positions"}
+        if "category_ids" in indexes:
+            self.category_id("")
+        if "suffix_trie" in indexes and self._suffix_trie is None:
+            self._suffix_trie = _build_suffix_trie(self._iter_items())
+        if "token_trie" in indexes and self._token_trie is None:
+            self._token_trie = _build_token_trie(self)
+        if "positions" in indexes and self._n_tags:
+            self.position(self.tag_at(0))
+
+    def position(self, tag) -> int:
+        """タグの JSON 上の位置。DB に無いタグは -1。"""
+        index = self._index(tag)
+        if index < 0:
+            return -1
+        if self._tag_positions is None:
+            positions = array("I", bytes(4 * self._n_tags))
+            for position, i in enumerate(self._tag_order):
+                positions[i] = position
+            self._tag_positions = positions
+        return self._tag_positions[index]
+
+    def _categories(self, index: int) -> List[str]:
+        ids = self._tag_cat_ids[self._tag_cat_offsets[index]:self._tag_cat_offsets[index + 1]]
+        return [self.category_name(i) for i in ids]
+
+    def __getitem__(self, tag) -> List[str]:
+        index = self._index(tag)
+        if index < 0:
+            raise KeyError(tag)
+        return self._categories(index)
+
+    def get(self, tag, default=None):
+        index = self._index(tag)
+        if index < 0:
+            return default
+        return self._categories(index)
+
+    def __contains__(self, tag) -> bool:
+        return self._index(tag) >= 0
+
+    def __len__(self) -> int:
+        return self._n_tags
+
+    def __iter__(self):
+        # JSON の並び順で返す
+        for index in self._tag_order:
+            yield self._tag_bytes(index).decode("utf-8")
+
+    def _iter_items(self):
+        for index in self._tag_order:
+            yield self._tag_bytes(index).decode("utf-8"), self._categories(index)
+
+    def items(self):
+        return _TagCategoryItemsView(self)
+
+
+class LayeredTagCategory(Mapping):
+    """
+    コンパイル済みの DB (base) の上に、オーバーレイのタグ -> カテゴリを重ねて見せる。
+    base はコピーせずに参照し、オーバーレイにあるタグだけ上書き (None なら削除) する。
+    位置は base のタグは base と同じ、追加されたタグは base の後ろに続く。
+    """
+
+    def __init__(self, base: TagCategoryDB, overlay: Dict[str, Optional[List[str]]], overlay_paths: tuple = ()):
+        self.base = base
+        self.overlay_paths = tuple(overlay_paths)
+        self.path = base.path
+        self._overlay = overlay
+
+        self._added: List[str] = []
+        self._positions: Dict[str, int] = {}
+        removed = 0
+        for tag, categories in overlay.items():
+            position = base.position(tag)
+            if position < 0:
+                if categories is None:
+                    continue
+                position = len(base) + len(self._added)
+                self._added.append(tag)
+            elif categories is None:
+                removed += 1
+            self._positions[tag] = position
+        self._len = len(base) - removed + len(self._added)
+
+        # base に無いカテゴリは base のカテゴリ ID の後ろに追加する
+        self._extra_categories: List[str] = []
+        extra_ids: Dict[str, int] = {}
+        for categories in overlay.values():
+            for category in categories or ():
+                if base.category_id(category) < 0 and category not in extra_ids:
+                    extra_ids[category] = base._n_cats + len(self._extra_categories)
+                    self._extra_categories.append(category)
+        self._extra_ids = extra_ids
+
+        self._suffix_trie: Optional[dict] = None
+        self._token_trie: Optional[dict] = None
+        self._category_mask = functools.lru_cache(maxsize=256)(self._category_mask_uncached)
+        self._category_tags = functools.lru_cache(maxsize=256)(self._category_tags_uncached)
+        self._tags_in_categories = functools.lru_cache(maxsize=64)(self._tags_in_categories_uncached)
+
+    def category_name(self, category_id: int) -> str:
+        if category_id < self.base._n_cats:
+            return self.base.category_name(category_id)
+        return self._extra_categories[category_id - self.base._n_cats]
+
+    def category_names(self) -> List[str]:
+        return self.base.category_names() + self._extra_categories
+
+    def category_id(self, category: str) -> int:
+        category_id = self.base.category_id(category)
+        if category_id < 0:
+            return self._extra_ids.get(category, -1)
+        return category_id
+
+    def category_mask(self, categories) -> int:
+        return self._category_mask(tuple(categories))
+
+    def _category_mask_uncached(self, categories: tuple) -> int:
+        mask = 0
+        for category in categories:
+            category_id = self.category_id(category)
+            if category_id >= 0:
+                mask |= 1 << category_id
+        return mask
+
+    def tag_mask(self, tag) -> Optional[int]:
+        if isinstance(tag, str) and tag in self._overlay:
+            categories = self._overlay[tag]
+            if categories is None:
+                return None
+            return self._category_mask(tuple(categories))
+        return self.base.tag_mask(tag)
+
+    def category_tags(self, category: str):
+        return self._category_tags(category)
+
+    def _category_tags_uncached(self, category: str) -> tuple:
+        # base の一覧からオーバーレイで上書きされたタグを除き、オーバーレイでこのカテゴリを持つタグを足す
+        overridden = set(self._positions.values())
+        positions = [position for position in self.base.category_tags(category) if position not in overridden]
+        positions.extend(self._positions[tag] for tag, categories in self._overlay.items()
+                         if categories and category in categories)
+        if not positions:
+            return ()
+        return tuple(sorted(positions))
+
+    def tags_in_categories(self, categories) -> frozenset:
+        return self._tags_in_categories(tuple(categories))
+
+    def _tags_in_categories_uncached(self, categories: tuple) -> frozenset:
+        positions = set()
+        for category in categories:
+            positions.update(self.category_tags(category))
+        return frozenset(positions)
+
+    def tag_at(self, position: int) -> str:
+        if position < len(self.base):
+            return self.base.tag_at(position)
+        return self._added[position - len(self.base)]
+
+    def longest_suffix(self, tag: str) -> Optional[str]:
+        """TagCategoryDB.longest_suffix と同じ。"""
+        if self._suffix_trie is None:
+            self._suffix_trie = _build_suffix_trie(self._iter_items())
+        return _match_suffix_trie(self._suffix_trie, tag)
+
+    def longest_match(self, tokens: List[str], start: int = 0, max_words: int = 4) -> Optional[tuple]:
+        """TagCategoryDB.longest_match と同じ。"""
+        if self._token_trie is None:
+            self._token_trie = _build_token_trie(self)
+        return _match_token_trie(self._token_trie, tokens, start, max_words)
+
+    def built_indexes(self) -> set:
+        # 木はオーバーレイを重ねた内容で作るので、base のものは使わない
+        built = self.base.built_indexes() - {"suffix_trie", "token_trie"}
+        if self._suffix_trie is not None:
+            built.add("suffix_trie")
+        if self._token_trie is not None:
+            built.add("token_trie")
+        return built
+
+    def warm_up(self, indexes=None):
+        if indexes is None:
+            indexes = {"category_ids", "suffix_trie", "token_trie", "positions"}
+        self.base.warm_up(set(indexes) - {"suffix_trie", "token_trie"})
+        if "suffix_trie" in indexes and self._suffix_trie is None:
+            self._suffix_trie = _build_suffix_trie(self._iter_items())
+        if "token_trie" in indexes and self._token_trie is None:
+            self._token_trie = _build_token_trie(self)
+
+    def __getitem__(self, tag) -> List[str]:
+        if isinstance(tag, str) and tag in self._overlay:
+            categories = self._overlay[tag]
+            if categories is None:
+                raise KeyError(tag)
+            return list(categories)
+        return self.base[tag]
+
+    def get(self, tag, default=None):
+        if isinstance(tag, str) and tag in self._overlay:
+            categories = self._overlay[tag]
+            return default if categories is None else list(categories)
+        return self.base.get(tag, default)
+
+    def __contains__(self, tag) -> bool:
+        if isinstance(tag, str) and tag in self._overlay:
+            return self._overlay[tag] is not None
+        return tag in self.base
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        for tag in self.base:
+            if tag not in self._overlay or self._overlay[tag] is not None:
+                yield tag
+        yield from self._added
+
+    def _iter_items(self):
+        for tag, categories in self.base.items():
+            if tag in self._overlay:
+                categories = self._overlay[tag]
+                if categories is None:
+                    continue
+                categories = list(categories)
+            yield tag, categories
+        for tag in self._added:
+            yield tag, list(self._overlay[tag])
+
+    def items(self):
+        return _TagCategoryItemsView(self)
+
+
+def default_db_path(json_path: str) -> str:
+    return os.path.splitext(json_path)[0] + DB_SUFFIX
+
+
+def _read_json(json_path: str) -> Dict[str, List[str]]:
+    with open(json_path, encoding="utf-8-sig") as f: # file encoding is utf-8
+        return json.load(f)
+
+
+def _create_temp(directory: str, suffix: str) -> Tuple[int, str]:
+    # mkstemp は 0600 で作るので、普通に open したファイルと同じく umask に従う権限で作る (他のユーザーも .tagdb を読めるように)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp_path = os.path.join(directory, f".tmp_{os.urandom(6).hex()}{suffix}")
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+
+def write_atomic(path: str, data: bytes, suffix: str = ".tmp"):
+    """
+    一時ファイルに書いてから置き換える (書きかけのファイルを読まれないようにする)。
+    path が既にある場合は、その権限を引き継ぐ。
+    """
+    fd, tmp_path = _create_temp(os.path.dirname(path) or ".", suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path: str, data, **kwargs):
+    """kwargs は json.dumps に渡す"""
+    kwargs.setdefault("ensure_ascii", True)
+    write_atomic(path, json.dumps(data, **kwargs).encode("utf-8"), ".json")
+
+
+def build_tag_db(json_path: str, db_path: Optional[str] = None) -> str:
+    db_path = db_path or default_db_path(json_path)
+    stat = os.stat(json_path)
+    data = compile_tag_category(_read_json(json_path), stat.st_size, stat.st_mtime_ns)
+    write_atomic(db_path, data, DB_SUFFIX)
+    return db_path
+
+
+def _open_db(db_path: str) -> TagCategoryDB:
+    with open(db_path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return TagCategoryDB(buffer, db_path)
+
+
+def _is_fresh(db_path: str, stat: os.stat_result) -> bool:
+    try:
+        with open(db_path, "rb") as f:
+            header = _HEADER.unpack(f.read(_HEADER.size))
+    except (OSError, struct.error):
+        return False
+    magic, version, byteorder, n_tags, n_cats, src_size, src_mtime_ns = header[:7]
+    return (magic == _MAGIC and version == _FORMAT_VERSION and byteorder == _BYTEORDER
+            and src_size == stat.st_size and src_mtime_ns == stat.st_mtime_ns)
+
+
+def load_tag_db(json_path: str, db_path: Optional[str] = None) -> TagCategoryDB:
+    """
+    コンパイル済みの .tagdb が JSON と一致していれば mmap で開く。
+    古い・存在しない場合はコンパイルし直して保存する（保存できなければメモリ上で使う）。
+    """
+    db_path = db_path or default_db_path(json_path)
+    stat = os.stat(json_path)
+
+    if _is_fresh(db_path, stat):
+        try:
+            return _open_db(db_path)
+        except (OSError, ValueError):
+            pass
+
+    data = compile_tag_category(_read_json(json_path), stat.st_size, stat.st_mtime_ns)
+    try:
+        write_atomic(db_path, data, DB_SUFFIX)
+        return _open_db(db_path)
+    except OSError:
+        return TagCategoryDB(data)
+
+
+def load_tag_counts(csv_paths: List[str]) -> Dict[str, int]:
+    """
+    WD tagger の CSV (name, category, count) から タグ -> count を読み込む。
+    レーティングのタグ (category 9) は除き、複数の CSV にあるタグは大きい方の count を使う。
+    """
+    counts = {}
+    for path in csv_paths:
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row["category"] == "9":
+                    continue
+                counts[row["name"]] = max(counts.get(row["name"], 0), int(row["count"] or 0))
+    return counts
+
+
+class AliasTable:
+    """
+    items から weights の重みで1つを O(1) で選ぶための表 (Walker の alias method)。
+    重みが全て 0 の場合は同じ確率で選ぶ。
+    """
+    __slots__ = ("items", "prob", "alias")
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        n = len(self.items)
+        if not n:
+            raise ValueError("AliasTable needs at least one item")
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights] if total > 0 else [1.0] * n
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # 残りは誤差で 1 からずれているだけなので、そのまま選ぶ
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def sample(self, myrand):
+        """myrand (random.Random) で1つ選ぶ。同じ状態の myrand からは同じ結果になる。"""
+        i = int(myrand.random() * len(self.items))
+        if myrand.random() < self.prob[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+
+OVERLAY_ENV = "COMFYUI_TAG_FILTER_OVERLAYS"
+
+
+def overlay_paths(overlay_dir: Optional[str] = None) -> List[str]:
+    """
+    オーバーレイファイルの一覧。overlay_dir 内の *.json (名前順) の後に、
+    環境変数 COMFYUI_TAG_FILTER_OVERLAYS (os.pathsep 区切り) のファイルを続ける。後のものが優先。
+    """
+    paths = []
+    if overlay_dir and os.path.isdir(overlay_dir):
+        paths.extend(sorted(glob.glob(os.path.join(overlay_dir, "*.json"))))
+    paths.extend(path for path in os.environ.get(OVERLAY_ENV, "").split(os.pathsep) if path)
+    return paths
+
+
+def _check_categories(path: str, tag: str, categories) -> List[str]:
+    if not isinstance(categories, list) or not all(isinstance(c, str) for c in categories):
+        raise ValueError(f"{path}: categories of '{tag}' must be a list of strings")
+    return categories
+
+
+def load_overlays(base: Mapping, paths: List[str]) -> Dict[str, Optional[List[str]]]:
+    """
+    オーバーレイファイルを順番に重ねて、タグ -> カテゴリ (削除は None) にまとめる。
+    ファイルの中身はタグ -> 次のどれか:
+        ["hair", "hair_style"]               カテゴリを置き換える (無いタグは追加)
+        {"add": [...], "remove": [...]}      カテゴリを追加・削除する
+        null                                 タグを削除する
+    読み込めないファイル・形の違うファイルは、エラーを表示して飛ばす。
+    """
+    overlay: Dict[str, Optional[List[str]]] = {}
+    for path in paths:
+        try:
+            overlay.update(_load_overlay(base, overlay, path))
+        except (OSError, ValueError) as e:
+            # 壊れたオーバーレイは読み込まずに、残りのオーバーレイを重ねる
+            print(f"[comfyui_tag_filter] skipped overlay {path}: {e}", file=sys.stderr)
+    return overlay
+
+
+def _load_overlay(base: Mapping, overlay: Dict[str, Optional[List[str]]], path: str) -> Dict[str, Optional[List[str]]]:
+    # 途中で失敗しても overlay が変わらないように、このファイルの分は別の dict にまとめる
+    data = _read_json(path)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: overlay must be a JSON object")
+    changes: Dict[str, Optional[List[str]]] = {}
+    for tag, value in data.items():
+        if value is None or isinstance(value, list):
+            changes[tag] = None if value is None else list(_check_categories(path, tag, value))
+            continue
+        if not isinstance(value, dict) or not set(value) <= {"add", "remove"}:
+            raise ValueError(f"{path}: invalid overlay entry for '{tag}'")
+        current = overlay[tag] if tag in overlay else base.get(tag)
+        categories = list(current or [])
+        for category in _check_categories(path, tag, value.get("add", [])):
+            if category not in categories:
+                categories.append(category)
+        remove = set(_check_categories(path, tag, value.get("remove", [])))
+        changes[tag] = [category for category in categories if category not in remove]
+    return changes
+
+
+def load_tag_category(json_path: str, overlays: Optional[List[str]] = None):
+    """load_tag_db に、オーバーレイがあれば LayeredTagCategory を重ねて返す。"""
+    base = load_tag_db(json_path)
+    if not overlays:
+        return base
+    return LayeredTagCategory(base, load_overlays(base, overlays), overlays)
+
+
+RELOAD_INTERVAL_ENV = "COMFYUI_TAG_FILTER_RELOAD_INTERVAL"
+
+
+def _file_signature(paths: List[str]) -> tuple:
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+class TagCategoryStore:
+    """
+    JSON とオーバーレイを監視して、変更されたら読み込み直す。
+    変更の確認は check_interval 秒に1回 (0 以下なら確認しない)。読み込みと索引の作成は
+    別スレッドで行い、終わったら get() が返すスナップショットを丸ごと差し替える。
+    get() で受け取ったスナップショットは差し替え後も変わらないので、実行中のノードの結果は一貫する。
+    json_path が無い間は fallback_path を読む (json_path ができたら読み込み直す)。
+    """
+
+    def __init__(self, json_path: str, overlay_dir: Optional[str] = None, check_interval: Optional[float] = None,
+                 fallback_path: Optional[str] = None):
+        if check_interval is None:
+            check_interval = float(os.environ.get(RELOAD_INTERVAL_ENV, "2"))
+        self.json_path = json_path
+        self.fallback_path = fallback_path
+        self.overlay_dir = overlay_dir
+        self.check_interval = check_interval
+        self.error: Optional[BaseException] = None
+        self._snapshot = None
+        self._signature: Optional[tuple] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sources(self) -> tuple:
+        json_path = self.json_path
+        if self.fallback_path and not os.path.exists(json_path):
+            json_path = self.fallback_path
+        overlays = overlay_paths(self.overlay_dir)
+        return json_path, overlays, _file_signature([json_path] + overlays)
+
+    def _load(self, json_path: str, overlays: List[str], signature: tuple, previous=None):
+        try:
+            snapshot = load_tag_category(json_path, overlays)
+            if previous is not None:
+                # 前のスナップショットで使われていた索引は、差し替える前に作っておく
+                snapshot.warm_up(previous.built_indexes())
+        except Exception as e:
+            # 壊れた JSON などは、今のスナップショットを使い続ける (ファイルが変わったらまた読み込む)。
+            # 最初の読み込みで失敗した場合は、次の get() でもう一度読み込む
+            self.error = e
+            print(f"[comfyui_tag_filter] failed to reload {json_path}: {e!r}", file=sys.stderr)
+            if previous is None:
+                raise
+            self._signature = signature
+        else:
+            self.error = None
+            self._snapshot = snapshot
+            self._signature = signature
+
+    def get(self):
+        """今のスナップショット (TagCategoryDB か LayeredTagCategory) を返す"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._checked = time.monotonic()
+                    self._load(*self._sources())
+                return self._snapshot
+
+        if self.check_interval > 0 and time.monotonic() - self._checked >= self.check_interval:
+            self.check()
+        return snapshot
+
+    def check(self, wait: bool = False) -> bool:
+        """ファイルが変更されていれば読み込み直す。読み込みを始めたら True。"""
+        with self._lock:
+            self._checked = time.monotonic()
+            if self._thread is not None and self._thread.is_alive():
+                thread = self._thread
+                started = False
+            else:
+                json_path, overlays, signature = self._sources()
+                if signature == self._signature:
+                    return False
+                thread = threading.Thread(target=self._load, args=(json_path, overlays, signature, self._snapshot),
+                                          name="tag-category-reload", daemon=True)
+                self._thread = thread
+                thread.start()
+                started = True
+        if wait:
+            thread.join()
+        return started
+
+
+ALIASES_ENV = "COMFYUI_TAG_FILTER_ALIASES"
+
+
+def load_tag_aliases(path: str) -> Dict[str, str]:
+    """tag_alias.py で作ったエイリアス表 (別名 -> 正規のタグ名 の JSON) を読み込む"""
+    with open(path, encoding="utf-8-sig") as f:
+        aliases = json.load(f)
+    if not isinstance(aliases, dict) or not all(isinstance(v, str) for v in aliases.values()):
+        raise ValueError(f"{path}: expected an object of alias -> tag")
+    return aliases
+
+
+class TagAliasStore:
+    """
+    エイリアス表のファイル。ファイルが無ければ空の表。
+    check_interval 秒に1回変更を確認して、変わっていたら読み込み直す (小さいファイルなのでその場で読む)。
+    """
+
+    def __init__(self, path: str, check_interval: Optional[float] = None):
+        if check_interval is None:
+            check_interval = float(os.environ.get(RELOAD_INTERVAL_ENV, "2"))
+        self.path = path
+        self.check_interval = check_interval
+        self.error: Optional[BaseException] = None
+        self._aliases: Dict[str, str] = {}
+        self._signature: Optional[tuple] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Dict[str, str]:
+        if self._signature is not None and (self.check_interval <= 0 or time.monotonic() - self._checked < self.check_interval):
+            return self._aliases
+        with self._lock:
+            self._checked = time.monotonic()
+            signature = _file_signature([self.path])
+            if signature != self._signature:
+                self._signature = signature
+                try:
+                    self._aliases = load_tag_aliases(self.path) if signature[0][1] is not None else {}
+                    self.error = None
+                except (OSError, ValueError) as e:
+                    self.error = e
+                    print(f"[comfyui_tag_filter] failed to load {self.path}: {e}", file=sys.stderr)
+        return self._aliases
+
+
+if __name__ == "__main__":
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    targets = sys.argv[1:] or sorted(glob.glob(os.path.join(code_dir, "tag_category*.json")))
+    for json_path in targets:
+        db_path = build_tag_db(json_path)
+        print(f"{json_path} -> {db_path} ({os.path.getsize(db_path)} bytes)")
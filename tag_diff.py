@@ -1,40 +1,180 @@
-import json
+"""
+Danbooru のタグ一覧 (utils/download_tags.py で取得したもの) と tag_category_v3.json を比べて、
+まだ DB に無いタグを new_danbooru_tags.json に書き出す。
+
+    python tag_diff.py
+    python tag_diff.py utils/danbooru_all_tags.ndjson --min-post-count 500 --category 1 4
+
+一覧は1件ずつ読み込むので、数百 MB のファイルでもメモリをほとんど使わない
+(NDJSON と、以前の形式の JSON の配列のどちらでも読める)。
+DB にあるタグの post_count と category は danbooru_tag_stats.json に保存しておき、
+前回から変わったもの (post_count は --post-count-change の割合以上) を追加したタグと一緒に
+tag_diff.ndjson に1行ずつ書き出す。
+"""
+
 import os
+import sys
+import json
 import shutil
+import argparse
+from typing import Iterator, TextIO
+
+try:
+    from .tag_db import load_tag_db, write_json_atomic
+except ImportError:
+    from tag_db import load_tag_db, write_json_atomic
+
+
+DUMP_SUFFIXES = ["", "_0", "_3", "_4", "_5"]
+
+# 1つの要素の大きさの上限。壊れたファイルで、読める値を待ってバッファが大きくなり続けないようにする
+MAX_VALUE_SIZE = 16 << 20
+
+
+def _iter_json_array(f: TextIO, chunk_size: int, max_value_size: int = MAX_VALUE_SIZE) -> Iterator:
+    """JSON の配列の要素を、ファイル全体を読み込まずに1つずつ返す (max_value_size 文字を超える要素は ValueError)"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and not started:
+            if buf[pos] != "[":
+                raise ValueError("expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            # 読み込んだ範囲の最後で終わっている値 (数値など) は続きがあるかもしれない
+            if end is not None and (end < len(buf) or eof):
+                yield value
+                pos = end
+                continue
+        if eof:
+            raise ValueError("unexpected end of JSON array")
+        if len(buf) - pos > max_value_size:
+            raise ValueError(f"JSON array element larger than {max_value_size} characters (or malformed JSON)")
+        more = f.read(chunk_size)
+        eof = not more
+        buf = buf[pos:] + more
+        pos = 0
+
+
+def iter_dump(path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """タグ一覧のファイル (NDJSON か JSON の配列) のタグを1件ずつ返す"""
+    with open(path, encoding="utf-8") as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            yield from _iter_json_array(f, chunk_size)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def default_dumps(dump_dir: str) -> list:
+    paths = []
+    for suffix in DUMP_SUFFIXES:
+        path = os.path.join(dump_dir, f"danbooru_all_tags{suffix}.ndjson")
+        if not os.path.exists(path) and os.path.exists(path[:-len(".ndjson")] + ".json"):
+            path = path[:-len(".ndjson")] + ".json"
+        paths.append(path)
+    return paths
+
+
+def _changes(name: str, old: list, new: list, post_count_change: float) -> dict:
+    old_count, old_category = old
+    new_count, new_category = new
+    change = {}
+    if abs(new_count - old_count) > max(old_count, 1) * post_count_change:
+        change["post_count"] = [old_count, new_count]
+    if new_category != old_category:
+        change["category"] = [old_category, new_category]
+    return {"type": "changed", "name": name, **change} if change else None
 
-# 最終的な結果を保存しているデータ
-print("tag_category_v2.jsonを読み込み中...")
-if not os.path.exists("tag_category_v3.json"):
-    shutil.copyfile("tag_category_v2.json", "tag_category_v3.json")
-with open("tag_category_v3.json", "r", encoding="utf-8") as f:
-    tag_category_v3 = json.load(f)
 
-# 最新のタグデータ
-print("danbooru_all_tags_*.jsonを読み込み中...")
-danbooru_tags = set()
-for cate in ['', '_0', '_3', '_4', '_5']:
-    print(f"danbooru_all_tags{cate}.jsonを読み込み中...")
-    with open(f"utils/danbooru_all_tags{cate}.json", "r", encoding="utf-8") as f:
-        danbooru_all_tags_cate = json.load(f)
-        for tag in danbooru_all_tags_cate:
+def diff(dump_paths: list, db, output, diff_output, previous_stats: dict, min_post_count: int = 200,
+         categories=(1,), post_count_change: float = 0.2) -> dict:
+    """
+    db に無く、条件に合うタグの名前を output に JSON の配列で書き出し、
+    追加・変更の記録を diff_output に NDJSON で書き出す。db にあるタグの [post_count, category] を返す。
+    """
+    categories = set(categories)
+    added = set()
+    stats = {}
+    output.write("[")
+    for path in dump_paths:
+        print(f"{path} を読み込み中...")
+        for tag in iter_dump(path):
+            name = tag["name"]
+            if name in db:
+                stats[name] = [tag["post_count"], tag["category"]]
+                continue
+            if (name in added
+                    or tag["post_count"] <= min_post_count
+                    or tag["is_deprecated"]
+                    or tag["category"] not in categories):
+                continue
+            output.write(("\n  " if not added else ",\n  ") + json.dumps(name, ensure_ascii=True))
+            diff_output.write(json.dumps({"type": "added", "name": name, "post_count": tag["post_count"],
+                                          "category": tag["category"]}, ensure_ascii=True) + "\n")
+            added.add(name)
+    output.write("\n]\n" if added else "]\n")
 
-            if (tag["post_count"] > 200 
-                and not tag["is_deprecated"] 
-                and tag["name"] not in tag_category_v3 
-                and tag["category"] == 1):
+    changed = 0
+    for name, new in stats.items():
+        old = previous_stats.get(name)
+        change = old and _changes(name, old, new, post_count_change)
+        if change:
+            diff_output.write(json.dumps(change, ensure_ascii=True) + "\n")
+            changed += 1
+    print(f"追加されたタグの数: {len(added)}")
+    print(f"post_count か category が変わったタグの数: {changed}")
+    return stats
 
-                danbooru_tags.add(tag["name"])
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find Danbooru tags missing from the tag category DB")
+    parser.add_argument("dumps", nargs="*", help="tag list files (default: utils/danbooru_all_tags*.ndjson)")
+    parser.add_argument("--db", default="tag_category_v3.json")
+    parser.add_argument("--output", default="new_danbooru_tags.json")
+    parser.add_argument("--diff", default="tag_diff.ndjson", help="added / changed tags (NDJSON)")
+    parser.add_argument("--stats", default="danbooru_tag_stats.json", help="post_count and category of DB tags from the last run")
+    parser.add_argument("--min-post-count", type=int, default=200)
+    parser.add_argument("--category", type=int, nargs="+", default=[1])
+    parser.add_argument("--post-count-change", type=float, default=0.2, help="report post_count changes larger than this ratio")
+    args = parser.parse_args(argv)
 
-danbooru_tags = list(danbooru_tags)
+    # 最終的な結果を保存しているデータ
+    if not os.path.exists(args.db):
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(args.db)), "tag_category_v2.json"), args.db)
+    db = load_tag_db(args.db)
 
-# 追加が何件あるか表示
-print(f"追加されたタグの数: {len(danbooru_tags)}")
+    previous_stats = {}
+    if os.path.exists(args.stats):
+        with open(args.stats, encoding="utf-8") as f:
+            previous_stats = json.load(f)
 
-# 追加されたタグを10件表示
-print(f"追加されたタグ: {danbooru_tags[0:10]}")
+    dump_paths = args.dumps or default_dumps(os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+    with open(args.output, "w", encoding="utf-8") as output, open(args.diff, "w", encoding="utf-8") as diff_output:
+        stats = diff(dump_paths, db, output, diff_output, previous_stats, args.min_post_count,
+                     args.category, args.post_count_change)
+    # 前回の値は、今回の一覧に無かったタグの分も残す
+    write_json_atomic(args.stats, {**previous_stats, **stats})
+    return 0
 
-# save danbooru_tags
-with open("new_danbooru_tags.json", "w", encoding="utf-8") as f:
-    json.dump(danbooru_tags, f, indent=2, ensure_ascii=True)
 
+if __name__ == "__main__":
+    sys.exit(main())
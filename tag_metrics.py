@@ -0,0 +1,334 @@
+"""
+ノードの呼び出し回数と処理時間を記録する計測モジュール (初期状態では無効)。
+
+    COMFYUI_TAG_FILTER_METRICS=1                           # 有効にする
+    COMFYUI_TAG_FILTER_METRICS_FILE=/tmp/tag_filter.prom  # .prom なら Prometheus 形式、それ以外は JSON で定期的に書き出す
+
+ノードごとに、呼び出し回数・エラー数・処理時間のヒストグラムと、その中で parse_tags、
+カテゴリの検索、tagdata_to_string にかかった時間、入力・出力のタグ数を記録する。
+入力のタグ数は、ノードに渡された文字列を parse した分だけを (1回の呼び出しで同じ入力は1回) 数える。
+ノードの中から呼ばれたノード (バッチ版が1件ずつ呼ぶ元のノードなど) は、外側のノードの分として記録する。
+無効の場合は何も差し替えないので、処理時間は変わらない。
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import bisect
+import functools
+import threading
+from typing import Dict, List, Optional
+
+try:
+    from .tag_db import write_atomic
+except ImportError:
+    from tag_db import write_atomic
+
+
+METRICS_ENV = "COMFYUI_TAG_FILTER_METRICS"
+METRICS_FILE_ENV = "COMFYUI_TAG_FILTER_METRICS_FILE"
+METRICS_INTERVAL_ENV = "COMFYUI_TAG_FILTER_METRICS_INTERVAL"
+
+# ヒストグラムの区切り (秒)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ノードの外 (tag_captions.py などから直接呼んだ場合) の記録先
+NO_NODE = "(none)"
+
+# カテゴリの検索として計測する DB のメソッド
+LOOKUP_METHODS = (
+    "__getitem__", "get", "__contains__", "tag_mask", "category_mask", "category_tags",
+    "tags_in_categories", "longest_suffix", "longest_match",
+)
+
+STAGES = ("parse_tags", "lookup", "tagdata_to_string")
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        # Prometheus と同じく、各区切り以下の累積数
+        cumulative = {}
+        total = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            cumulative["+Inf" if bound == float("inf") else str(bound)] = total
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class NodeMetrics:
+    __slots__ = ("calls", "errors", "latency", "stages", "input_tags", "output_tags")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.input_tags = 0
+        self.output_tags = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency": self.latency.to_dict(),
+            "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            "input_tags": self.input_tags,
+            "output_tags": self.output_tags,
+        }
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_metrics: Dict[str, NodeMetrics] = {}
+_patches: List[tuple] = []
+_output_path: Optional[str] = None
+_dump_interval = 10.0
+_last_dump = 0.0
+
+
+def enabled() -> bool:
+    return bool(_patches)
+
+
+def _node_metrics(name: str) -> NodeMetrics:
+    metrics = _metrics.get(name)
+    if metrics is None:
+        with _lock:
+            metrics = _metrics.setdefault(name, NodeMetrics())
+    return metrics
+
+
+def _current_node() -> str:
+    stack = getattr(_local, "nodes", None)
+    return stack[-1][0] if stack else NO_NODE
+
+
+def _take_input(value) -> bool:
+    """value が今のノードの入力で、まだ数えていなければ True"""
+    stack = getattr(_local, "nodes", None)
+    if not stack or not isinstance(value, str):
+        return False
+    inputs = stack[-1][1]
+    if value in inputs:
+        inputs.discard(value)
+        return True
+    return False
+
+
+def _wrap_node(name: str, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, "nodes", None)
+        if stack is None:
+            stack = _local.nodes = []
+        # 入力の文字列を覚えておき、それを parse した時だけ入力のタグ数に数える
+        inputs = {value for value in (*args, *kwargs.values()) if isinstance(value, str)}
+        if stack:
+            # 外側のノードの一部として数える (呼び出し回数や処理時間は記録しない)
+            stack[-1][1].update(inputs)
+            return function(*args, **kwargs)
+        stack.append((name, inputs))
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            metrics = _node_metrics(name)
+            with _lock:
+                metrics.calls += 1
+                metrics.errors += failed
+                metrics.latency.observe(elapsed)
+            _maybe_dump()
+    return wrapper
+
+
+def _wrap_stage(stage: str, function, count_tags=None):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # DB の中で別の検索を呼ぶ場合 (LayeredTagCategory -> base など) は外側だけを数える
+        depth = getattr(_local, "depth", 0)
+        if depth:
+            return function(*args, **kwargs)
+        _local.depth = 1
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            _local.depth = 0
+        elapsed = time.perf_counter() - start
+        metrics = _node_metrics(_current_node())
+        with _lock:
+            metrics.stages[stage].observe(elapsed)
+            if count_tags is not None:
+                count_tags(metrics, args, result)
+        return result
+    return wrapper
+
+
+def _count_input(metrics: NodeMetrics, args, result):
+    # ノードの中で作った文字列 (出力の parse し直しなど) は数えない
+    if args and _take_input(args[0]):
+        metrics.input_tags += len(result)
+
+
+def _count_output(metrics: NodeMetrics, args, result):
+    metrics.output_tags += len(args[0]) if args else 0
+
+
+def _patch(owner, name: str, value):
+    _patches.append((owner, name, owner.__dict__[name]))
+    setattr(owner, name, value)
+
+
+def enable(nodes_module, db_classes=(), output_path: Optional[str] = None, dump_interval: Optional[float] = None):
+    """
+    nodes_module のノードと parse_tags / tagdata_to_string、db_classes の検索メソッドを計測用に差し替える。
+    output_path を指定すると dump_interval 秒ごとと終了時に書き出す。
+    """
+    global _output_path, _dump_interval
+    # 同時に呼ばれても二重に差し替えないように、差し替えもロックの中で行う
+    with _lock:
+        if _patches:
+            return
+        _patch(nodes_module, "parse_tags", _wrap_stage("parse_tags", nodes_module.parse_tags, _count_input))
+        # tag_format_set はキャッシュしているので、中の parse_tags ではなくこちらで入力を数える
+        if hasattr(nodes_module, "tag_format_set"):
+            _patch(nodes_module, "tag_format_set",
+                   _wrap_stage("parse_tags", nodes_module.tag_format_set, _count_input))
+        _patch(nodes_module, "tagdata_to_string", _wrap_stage("tagdata_to_string", nodes_module.tagdata_to_string, _count_output))
+        for db_class in db_classes:
+            for method in LOOKUP_METHODS:
+                if method in db_class.__dict__:
+                    _patch(db_class, method, _wrap_stage("lookup", db_class.__dict__[method]))
+        for name, node_class in nodes_module.NODE_CLASS_MAPPINGS.items():
+            function_name = node_class.FUNCTION
+            if function_name in node_class.__dict__:
+                _patch(node_class, function_name, _wrap_node(name, node_class.__dict__[function_name]))
+
+        _output_path = output_path
+        if dump_interval is not None:
+            _dump_interval = dump_interval
+        if output_path:
+            atexit.register(dump)
+
+
+def disable():
+    """差し替えたものを元に戻す (記録した値は残る)"""
+    global _output_path
+    with _lock:
+        while _patches:
+            owner, name, value = _patches.pop()
+            setattr(owner, name, value)
+        if _output_path:
+            atexit.unregister(dump)
+        _output_path = None
+
+
+def enable_from_env(nodes_module, db_classes=()):
+    if os.environ.get(METRICS_ENV, "").lower() not in ("1", "true", "yes", "on"):
+        return
+    enable(nodes_module, db_classes, os.environ.get(METRICS_FILE_ENV) or None,
+           float(os.environ.get(METRICS_INTERVAL_ENV, "10")))
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def snapshot() -> dict:
+    """ノード名 -> 記録した値 の dict"""
+    with _lock:
+        return {name: metrics.to_dict() for name, metrics in sorted(_metrics.items())}
+
+
+def to_json() -> str:
+    return json.dumps({"nodes": snapshot()}, indent=2)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(metric: str, labels: str, histogram: dict) -> List[str]:
+    lines = []
+    for bound, count in histogram["buckets"].items():
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+    lines.append(f"{metric}_sum{{{labels}}} {histogram['sum']!r}")
+    lines.append(f"{metric}_count{{{labels}}} {histogram['count']}")
+    return lines
+
+
+def to_prometheus() -> str:
+    """Prometheus のテキスト形式 (node_exporter の textfile collector で読める)"""
+    nodes = snapshot()
+    lines = [
+        "# HELP tag_filter_node_calls_total Number of node executions.",
+        "# TYPE tag_filter_node_calls_total counter",
+    ]
+    lines += [f'tag_filter_node_calls_total{{node="{_label(n)}"}} {m["calls"]}' for n, m in nodes.items()]
+    lines += [
+        "# HELP tag_filter_node_errors_total Number of node executions that raised.",
+        "# TYPE tag_filter_node_errors_total counter",
+    ]
+    lines += [f'tag_filter_node_errors_total{{node="{_label(n)}"}} {m["errors"]}' for n, m in nodes.items()]
+    lines += [
+        "# HELP tag_filter_node_seconds Node execution time.",
+        "# TYPE tag_filter_node_seconds histogram",
+    ]
+    for name, metrics in nodes.items():
+        lines += _histogram_lines("tag_filter_node_seconds", f'node="{_label(name)}"', metrics["latency"])
+    lines += [
+        "# HELP tag_filter_stage_seconds Time spent in parse_tags, category lookups and tagdata_to_string.",
+        "# TYPE tag_filter_stage_seconds histogram",
+    ]
+    for name, metrics in nodes.items():
+        for stage, histogram in metrics["stages"].items():
+            if histogram["count"]:
+                lines += _histogram_lines("tag_filter_stage_seconds", f'node="{_label(name)}",stage="{stage}"', histogram)
+    for key, help_text in (("input_tags", "Tags parsed from node inputs."), ("output_tags", "Tags written to node outputs.")):
+        lines += [f"# HELP tag_filter_{key}_total {help_text}", f"# TYPE tag_filter_{key}_total counter"]
+        lines += [f'tag_filter_{key}_total{{node="{_label(n)}"}} {m[key]}' for n, m in nodes.items()]
+    return "\n".join(lines) + "\n"
+
+
+def dump(path: Optional[str] = None) -> Optional[str]:
+    """path (省略時は COMFYUI_TAG_FILTER_METRICS_FILE) に書き出す。拡張子が .prom なら Prometheus 形式。"""
+    path = path or _output_path
+    if not path:
+        return None
+    text = to_prometheus() if path.endswith(".prom") else to_json()
+    write_atomic(path, text.encode("utf-8"), ".prom" if path.endswith(".prom") else ".json")
+    return path
+
+
+def _maybe_dump():
+    global _last_dump
+    if not _output_path:
+        return
+    now = time.monotonic()
+    if now - _last_dump < _dump_interval:
+        return
+    _last_dump = now
+    try:
+        dump()
+    except OSError as e:
+        print(f"[comfyui_tag_filter] failed to write metrics to {_output_path}: {e}", file=sys.stderr)
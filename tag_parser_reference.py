@@ -0,0 +1,172 @@
+"""
+高速化する前の parse_tags / TagData / エスケープ処理をそのまま残したもの。
+nodes.py の実装と結果が一致するかの確認（テスト・ベンチマーク）に使う。
+"""
+
+import decimal
+
+
+class TagData:
+    def __init__(self, tag:str, weight:float):
+        self.tag:str = tag
+        self.weight:decimal.Decimal = decimal.Decimal(str(round(weight, 3)))
+        self.format:str = tag.lower().strip().replace(' ', '_')
+        self.format_escape:str = escape_tag_special_chars(self.format)
+        self.format_unescape:str = remove_escape(unescape_tag_special_chars(self.format_escape))
+    
+    def __str__(self):
+        return self.format
+    
+    def __repr__(self):
+        return self.format
+
+    def __eq__(self, other):
+        if isinstance(other, TagData):
+            return self.format == other.format
+        return False
+
+    def __hash__(self):
+        return hash(self.format)
+    
+    def text(self, format=False, underscore=False):
+        tag_text = self.tag
+        if format:
+            tag_text = self.format
+        if underscore:
+            tag_text = tag_text.replace(' ', '_')
+
+        tag_text = unescape_tag_special_chars(tag_text)
+        
+        if self.weight != decimal.Decimal("1.0"):
+            return f"({tag_text}:{self.weight})"
+        return tag_text
+
+
+def parse_tags(tag_string:str) -> list[TagData]:
+    if tag_string is None:
+        return []
+    if not tag_string:
+        return []
+    tag_string = tag_string.strip()
+    if not tag_string:
+        return []
+    
+    tag_string = escape_tag_special_chars(tag_string)
+    #print(tag_string)
+
+    def clean_tag(tag):
+        # Remove any leading/trailing whitespace and parentheses
+        tag = tag.strip()
+        while tag.startswith(('(', ')')) or tag.endswith(('(', ')')):
+            tag = tag.strip('()')
+        return tag.strip()
+
+    def get_weight_and_tags(group):
+        group = clean_tag(group)
+        if ':' in group:
+            tags_part, weight_part = group.split(':', 1)
+            try:
+                weight = float(weight_part)
+            except ValueError:
+                weight = 1.0
+                tags_part = group
+            tags = [t.strip() for t in tags_part.split(',')]
+        else:
+            tags = [t.strip() for t in group.split(',')]
+            weight = 1.0
+        return tags, weight
+
+    result = []
+    paren_count = 0
+    
+    # First pass: split into proper groups
+    groups = []
+    current = ''
+    for char in tag_string:
+        if char == '(':
+            paren_count += 1
+        elif char == ')':
+            paren_count -= 1
+        
+        current += char
+        
+        if paren_count == 0 and char == ',':
+            if current.strip(',').strip():
+                groups.append(current.strip(',').strip())
+            current = ''
+    if current.strip(',').strip():
+        groups.append(current.strip(',').strip())
+
+    # Second pass: process each group
+    for group in groups:
+        group = group.strip()
+        if not group:
+            continue
+
+        # Count the number of opening parentheses at the start
+        opening_count = 0
+        for char in group:
+            if char == '(':
+                opening_count += 1
+            else:
+                break
+
+        # Count the number of closing parentheses at the end
+        closing_count = 0
+        for char in reversed(group):
+            if char == ')':
+                closing_count += 1
+            else:
+                break
+
+        # Get the actual parentheses pairs count (use the minimum to ensure matching pairs)
+        paren_pairs = min(opening_count, closing_count)
+
+        tags, custom_weight = get_weight_and_tags(group)
+        
+        # Set weight based on parentheses pairs
+        if custom_weight != 1.0:
+            weight = custom_weight
+        else:
+            if paren_pairs == 0:
+                weight = 1.0
+            else:
+                weight = 1.0 + (paren_pairs * 0.1)
+
+        # Add each tag with its weight
+        for tag in tags:
+            tag = clean_tag(tag)
+            if tag:
+                result.append(TagData(tag, weight))
+    
+    return result
+
+
+def tagdata_to_string(tags:list[TagData], underscore=False) -> str:
+    return ", ".join([tag.text(underscore=underscore) for tag in tags])
+
+
+# エスケープ対象とトークンの対応表
+ESCAPE_MAP = {
+    '\\(':  '__escape_kakko_start__',
+    '\\)':  '__escape_kakko_end__',
+    '\\:':  '__escape_colon__',
+    '\\,':  '__escape_comma__',
+    '\\\\': '__escape_backslash__',  # 最後に展開。二重エスケープ用
+}
+
+UNESCAPE_MAP = {v: k for k, v in ESCAPE_MAP.items()}
+
+def escape_tag_special_chars(s: str) -> str:
+    # バックスラッシュは一番最後に処理するため、順番を工夫
+    for orig, repl in sorted(ESCAPE_MAP.items(), key=lambda x: -len(x[0])):
+        s = s.replace(orig, repl)
+    return s
+
+def unescape_tag_special_chars(s: str) -> str:
+    for repl, orig in UNESCAPE_MAP.items():
+        s = s.replace(repl, orig)
+    return s
+
+def remove_escape(s: str) -> str:
+    return s.replace('\\\\', '\\').replace('\\(', '(').replace('\\)', ')').replace('\\:', ':').replace('\\,', ',')
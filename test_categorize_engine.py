@@ -0,0 +1,134 @@
+# python -m unittest test_categorize_engine.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from utils.categorize_engine import (
+    BackendError, ChatCompletionsBackend, CategorizeEngine, FunctionBackend, StubBackend, parse_json_object, serve_stub,
+)
+
+
+CATEGORIES = {"long_hair": ["hair", "hair_style"], "red_eyes": ["eyes", "color"], "smile": ["expression"]}
+
+
+class TestCategorizeEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tags = [f"tag{i}_{word}" for i, word in enumerate(["hair", "eyes", "smile", "dress"] * 25)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def engine(self, backend, **kwargs):
+        options = {"backoff": 0.0, "log": lambda message: None}
+        options.update(kwargs)
+        return CategorizeEngine(backend, **options)
+
+    def test_run(self):
+        backend = StubBackend(CATEGORIES)
+        received = {}
+        engine = self.engine(backend, batch_size=10, on_result=received.update)
+        results, failed = engine.run(self.tags + ["long_hair", "tag0_hair"])
+        self.assertEqual([], failed)
+        self.assertEqual(len(self.tags) + 1, len(results))
+        self.assertEqual(["hair", "hair_style"], results["tag0_hair"])
+        self.assertEqual(["expression"], results["tag2_smile"])
+        self.assertEqual(["other"], results["tag3_dress"])
+        self.assertEqual(results, received)
+        # 速く答えが返ってくる間はバッチを大きくしていく
+        self.assertGreater(engine.batch_size, 10)
+
+    def test_adaptive_batch(self):
+        # 大きすぎるバッチは失敗するので、小さくして送り直す
+        backend = StubBackend(CATEGORIES, max_tags=8)
+        engine = self.engine(backend, batch_size=30, max_attempts=10)
+        results, failed = engine.run(self.tags)
+        self.assertEqual([], failed)
+        self.assertEqual(len(self.tags), len(results))
+        self.assertGreater(engine.stats["errors"], 0)
+        self.assertLess(engine.stats["errors"], engine.stats["requests"] / 2)
+        self.assertLess(engine.batch_size, 30)
+
+    def test_failed_and_missing(self):
+        def complete(system, user):
+            tags = json.loads(user)
+            if "bad_tag" in tags:
+                raise BackendError("bad")
+            # 頼んでいないタグが混ざっていても使わず、答えの無いタグは送り直す
+            answer = {tag: ["x"] for tag in tags if tag != "lost_tag"}
+            answer["unrequested"] = ["y"]
+            return json.dumps(answer)
+
+        engine = self.engine(FunctionBackend(complete, "test"), batch_size=4, max_attempts=3)
+        results, failed = engine.run(["a", "bad_tag", "b", "lost_tag", "c"])
+        self.assertEqual({"a": ["x"], "b": ["x"], "c": ["x"]}, results)
+        self.assertEqual({"bad_tag", "lost_tag"}, set(failed))
+
+    def test_bad_tag_in_large_batch(self):
+        # 1つの失敗するタグのせいで、同じバッチのタグが失敗にならない
+        def complete(system, user):
+            tags = json.loads(user)
+            if "poison" in tags:
+                raise BackendError("bad")
+            return json.dumps({tag: ["x"] for tag in tags})
+
+        tags = ["poison"] + [f"t{i}" for i in range(59)]
+        engine = self.engine(FunctionBackend(complete, "test"), batch_size=60, concurrency=4, max_attempts=3)
+        results, failed = engine.run(tags)
+        self.assertEqual(["poison"], failed)
+        self.assertEqual(set(tags[1:]), set(results))
+
+    def test_unexpected_error(self):
+        # バックエンドの想定外の例外でも、全体は止まらない
+        def complete(system, user):
+            tags = json.loads(user)
+            if "crash" in tags:
+                raise KeyError("crash")
+            return json.dumps({tag: ["x"] for tag in tags})
+
+        engine = self.engine(FunctionBackend(complete, "test"), batch_size=5, max_attempts=2)
+        results, failed = engine.run(["a", "b", "crash", "c", "d", "e"])
+        self.assertEqual(["crash"], failed)
+        self.assertEqual({"a", "b", "c", "d", "e"}, set(results))
+
+    def test_cache(self):
+        backend = StubBackend(CATEGORIES)
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        first, _ = self.engine(backend, cache_dir=cache_dir, batch_size=10, max_batch_size=10).run(self.tags)
+        calls = backend.calls
+        engine = self.engine(backend, cache_dir=cache_dir, batch_size=10, max_batch_size=10)
+        second, _ = engine.run(self.tags)
+        self.assertEqual(first, second)
+        self.assertEqual(calls, backend.calls)
+        self.assertEqual(10, engine.stats["cache_hits"])
+
+        # 別のバックエンドの応答は使わない
+        other = FunctionBackend(lambda system, user: json.dumps({tag: ["z"] for tag in json.loads(user)}), "other")
+        third, _ = self.engine(other, cache_dir=cache_dir, batch_size=10, max_batch_size=10).run(self.tags)
+        self.assertEqual(["z"], third["tag0_hair"])
+
+    def test_stub_server(self):
+        stub = StubBackend(CATEGORIES, error_rate=0.3, seed=1)
+        server = serve_stub(stub)
+        try:
+            backend = ChatCompletionsBackend("stub", base_url=f"http://127.0.0.1:{server.server_address[1]}")
+            engine = self.engine(backend, batch_size=7, max_attempts=10)
+            results, failed = engine.run(self.tags)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([], failed)
+        self.assertEqual(["eyes", "color"], results["tag1_eyes"])
+        self.assertGreater(engine.stats["errors"], 0)
+
+    def test_parse_json_object(self):
+        self.assertEqual({"a": ["x"], "b": ["y", "z"], "c": []},
+                         parse_json_object('```json\n{"a": "x", "b": ["y", "z"], "c": null}\n```'))
+        with self.assertRaises(ValueError):
+            parse_json_object('["a"]')
+
+
+if __name__ == "__main__":
+    unittest.main()
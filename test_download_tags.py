@@ -0,0 +1,174 @@
+# python -m unittest test_download_tags.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import socket
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils.download_tags import RateLimiter, download, iter_tags, checkpoint_path
+
+
+class StubDanbooru(BaseHTTPRequestHandler):
+    """tags.json?limit=&page= だけに答える Danbooru の代わり"""
+    tags = []
+    fail_first = set()  # 最初の1回だけ 503 を返すページ
+    forbidden_from = None
+    broken_from = None  # このページから読めない JSON を返す
+    requested = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        page = int(query["page"])
+        limit = int(query["limit"])
+        with self.lock:
+            self.requested.append(page)
+            fail = page in self.fail_first
+            self.fail_first.discard(page)
+        if fail:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        if self.forbidden_from is not None and page >= self.forbidden_from:
+            self.send_response(410)
+            self.end_headers()
+            return
+        tags = [tag for tag in self.tags if query.get("search[category]") in (None, str(tag["category"]))]
+        body = json.dumps(tags[(page - 1) * limit:page * limit]).encode("utf-8")
+        if self.broken_from is not None and page >= self.broken_from:
+            body = body[:-5]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadTags(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, "tags.ndjson")
+        StubDanbooru.tags = [{"id": i, "name": f"tag_{i}", "category": i % 2, "post_count": i} for i in range(95)]
+        StubDanbooru.fail_first = set()
+        StubDanbooru.forbidden_from = None
+        StubDanbooru.broken_from = None
+        StubDanbooru.requested = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubDanbooru)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, **kwargs):
+        options = {"limit": 10, "workers": 3, "rate": 0, "backoff": 0.01, "log": lambda message: None}
+        options.update(kwargs)
+        return download(self.output_path, self.base_url, **options)
+
+    def test_download(self):
+        # 失敗したページも再試行して、ページの順番通りに保存する
+        StubDanbooru.fail_first = {2, 5}
+        state = self.download()
+        self.assertTrue(state["done"])
+        self.assertEqual(95, state["count"])
+        self.assertEqual(StubDanbooru.tags, list(iter_tags(self.output_path)))
+        self.assertEqual(os.path.getsize(self.output_path), state["offset"])
+
+        # 取得済みなら何も取得しない
+        StubDanbooru.requested = []
+        self.assertTrue(self.download()["done"])
+        self.assertEqual([], StubDanbooru.requested)
+
+    def test_category(self):
+        state = self.download(params={"search[category]": 1})
+        self.assertEqual(47, state["count"])
+        self.assertTrue(all(tag["category"] == 1 for tag in iter_tags(self.output_path)))
+
+    def test_resume(self):
+        state = self.download(max_pages=4)
+        self.assertFalse(state["done"])
+        self.assertEqual(40, state["count"])
+        self.assertEqual(5, state["next_page"])
+
+        # 中断した時の書きかけの行は捨てて、続きのページから取得する
+        with open(self.output_path, "ab") as f:
+            f.write(b'{"id": 40, "na')
+        StubDanbooru.requested = []
+        state = self.download()
+        self.assertTrue(state["done"])
+        self.assertEqual(5, min(StubDanbooru.requested))
+        self.assertEqual(StubDanbooru.tags, list(iter_tags(self.output_path)))
+
+        # 別の条件のチェックポイントは使わない
+        state = self.download(params={"search[category]": 0})
+        self.assertEqual(48, state["count"])
+
+    def test_http_error(self):
+        # 再試行しないエラーのページまでで止めて、次はそのページから取得し直す
+        StubDanbooru.forbidden_from = 3
+        state = self.download()
+        self.assertFalse(state["done"])
+        self.assertEqual(410, state["error"])
+        self.assertEqual(20, state["count"])
+        with open(checkpoint_path(self.output_path), encoding="utf-8") as f:
+            self.assertEqual(3, json.load(f)["next_page"])
+
+        StubDanbooru.forbidden_from = None
+        state = self.download()
+        self.assertTrue(state["done"])
+        self.assertEqual(StubDanbooru.tags, list(iter_tags(self.output_path)))
+
+    def test_broken_response(self):
+        # 再試行しても読めないページも、ワーカーを止めずにチェックポイントに記録して止める
+        StubDanbooru.broken_from = 2
+        state = self.download(retries=1)
+        self.assertFalse(state["done"])
+        self.assertIn("JSONDecodeError", state["error"])
+        self.assertEqual(10, state["count"])
+        with open(checkpoint_path(self.output_path), encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        self.assertEqual(2, checkpoint["next_page"])
+        self.assertEqual(state["error"], checkpoint["error"])
+
+        # 接続できない場合も同じ
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            closed_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        state = download(self.output_path, closed_url, limit=10, workers=3, rate=0, retries=1, backoff=0.01,
+                         log=lambda message: None)
+        self.assertFalse(state["done"])
+        self.assertIn("URLError", state["error"])
+        with open(checkpoint_path(self.output_path), encoding="utf-8") as f:
+            self.assertEqual(state["error"], json.load(f)["error"])
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual([0.25, 0.25], sleeps)
+        limiter.defer(2.0)
+        limiter.wait()
+        self.assertEqual(2.0, sleeps[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
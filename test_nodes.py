@@ -7,7 +7,8 @@ from nodes import (
     TagFilter, TagIf, TagSwitcher, TagMerger, TagSelector, 
     TagComparator, TagRemover, TagEnhance, TagCategoryEnhance, 
     TagCategory, TagWildcardFilter, parse_tags, tagdata_to_string,
-    TagFlag, TagFlagImage, TagRandom, TagDetector, TagEmpty, TagColorChanger
+    TagFlag, TagFlagImage, TagRandom, TagDetector, TagEmpty, TagColorChanger,
+    TagReplace, TagMultiComparator
 )
 
 
@@ -259,6 +260,25 @@ class TestTagNodes(unittest.TestCase):
         self.assertEqual('(1boy:1.5), (lying:0.5), twintails', result[1])
         self.assertEqual('(long hair:1.2), (sitting:1.5), (1girl:1.2)', result[2])
 
+    def test_tag_multi_comparator(self):
+        tmc = TagMultiComparator()
+
+        # 空の入力は比較に含めない
+        result = tmc.tag(
+            tags1="1girl, (long hair:1.2), smile, smile",
+            tags2="long_hair, 1girl, twintails",
+            tags3="",
+            tags4="1girl, (smile:0.5), solo",
+        )
+        self.assertEqual('twintails, solo', result[0])
+        self.assertEqual('1girl', result[1])
+        self.assertEqual('1girl, (long hair:1.2), smile, twintails, solo', result[2])
+
+        # 入力が1つだけの場合は全てのタグが共通かつユニーク
+        result = tmc.tag(tags2="1girl, smile")
+        self.assertEqual(('1girl, smile', '1girl, smile', '1girl, smile'), result)
+        self.assertEqual(('', '', ''), tmc.tag())
+
     def test_tag_remover(self):
         tr = TagRemover()
         
@@ -311,6 +331,30 @@ class TestTagNodes(unittest.TestCase):
         )
         self.assertEqual('school_uniform, (long hair:1.2), (v:0.5), (sitting:0.5), (standing:0.5), (attack:0.5), (1girl:1.2), original_tag', result[0])
 
+    def test_tag_replace(self):
+        tr = TagReplace()
+
+        # 同じカテゴリのタグに置換され、元のタグの重みが引き継がれる
+        result = tr.tag("(long hair:1.2), original_tag, ((smile))", "short hair, (sword:0.8), short hair", 0.3)
+        self.assertEqual("(short hair:1.2), original_tag, (smile:1.2), (sword:0.8)", result[0])
+
+        # 一致度が足りない場合は置換しない
+        result = tr.tag("long hair, school_uniform", "short hair", 1.0)
+        self.assertEqual("short hair, school_uniform", result[0])
+        result = tr.tag("long hair, school_uniform", "sword", 1.0)
+        self.assertEqual("long hair, school_uniform, sword", result[0])
+
+        # 使われなかった置換先のタグは、小文字・"_" 区切りで追加する
+        result = tr.tag("long hair, school_uniform", "Unknown Item, (Big Sword:0.8)", 1.0)
+        self.assertEqual("long hair, school_uniform, unknown_item, (big_sword:0.8)", result[0])
+
+        result = tr.tag("long hair, 1girl", "", 0.3)
+        self.assertEqual("long hair, 1girl", result[0])
+
+        # 改行もタグの区切りとして扱う
+        result = tr.tag("long hair\nsmile", "short hair\nsword", 0.3)
+        self.assertEqual("short hair, smile, sword", result[0])
+
     def test_tag_category(self):
         tc = TagCategory()
         
@@ -360,6 +404,28 @@ class TestTagNodes(unittest.TestCase):
         result = twf.tag(tags=self.wildcard_tags, wildcard="*skirt")
         self.assertFalse(result[1])
 
+        # カンマ・改行区切りで複数のワイルドカードを指定するテスト
+        result = twf.tag(tags=self.wildcard_tags, wildcard="hair*, unknown\n*skirt")
+        self.assertEqual('hair_ornament, hair accessory, unknown_tag', result[0])
+        self.assertTrue(result[1])
+
+        # ? と [...] のテスト
+        result = twf.tag(tags=self.wildcard_tags, wildcard="[ls]*_hair")
+        self.assertEqual('long_hair, straight_hair, short hair', result[0])
+        result = twf.tag(tags=self.wildcard_tags, wildcard="lo?g_hair")
+        self.assertEqual('long_hair', result[0])
+        result = twf.tag(tags=self.wildcard_tags, wildcard="[!lsm]*")
+        self.assertEqual('hair_ornament, hair accessory, unknown_tag', result[0])
+
+        # 除外ワイルドカードのテスト
+        result = twf.tag(tags=self.wildcard_tags, wildcard="*hair*", exclude_wildcard="*_hair, ornament")
+        self.assertEqual('hair accessory', result[0])
+        result = twf.tag(tags=self.wildcard_tags, wildcard="", exclude_wildcard="*hair*")
+        self.assertEqual('unknown_tag', result[0])
+        self.assertTrue(result[1])
+        result = twf.tag(tags=self.wildcard_tags, wildcard="", exclude_wildcard=" , ")
+        self.assertEqual(self.wildcard_tags, result[0])
+
         result = twf.tag(tags=self.wildcard_tags, wildcard="skirt*")
         self.assertFalse(result[1])
 
@@ -415,6 +481,104 @@ class TestTagNodes(unittest.TestCase):
         self.assertIn('(9s \\(nier\\:automata\\):0.5)', result_tags)
 
 
+    def test_parse_tags_reference(self):
+        import tag_parser_reference
+
+        # 変更前の parse_tags と同じ結果になるかのテスト
+        cases = [
+            self.sample_tags, self.hair_tags, self.looking_tags, self.wildcard_tags,
+            "1girl, 1boy, 2b_\\(nier:automata\\), (9s \\(nier\\:automata\\):1.2)",
+            "((a, b)), (c:1.0), (d:x), ((e:0.5)), (f), )g(, (h, i:1.3)",
+            ",,, a,, (b,,c) ,\n d\\, e, \\\\(x\\\\), ((, )), (:), :, (:1.2)",
+            "(((a)), b), ((c)))), (((d), (e:1.2)",
+        ]
+        for case in cases:
+            expected = tag_parser_reference.parse_tags(case)
+            actual = parse_tags(case)
+            self.assertEqual(
+                [(t.tag, t.weight, t.format_unescape, t.text()) for t in expected],
+                [(t.tag, t.weight, t.format_unescape, t.text()) for t in actual])
+            self.assertEqual(tag_parser_reference.tagdata_to_string(expected), tagdata_to_string(actual))
+
+    def test_parse_tags_fuzz(self):
+        import nodes
+        import tag_parser_reference
+        from fuzz_parse import PromptGenerator, diverges, minimize
+
+        # ランダムな入力で変更前の実装と同じ結果になるかのテスト
+        generator = PromptGenerator(5678)
+        for _ in range(300):
+            case = generator.prompt()
+            if diverges(tag_parser_reference, nodes, case):
+                self.fail(f"parse_tags diverges: {minimize(tag_parser_reference, nodes, case)!r}")
+
+    def test_parse_tags_cache(self):
+        from nodes import parse_tags_cache_info, parse_tags_cache_clear
+
+        parse_tags_cache_clear()
+        tags1 = parse_tags(self.sample_tags)
+        tags2 = parse_tags(self.sample_tags)
+        info = parse_tags_cache_info()
+        self.assertEqual(1, info.misses)
+        self.assertEqual(1, info.hits)
+        self.assertEqual(tags1, tags2)
+        self.assertIsNot(tags1, tags2)
+
+        # キャッシュされた TagData は変更できない
+        with self.assertRaises(AttributeError):
+            tags1[0].weight = 2.0
+
+        # 強度を変更するノードを通しても、キャッシュの内容は変わらない
+        before = tagdata_to_string(parse_tags(self.sample_tags))
+        TagEnhance().tag(self.sample_tags, "school_uniform, long hair", 0.5, True)
+        TagCategoryEnhance().tag(self.sample_tags, "pose", 0.5, False)
+        self.assertEqual(before, tagdata_to_string(parse_tags(self.sample_tags)))
+
+    def test_tag_data_weight(self):
+        import decimal
+        from nodes import TagData
+
+        tag = TagData("long hair", 1.25)
+        self.assertEqual(1250, tag.weight_milli)
+        self.assertEqual(decimal.Decimal("1.25"), tag.weight)
+        self.assertEqual("(long hair:1.25)", tag.text())
+        self.assertEqual("(long_hair:1.25)", tag.text(underscore=True))
+        self.assertFalse(hasattr(tag, "__dict__"))
+
+        # 以前の Decimal の加算と同じ桁数で表示する
+        self.assertEqual("(long hair:1.50)", tag.add_weight(0.25).text())
+        self.assertEqual("(long hair:0.5)", tag.with_weight(0.5).text())
+        self.assertEqual("long hair", tag.with_weight(1.0).text())
+        self.assertEqual("(long hair:2.0)", TagData("long hair", 1.0).add_weight(1.0).text())
+        self.assertEqual("(long hair:-0.0)", TagData("long hair", -0.0).text())
+        self.assertEqual("(long hair:NaN)", TagData("long hair", float("nan")).text())
+        self.assertEqual("(long hair:1.200)", TagData("long hair", decimal.Decimal("1.2")).text())
+        self.assertEqual("long_hair", tag.format_unescape)
+
+    def test_batch_node(self):
+        from nodes import NODE_CLASS_MAPPINGS
+
+        tsb = NODE_CLASS_MAPPINGS["TagSelectorBatch"]()
+        self.assertTrue(tsb.INPUT_IS_LIST)
+        self.assertEqual((True, True), tsb.OUTPUT_IS_LIST)
+
+        # 設定の入力は1件だけでも、全てのタグに使われる
+        tags_list = [self.sample_tags, self.hair_tags, ""]
+        result = getattr(tsb, tsb.FUNCTION)(tags=tags_list, categorys=["pose"], whitelist_only=[True])
+        ts = TagSelector()
+        expected = [ts.tag(tags, "pose", whitelist_only=True) for tags in tags_list]
+        self.assertEqual([r[0] for r in expected], result[0])
+        self.assertEqual([r[1] for r in expected], result[1])
+
+        twb = NODE_CLASS_MAPPINGS["TagWildcardFilterBatch"]()
+        result = getattr(twb, twb.FUNCTION)(tags=[self.wildcard_tags, self.sample_tags], wildcard=["hair*", "*uniform"])
+        self.assertEqual(['hair_ornament, hair accessory', 'school_uniform'], result[0])
+        self.assertEqual(([], []), getattr(twb, twb.FUNCTION)(tags=[], wildcard=["hair*"]))
+
+        for name in list(NODE_CLASS_MAPPINGS.keys()):
+            if not name.endswith("Batch"):
+                self.assertIn(name + "Batch", NODE_CLASS_MAPPINGS)
+
     def test_tag_flag(self):
         tf = TagFlag()
         
@@ -525,6 +689,60 @@ class TestTagNodes(unittest.TestCase):
         self.assertNotIn('nature', result_tags)
         self.assertNotIn('hair_accessory', result_tags)
 
+    def test_tag_random_category_weighted(self):
+        from nodes import TagRandomCategory, tag_post_counts
+        trc = TagRandomCategory()
+        counts = tag_post_counts()
+        tc = TagCategory()
+
+        result = trc.tag("hair_style, eye_color", "hair_accessory, nature", count=5, seed=1, popularity_weighted=True)
+        self.assertEqual(result, trc.tag("hair_style, eye_color", "hair_accessory, nature", count=5, seed=1, popularity_weighted=True))
+        result_tags = tc.tag(result[0])[0]
+        self.assertIn('hair_style', result_tags)
+        self.assertIn('eye_color', result_tags)
+        self.assertNotIn('hair_accessory', result_tags)
+
+        # よく使われるタグほど選ばれやすい
+        def mean_count(weighted):
+            tags = []
+            for seed in range(50):
+                tags += trc.tag("clothing", "", count=10, seed=seed, popularity_weighted=weighted)[0].split(", ")
+            return sum(counts.get(tag, 0) for tag in tags) / len(tags)
+        self.assertGreater(mean_count(True), mean_count(False) * 5)
+
+        # ほとんどのタグを除く場合 (引き直しでは足りない) も、除くカテゴリのタグは選ばれない
+        result = trc.tag("hair", "hair_style, hair_color, hair_accessory, color", count=20, seed=3, popularity_weighted=True)
+        self.assertTrue(result[0])
+        result_tags = tc.tag(result[0])[0]
+        for category in ('hair_style', 'hair_color', 'hair_accessory', 'color'):
+            self.assertNotIn(category, result_tags)
+        self.assertEqual(("",), trc.tag("hair", "hair", count=3, popularity_weighted=True))
+
+    def test_tag_alias(self):
+        import tempfile
+        import nodes
+        from tag_db import TagAliasStore
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            alias_path = os.path.join(tmp_dir, "tag_alias.json")
+            # smile は DB にあるので、DB のカテゴリを使う
+            with open(alias_path, "w", encoding="utf-8") as f:
+                json.dump({"longhair": "long_hair", "sitting_down": "sitting", "smile": "long_hair"}, f)
+            tags = "(longhair:1.2), sitting down, smile, unknown_tag"
+            ts = TagSelector()
+            self.assertEqual(("", False), ts.tag(tags, "hair_style", whitelist_only=True))
+
+            old_store = nodes.tag_alias_store
+            nodes.tag_alias_store = TagAliasStore(alias_path)
+            try:
+                # カテゴリは正規のタグ名で引くが、出力するタグは書かれた通り
+                self.assertEqual(("(longhair:1.2)", True), ts.tag(tags, "hair_style", whitelist_only=True))
+                self.assertEqual("(longhair:1.2), sitting down, smile", ts.tag(tags, "*", whitelist_only=True)[0])
+                self.assertEqual("body, expression, face, hair, hair_style, pose", TagCategory().tag(tags)[0])
+                self.assertEqual("(longhair:1.2), (sitting down:1.5), (smile:1.5), unknown_tag",
+                                 TagCategoryEnhance().tag(tags, "pose", 1.5)[0])
+            finally:
+                nodes.tag_alias_store = old_store
+
 
     def test_tag_pipe(self):
         from nodes import TagPipeIn, TagPipeOut, TagPipeUpdate, TagPipeOutOne, TagPipeMerge
@@ -647,6 +865,13 @@ breasts 4.3M
 
         self.assertEqual('1girl, blue_eyes, blush, breasts', result)
 
+        # 長い方のタグを優先し、大文字・小文字や文末の . は無視する
+        result = td.tag(tags="A girl with Long Hair and blue eyes. She wears a school uniform.")[0]
+        self.assertEqual('long_hair, blue_eyes, school_uniform', result)
+
+        result = td.tag(tags="long hair, smile", max_join=1)[0]
+        self.assertEqual('smile', result)
+
 
     def test_tag_empty(self):
         te = TagEmpty()
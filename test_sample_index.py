@@ -0,0 +1,63 @@
+# python -m unittest test_sample_index.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from utils.sample_index import SampleIndex, tag_words
+
+
+TAGS = [
+    "sailor_collar", "red_collar", "collar", "on_bed", "on_chair", "on_floor", "on_stomach",
+    "hatsune_miku", "hatsune_miku_(append)", "cosplay", "holding_umbrella", "umbrella", "red_dress",
+]
+
+
+class TestSampleIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "index.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tag_words(self):
+        self.assertEqual(["hatsune", "miku", "append"], tag_words("Hatsune_Miku_(append)"))
+        self.assertEqual(["k", "on"], tag_words("k-on!"))
+
+    def test_top_k(self):
+        index = SampleIndex.load(self.path, TAGS)
+        # 珍しい単語 (collar) が共通するタグを、よくある単語 (red) より優先する
+        self.assertEqual(["collar", "sailor_collar", "red_collar"], index.top_k("blue_collar", 3))
+        self.assertEqual(["on_bed"], index.top_k("on_bed_sheet", 1))
+        self.assertEqual(["umbrella", "holding_umbrella"], index.top_k("broken_umbrella", 5))
+        self.assertEqual(["cosplay", "hatsune_miku"], index.top_k("hatsune_miku_(cosplay)", 2))
+        # 自分自身と exclude は返さない、重複もしない
+        result = index.top_k("red_collar", 10, exclude=["collar"])
+        self.assertNotIn("red_collar", result)
+        self.assertNotIn("collar", result)
+        self.assertEqual(len(result), len(set(result)))
+        self.assertEqual([], index.top_k("unknown_word", 3))
+        self.assertEqual([], index.top_k("!!", 3))
+
+    def test_persist(self):
+        index = SampleIndex.load(self.path, TAGS)
+        index.add("red_ribbon")
+        index.save()
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(TAGS + ["red_ribbon"], json.load(f)["tags"])
+
+        # 保存した索引に、増えたタグだけを追加する
+        index = SampleIndex.load(self.path, TAGS + ["red_ribbon", "ribbon"])
+        self.assertEqual(TAGS + ["red_ribbon", "ribbon"], index.tags)
+        self.assertEqual(["ribbon", "red_ribbon"], index.top_k("hair_ribbon", 2))
+
+        # 消えたタグがあれば作り直す
+        index = SampleIndex.load(self.path, ["ribbon", "red_ribbon"])
+        self.assertEqual(["ribbon", "red_ribbon"], index.tags)
+        self.assertEqual({"ribbon": [0, 1], "red": [1]}, index.postings)
+
+
+if __name__ == "__main__":
+    unittest.main()
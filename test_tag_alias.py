@@ -0,0 +1,80 @@
+# python -m unittest test_tag_alias.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from tag_alias import iter_aliases, resolve_aliases, main
+
+
+def danbooru_alias(antecedent, consequent, status="active"):
+    return {"id": 1, "antecedent_name": antecedent, "consequent_name": consequent, "status": status}
+
+
+class TestTagAlias(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = self.path("db.json")
+        with open(self.db_path, "w", encoding="utf-8") as f:
+            json.dump({"long_hair": ["hair"], "smile": ["expression"], "sitting": ["pose"]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_iter_aliases(self):
+        dump_path = self.path("tag_aliases.ndjson")
+        with open(dump_path, "w", encoding="utf-8") as f:
+            for alias in [danbooru_alias("longhair", "long_hair"), danbooru_alias("old_tag", "smile", "deleted")]:
+                f.write(json.dumps(alias) + "\n")
+        self.assertEqual([("longhair", "long_hair")], list(iter_aliases(dump_path)))
+
+        # 「別名,タグ」の CSV と、tagcomplete の CSV
+        csv_path = self.path("aliases.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write('sitting_down,sitting\nlong_hair,0,100,"longhair,long hair "\nsmile,0,50,\n')
+        self.assertEqual([("sitting_down", "sitting"), ("longhair", "long_hair"), ("long hair", "long_hair")],
+                         list(iter_aliases(csv_path)))
+
+    def test_resolve_aliases(self):
+        pairs = [("a", "b"), ("b", "c"), ("x", "y"), ("y", "x"), ("a", "z"), ("s", "s")]
+        # 連鎖は最後のタグにまとめ、循環しているものは捨てる
+        self.assertEqual({"a": "c", "b": "c"}, resolve_aliases(pairs))
+        # タグ名はノードと同じ形にしてからまとめる
+        pairs = [("long hair", "long_hair"), ("Long Hairs ", "Long Hair"), ("LongHair", "long_hairs")]
+        self.assertEqual({"long_hairs": "long_hair", "longhair": "long_hair"}, resolve_aliases(pairs))
+
+    def test_main(self):
+        dump_path = self.path("tag_aliases.json")
+        with open(dump_path, "w", encoding="utf-8") as f:
+            json.dump([danbooru_alias("sitting_down", "sitting"), danbooru_alias("longhair", "long_hair_(old)"),
+                       danbooru_alias("long_hair_(old)", "long_hair"), danbooru_alias("smile", "smiling"),
+                       danbooru_alias("unknown", "unknown_tag")], f)
+        output = self.path("tag_alias.json")
+        main([dump_path, "--db", self.db_path, "--output", output])
+        with open(output, encoding="utf-8") as f:
+            self.assertEqual({"long_hair_(old)": "long_hair", "longhair": "long_hair", "sitting_down": "sitting"}, json.load(f))
+
+        main([dump_path, "--all", "--output", output])
+        with open(output, encoding="utf-8") as f:
+            self.assertEqual(5, len(json.load(f)))
+
+    def test_csv_matches_prompt(self):
+        # tagcomplete の別名 (空白や大文字を含む) も、プロンプトのタグと一致する
+        from nodes import parse_tags
+        csv_path = self.path("tags.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write('long_hair,0,100,"Long Hairs,LongHair"\n')
+        output = self.path("tag_alias.json")
+        main([csv_path, "--db", self.db_path, "--output", output])
+        with open(output, encoding="utf-8") as f:
+            aliases = json.load(f)
+        for tag in parse_tags("long hairs, (LongHair:1.2)"):
+            self.assertEqual("long_hair", aliases[tag.format_unescape])
+
+
+if __name__ == "__main__":
+    unittest.main()
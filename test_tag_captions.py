@@ -0,0 +1,99 @@
+# python -m unittest test_tag_captions.py
+
+import unittest
+import os
+import tempfile
+import shutil
+import io
+import stat
+import contextlib
+from unittest import mock
+import tag_captions
+from tag_captions import parse_step, run
+
+
+class TestTagCaptions(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, "input")
+        self.captions = {
+            "a.txt": "school_uniform, (long hair, v:1.2), (sitting:1.5), attack, ((1girl)), original_tag",
+            os.path.join("sub", "b.txt"): "1girl, long hair, standing, watermark",
+            os.path.join("sub", "c.txt"): "original_tag",
+        }
+        for name, text in self.captions.items():
+            path = os.path.join(self.input_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        with open(os.path.join(self.input_dir, "skip.json"), "w", encoding="utf-8") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, base_dir, name):
+        with open(os.path.join(base_dir, name), encoding="utf-8") as f:
+            return f.read()
+
+    def test_parse_step(self):
+        self.assertEqual(
+            ("TagSelector", "tags", {"categorys": "pose, action", "exclude": True}),
+            parse_step('TagSelector "categorys=pose, action" exclude=true'))
+        with self.assertRaises(ValueError):
+            parse_step("NoSuchNode")
+        with self.assertRaises(ValueError):
+            parse_step("TagSelector no_such_input=1")
+        with self.assertRaises(ValueError):
+            parse_step("TagSelector exclude=maybe")
+        # バッチ版のノード名は受け付けない
+        with self.assertRaises(ValueError):
+            parse_step("TagSelectorBatch categorys=pose")
+        # 必須の入力は既定値で補い、既定値も無ければエラー
+        self.assertEqual(("TagSelector", "tags", {"exclude": True, "categorys": "*"}), parse_step("TagSelector exclude=true"))
+        with self.assertRaises(ValueError):
+            parse_step("TagEnhance strength=1.5")
+
+    def test_run(self):
+        steps = [
+            parse_step("TagSelector categorys=pose exclude=true"),
+            parse_step("TagRemover exclude_tags=watermark"),
+        ]
+        for workers in (1, 2):
+            output_dir = os.path.join(self.tmp_dir, f"output{workers}")
+            progress = run(self.input_dir, steps, output_dir, workers=workers, chunk_size=2, quiet=True)
+            self.assertEqual(3, progress.files)
+            self.assertEqual(0, progress.errors)
+            self.assertEqual("school_uniform, (long hair:1.2), (1girl:1.2), original_tag", self.read(output_dir, "a.txt"))
+            self.assertEqual("1girl, long hair", self.read(output_dir, os.path.join("sub", "b.txt")))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "skip.json")))
+
+    def test_run_in_place(self):
+        unchanged = os.path.join(self.input_dir, "sub", "c.txt")
+        os.utime(unchanged, ns=(0, 0))
+        progress = run(self.input_dir, [parse_step("TagRemover exclude_tags=watermark")], workers=1, quiet=True)
+        self.assertEqual(3, progress.files)
+        # 変更の無いファイルは書き込まない
+        self.assertEqual(2, progress.changed)
+        self.assertEqual(0, os.stat(unchanged).st_mtime_ns)
+        self.assertEqual("1girl, long hair, standing", self.read(self.input_dir, os.path.join("sub", "b.txt")))
+
+    def test_run_keeps_mode(self):
+        path = os.path.join(self.input_dir, "a.txt")
+        os.chmod(path, 0o644)
+        run(self.input_dir, [parse_step("TagRemover exclude_tags=watermark")], workers=1, quiet=True)
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_run_node_error(self):
+        # ノードのエラーはファイルごとのエラーとして数え、処理は止めない
+        with mock.patch.object(tag_captions, "apply_steps", side_effect=TypeError("missing input")), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            progress = run(self.input_dir, [parse_step("TagRemover exclude_tags=watermark")], workers=1, quiet=True)
+        self.assertEqual(3, progress.files)
+        self.assertEqual(3, progress.errors)
+        self.assertEqual(0, progress.changed)
+        self.assertIn("missing input", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
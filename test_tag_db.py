@@ -0,0 +1,332 @@
+# python -m unittest test_tag_db.py
+
+import unittest
+import os
+import io
+import contextlib
+import json
+import tempfile
+import shutil
+import random
+from collections import Counter
+from tag_db import (
+    TagCategoryDB, LayeredTagCategory, compile_tag_category, load_tag_db, default_db_path, tokenize_text,
+    load_overlays, load_tag_category, overlay_paths, OVERLAY_ENV, TagCategoryStore, AliasTable, load_tag_counts
+)
+
+
+class TestTagDB(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sample = {
+            "long_hair": ["hair", "hair_style"],
+            "1girl": ["target", "person", "camera_subject", "gender"],
+            "\\m/": ["gesture", "hands"],
+            "2b_(nier:automata)": ["character"],
+            "ハート": ["symbol"],
+            "empty_tag": [],
+        }
+        self.json_path = os.path.join(self.tmp_dir, "tag_category_test.json")
+        with open(self.json_path, "w", encoding="utf-8") as f:
+            json.dump(self.sample, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_mapping_api(self):
+        db = TagCategoryDB(compile_tag_category(self.sample))
+
+        self.assertEqual(len(self.sample), len(db))
+        # 並び順は JSON のまま
+        self.assertEqual(list(self.sample.keys()), list(db))
+        self.assertEqual(list(self.sample.items()), list(db.items()))
+
+        self.assertIn("1girl", db)
+        self.assertNotIn("2girls", db)
+        self.assertNotIn(None, db)
+        self.assertEqual(["symbol"], db["ハート"])
+        self.assertEqual([], db["empty_tag"])
+        self.assertEqual(["character"], db.get("2b_(nier:automata)"))
+        self.assertIsNone(db.get("2girls"))
+        self.assertEqual([], db.get(None, []))
+        with self.assertRaises(KeyError):
+            db["2girls"]
+
+    def test_category_mask(self):
+        db = TagCategoryDB(compile_tag_category(self.sample))
+
+        hair_mask = db.category_mask(["hair", "unknown_category"])
+        self.assertEqual(db.category_mask(["hair"]), hair_mask)
+        self.assertEqual(0, db.category_mask(["unknown_category"]))
+        self.assertTrue(db.tag_mask("long_hair") & hair_mask)
+        self.assertFalse(db.tag_mask("1girl") & hair_mask)
+        self.assertEqual(db.category_mask(db["1girl"]), db.tag_mask("1girl"))
+        self.assertEqual(0, db.tag_mask("empty_tag"))
+        self.assertIsNone(db.tag_mask("2girls"))
+        self.assertEqual(-1, db.category_id("unknown_category"))
+        self.assertEqual("gender", db.category_name(db.category_id("gender")))
+
+    def test_category_tags(self):
+        db = TagCategoryDB(compile_tag_category(self.sample))
+
+        hair_tags = [db.tag_at(position) for position in db.category_tags("hair")]
+        self.assertEqual(["long_hair"], hair_tags)
+        self.assertEqual([], list(db.category_tags("unknown_category")))
+        self.assertEqual({"1girl", "\\m/"}, {db.tag_at(p) for p in db.tags_in_categories(["gender", "hands"])})
+        for position, tag in enumerate(self.sample):
+            self.assertEqual(tag, db.tag_at(position))
+
+    def test_longest_suffix(self):
+        self.sample["very_long_hair"] = ["hair", "hair_length"]
+        self.sample["hair"] = ["hair"]
+        self.sample["empty_tag"] = []
+        db = TagCategoryDB(compile_tag_category(self.sample))
+
+        self.assertEqual("very_long_hair", db.longest_suffix("crazy_very_long_hair"))
+        self.assertEqual("long_hair", db.longest_suffix("crazy_long_hair"))
+        self.assertEqual("hair", db.longest_suffix("crazy_short_hair"))
+        # タグ自身とカテゴリの無いタグは対象外
+        self.assertIsNone(db.longest_suffix("hair"))
+        self.assertIsNone(db.longest_suffix("my_empty_tag"))
+        self.assertIsNone(db.longest_suffix("original_tag"))
+
+    def test_longest_match(self):
+        self.sample["very_long_hair"] = ["hair", "hair_length"]
+        self.sample["hair"] = ["hair"]
+        self.sample["c.c."] = ["character"]
+        db = TagCategoryDB(compile_tag_category(self.sample))
+
+        tokens = tokenize_text("Very long hair, C.C. and long_hair.")
+        self.assertEqual(["very", "long", "hair", "c.c", ".", "and", "long", "hair", "."], tokens)
+        self.assertEqual((3, "very_long_hair"), db.longest_match(tokens, 0))
+        self.assertEqual((3, "long_hair"), db.longest_match(tokens, 1))
+        self.assertEqual((5, "c.c."), db.longest_match(tokens, 3))
+        self.assertIsNone(db.longest_match(tokens, 5))
+        self.assertEqual((1, "hair"), db.longest_match(["hair", "x"], 0))
+        # max_words を超える長さのタグは探さない
+        self.assertIsNone(db.longest_match(tokens, 0, max_words=2))
+        self.assertEqual((3, "long_hair"), db.longest_match(tokens, 1, max_words=2))
+        # "_" 以外の区切り文字を含むタグは対象外
+        self.assertIsNone(db.longest_match(tokenize_text("2b nier automata"), 0))
+
+    def test_load_and_rebuild(self):
+        db = load_tag_db(self.json_path)
+        self.assertTrue(os.path.exists(default_db_path(self.json_path)))
+        self.assertEqual(self.sample, dict(db.items()))
+        # 普通に作ったファイルと同じ権限 (mkstemp の 0600 ではない)
+        with open(os.path.join(self.tmp_dir, "plain"), "wb"):
+            pass
+        self.assertEqual(os.stat(os.path.join(self.tmp_dir, "plain")).st_mode,
+                         os.stat(default_db_path(self.json_path)).st_mode)
+
+        # 2回目はコンパイル済みのファイルを開く
+        mtime = os.stat(default_db_path(self.json_path)).st_mtime_ns
+        db = load_tag_db(self.json_path)
+        self.assertEqual(mtime, os.stat(default_db_path(self.json_path)).st_mtime_ns)
+
+        # JSON が変更されたらコンパイルし直す
+        self.sample["short_hair"] = ["hair", "hair_style"]
+        with open(self.json_path, "w", encoding="utf-8") as f:
+            json.dump(self.sample, f)
+        db = load_tag_db(self.json_path)
+        self.assertEqual(["hair", "hair_style"], db["short_hair"])
+
+    def write_overlay(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        return path
+
+    def test_overlay(self):
+        self.sample["hair"] = ["hair"]
+        base = TagCategoryDB(compile_tag_category(self.sample))
+        paths = [
+            self.write_overlay("a.json", {
+                "long_hair": ["hair", "hair_length"],
+                "1girl": {"add": ["solo"], "remove": ["camera_subject"]},
+                "\\m/": None,
+                "blue_eyes": ["eyes", "color"],
+                "no_such_tag": None,
+            }),
+            self.write_overlay("b.json", {
+                "long_hair": {"remove": ["hair_length"]},
+                "blue_eyes": {"add": ["face"]},
+                "ハート": [],
+            }),
+        ]
+        db = LayeredTagCategory(base, load_overlays(base, paths), paths)
+
+        # JSON をマージしてコンパイルした DB と同じ結果になる
+        merged = dict(self.sample)
+        merged["long_hair"] = ["hair"]
+        merged["1girl"] = ["target", "person", "gender", "solo"]
+        del merged["\\m/"]
+        merged["blue_eyes"] = ["eyes", "color", "face"]
+        merged["ハート"] = []
+        expected = TagCategoryDB(compile_tag_category(merged))
+
+        self.assertEqual(list(merged.items()), list(db.items()))
+        self.assertEqual(list(merged), list(db))
+        self.assertEqual(len(merged), len(db))
+        self.assertNotIn("\\m/", db)
+        self.assertIsNone(db.get("\\m/"))
+        self.assertIsNone(db.tag_mask("\\m/"))
+        with self.assertRaises(KeyError):
+            db["no_such_tag"]
+        self.assertEqual(["eyes", "color", "face"], db["blue_eyes"])
+
+        for category in expected.category_names() + ["hair_length", "camera_subject", "unknown_category"]:
+            self.assertEqual([expected.tag_at(p) for p in expected.category_tags(category)],
+                             [db.tag_at(p) for p in db.category_tags(category)], category)
+        for tag in list(merged) + ["\\m/", "2girls"]:
+            mask = db.tag_mask(tag)
+            names = None if mask is None else {c for c in db.category_names() if mask & db.category_mask([c])}
+            self.assertEqual(None if tag not in merged else set(merged[tag]), names, tag)
+        self.assertTrue(db.tag_mask("blue_eyes") & db.category_mask(["face", "unknown_category"]))
+        self.assertEqual({"1girl", "blue_eyes"}, {db.tag_at(p) for p in db.tags_in_categories(["solo", "eyes"])})
+
+        self.assertEqual("long_hair", db.longest_suffix("crazy_long_hair"))
+        self.assertEqual("blue_eyes", db.longest_suffix("big_blue_eyes"))
+        for tag in ("crazy_long_hair", "big_blue_eyes", "big_ハート", "very_\\m/", "my_1girl", "x_no_such_tag"):
+            self.assertEqual(expected.longest_suffix(tag), db.longest_suffix(tag), tag)
+        self.assertIn("suffix_trie", db.built_indexes())
+        self.assertEqual((2, "blue_eyes"), db.longest_match(tokenize_text("blue eyes"), 0))
+        self.assertIsNone(db.longest_match(["\\m/"], 0))
+
+    def test_overlay_paths(self):
+        overlay_dir = os.path.join(self.tmp_dir, "overlays")
+        os.makedirs(overlay_dir)
+        for name in ("b.json", "a.json", "readme.txt"):
+            with open(os.path.join(overlay_dir, name), "w", encoding="utf-8") as f:
+                f.write("{}")
+        extra = self.write_overlay("extra.json", {"ハート": ["heart"]})
+        old_env = os.environ.get(OVERLAY_ENV)
+        os.environ[OVERLAY_ENV] = extra
+        try:
+            paths = overlay_paths(overlay_dir)
+        finally:
+            if old_env is None:
+                del os.environ[OVERLAY_ENV]
+            else:
+                os.environ[OVERLAY_ENV] = old_env
+        self.assertEqual([os.path.join(overlay_dir, "a.json"), os.path.join(overlay_dir, "b.json"), extra], paths)
+
+        db = load_tag_category(self.json_path, paths)
+        self.assertEqual(["heart"], db["ハート"])
+        self.assertIsInstance(load_tag_category(self.json_path, []), TagCategoryDB)
+
+        # 壊れたオーバーレイは飛ばして、残りを重ねる (途中まで読んだ分も使わない)
+        bad = self.write_overlay("bad.json", {"long_hair": ["hair"], "1girl": "person"})
+        broken = os.path.join(self.tmp_dir, "broken.json")
+        with open(broken, "w", encoding="utf-8") as f:
+            f.write("[")
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            db = load_tag_category(self.json_path, [bad, extra, broken])
+        self.assertIn("bad.json", stderr.getvalue())
+        self.assertIn("broken.json", stderr.getvalue())
+        self.assertEqual(["heart"], db["ハート"])
+        self.assertEqual(["hair", "hair_style"], db["long_hair"])
+
+    def update_json(self, data):
+        # mtime の分解能が粗いファイルシステムでも変更が分かるようにする
+        stat = os.stat(self.json_path)
+        with open(self.json_path, "w", encoding="utf-8") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+        os.utime(self.json_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_store_reload(self):
+        overlay_dir = os.path.join(self.tmp_dir, "overlays")
+        store = TagCategoryStore(self.json_path, overlay_dir, check_interval=0)
+        old = store.get()
+        self.assertIs(old, store.get())
+        self.assertFalse(store.check(wait=True))
+        old.longest_suffix("crazy_long_hair")
+
+        # JSON を変更すると新しいスナップショットに差し替わる。古いスナップショットはそのまま使える
+        self.sample["short_hair"] = ["hair"]
+        self.update_json(self.sample)
+        self.assertTrue(store.check(wait=True))
+        new = store.get()
+        self.assertIsNot(old, new)
+        self.assertEqual(["hair"], new["short_hair"])
+        self.assertNotIn("short_hair", old)
+        self.assertEqual(["hair", "hair_style"], old["long_hair"])
+        # 古いスナップショットで作られていた索引は作成済み
+        self.assertIn("suffix_trie", new.built_indexes())
+        self.assertNotIn("token_trie", new.built_indexes())
+
+        # 壊れた JSON は読み込まずに今のスナップショットを使い続ける
+        self.update_json("{broken")
+        self.assertTrue(store.check(wait=True))
+        self.assertIs(new, store.get())
+        self.assertIsInstance(store.error, ValueError)
+        self.assertFalse(store.check(wait=True))
+        # JSON として読めても形が違うものも同じ
+        self.update_json("[1, 2]")
+        self.assertTrue(store.check(wait=True))
+        self.assertIs(new, store.get())
+        self.assertIsNotNone(store.error)
+        self.assertFalse(store.check(wait=True))
+
+        # オーバーレイの追加も変更として扱う
+        os.makedirs(overlay_dir)
+        with open(os.path.join(overlay_dir, "fix.json"), "w", encoding="utf-8") as f:
+            json.dump({"short_hair": ["hair", "hair_length"]}, f)
+        self.update_json(self.sample)
+        self.assertTrue(store.check(wait=True))
+        self.assertIsNone(store.error)
+        self.assertEqual(["hair", "hair_length"], store.get()["short_hair"])
+
+        # 最初の読み込みに失敗した場合は、次の get() で読み込み直す
+        self.update_json("[1, 2]")
+        store = TagCategoryStore(self.json_path, check_interval=0)
+        with self.assertRaises(Exception):
+            store.get()
+        self.update_json(self.sample)
+        self.assertEqual(["hair"], store.get()["short_hair"])
+
+        # json_path が無い間は fallback_path を読み、できたら読み込み直す
+        missing = os.path.join(self.tmp_dir, "tag_category_missing.json")
+        store = TagCategoryStore(missing, check_interval=0, fallback_path=self.json_path)
+        self.assertEqual(["hair"], store.get()["short_hair"])
+        with open(missing, "w", encoding="utf-8") as f:
+            json.dump({"short_hair": ["hair_length"]}, f)
+        self.assertTrue(store.check(wait=True))
+        self.assertEqual(["hair_length"], store.get()["short_hair"])
+
+    def test_alias_table(self):
+        table = AliasTable(["a", "b", "c", "d"], [60, 30, 10, 0])
+        myrand = random.Random(1)
+        counts = Counter(table.sample(myrand) for _ in range(20000))
+        self.assertEqual(0, counts["d"])
+        self.assertAlmostEqual(0.6, counts["a"] / 20000, delta=0.02)
+        self.assertAlmostEqual(0.3, counts["b"] / 20000, delta=0.02)
+        self.assertAlmostEqual(0.1, counts["c"] / 20000, delta=0.02)
+        # 同じシードなら同じ結果
+        self.assertEqual([table.sample(random.Random(5)) for _ in range(3)],
+                         [table.sample(random.Random(5)) for _ in range(3)])
+        # 重みが全て 0 なら同じ確率
+        counts = Counter(AliasTable(["a", "b"], [0, 0]).sample(myrand) for _ in range(2000))
+        self.assertAlmostEqual(0.5, counts["a"] / 2000, delta=0.05)
+        with self.assertRaises(ValueError):
+            AliasTable([], [])
+
+    def test_load_tag_counts(self):
+        paths = []
+        for i, rows in enumerate([["1,general,9,100", "2,long_hair,0,50"], ["3,long_hair,0,80", "4,smile,0,"]]):
+            paths.append(os.path.join(self.tmp_dir, f"tagger{i}.csv"))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.write("tag_id,name,category,count\n" + "\n".join(rows) + "\n")
+        self.assertEqual({"long_hair": 80, "smile": 0}, load_tag_counts(paths))
+
+    def test_bundled_category(self):
+        code_dir = os.path.dirname(os.path.realpath(__file__))
+        json_path = os.path.join(code_dir, "tag_category_v2.json")
+        with open(json_path, encoding="utf-8-sig") as f:
+            expected = json.load(f)
+        db = TagCategoryDB(compile_tag_category(expected))
+        self.assertEqual(list(expected.items()), list(db.items()))
+
+
+if __name__ == "__main__":
+    unittest.main()
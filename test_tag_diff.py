@@ -0,0 +1,91 @@
+# python -m unittest test_tag_diff.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import io
+from tag_diff import _iter_json_array, iter_dump, main
+
+
+def danbooru_tag(name, post_count, category=1, is_deprecated=False):
+    return {"id": 1, "name": name, "post_count": post_count, "category": category, "is_deprecated": is_deprecated}
+
+
+class TestTagDiff(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = self.path("db.json")
+        with open(self.db_path, "w", encoding="utf-8") as f:
+            json.dump({"long_hair": ["hair"], "smile": ["expression"]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write_ndjson(self, name, tags):
+        with open(self.path(name), "w", encoding="utf-8") as f:
+            for tag in tags:
+                f.write(json.dumps(tag) + "\n")
+        return self.path(name)
+
+    def run_diff(self, *dumps):
+        main(list(dumps) + ["--db", self.db_path, "--output", self.path("new.json"),
+                            "--diff", self.path("diff.ndjson"), "--stats", self.path("stats.json")])
+        with open(self.path("new.json"), encoding="utf-8") as f:
+            new_tags = json.load(f)
+        with open(self.path("diff.ndjson"), encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        return new_tags, records
+
+    def test_iter_dump(self):
+        tags = [danbooru_tag(f"tag_{i}", i * 1000) for i in range(50)]
+        array_path = self.path("tags.json")
+        with open(array_path, "w", encoding="utf-8") as f:
+            json.dump(tags, f, indent=2)
+        # 配列は小さく区切って読んでも、要素の途中で切れずに読める
+        self.assertEqual(tags, list(iter_dump(array_path, chunk_size=7)))
+        self.assertEqual(tags, list(iter_dump(self.write_ndjson("tags.ndjson", tags))))
+
+        with open(array_path, "w", encoding="utf-8") as f:
+            f.write(' [ ]')
+        self.assertEqual([], list(iter_dump(array_path)))
+        with open(array_path, "w", encoding="utf-8") as f:
+            f.write('[{"name": "a"}, {"name"')
+        with self.assertRaises(ValueError):
+            list(iter_dump(array_path, chunk_size=4))
+
+        # 壊れた配列は、要素が上限を超えたところで止める (末尾まで読み込まない)
+        f = io.StringIO('[{"name": "a"}, {"name": ' + "x" * 10000 + "]")
+        with self.assertRaises(ValueError):
+            list(_iter_json_array(f, chunk_size=16, max_value_size=100))
+        self.assertLess(f.tell(), 200)
+        f = io.StringIO('[{"name": "a"}, {"name": "' + "x" * 200 + '"}]')
+        self.assertEqual(2, len(list(_iter_json_array(f, chunk_size=16, max_value_size=300))))
+
+    def test_diff(self):
+        full = self.write_ndjson("all.ndjson", [
+            danbooru_tag("long_hair", 1000, 0),
+            danbooru_tag("smile", 500, 0),
+            danbooru_tag("new_tag", 300),
+            danbooru_tag("rare_tag", 200),
+            danbooru_tag("old_tag", 5000, is_deprecated=True),
+            danbooru_tag("artist_tag", 5000, category=4),
+        ])
+        general = self.write_ndjson("general.ndjson", [danbooru_tag("new_tag", 300), danbooru_tag("new_tag2", 201)])
+        new_tags, records = self.run_diff(full, general)
+        self.assertEqual(["new_tag", "new_tag2"], new_tags)
+        self.assertEqual(["added", "added"], [record["type"] for record in records])
+
+        # 前回から変わった DB のタグ
+        full = self.write_ndjson("all.ndjson", [danbooru_tag("long_hair", 1100, 0), danbooru_tag("smile", 900, 5)])
+        new_tags, records = self.run_diff(full)
+        self.assertEqual([], new_tags)
+        self.assertEqual([{"type": "changed", "name": "smile", "post_count": [500, 900], "category": [0, 5]}], records)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# python -m unittest test_tag_journal.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+from utils.tag_journal import TagJournal
+
+
+class TestTagJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "tag_category_v3.json")
+        with open(self.db_path, "w", encoding="utf-8") as f:
+            json.dump({"long_hair": ["hair"]}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_db(self):
+        with open(self.db_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_append_and_resume(self):
+        journal = TagJournal(self.db_path, compact_every=100)
+        self.assertEqual({"long_hair": ["hair"]}, journal.load())
+        journal.append({"smile": ["expression"], "sitting": ["pose"]})
+        journal.append({"long_hair": ["hair", "hair_style"]})
+        # DB はまだ書き直さない
+        self.assertEqual({"long_hair": ["hair"]}, self.read_db())
+        journal._file.close()  # close せずに止まった場合
+
+        # 書きかけの行は捨てて、ジャーナルを重ねた状態から続ける
+        with open(journal.journal_path, "ab") as f:
+            f.write(b'{"watermark": ["te')
+        journal = TagJournal(self.db_path, compact_every=100)
+        expected = {"long_hair": ["hair", "hair_style"], "smile": ["expression"], "sitting": ["pose"]}
+        self.assertEqual(expected, journal.load())
+        self.assertIn("smile", journal)
+        self.assertEqual(3, journal.pending)
+        journal.append({"watermark": ["text"]})
+        journal.close()
+
+        expected["watermark"] = ["text"]
+        self.assertEqual(expected, self.read_db())
+        self.assertEqual(0, os.path.getsize(journal.journal_path))
+        self.assertEqual(expected, TagJournal(self.db_path).load())
+
+    def test_compact_every(self):
+        os.chmod(self.db_path, 0o640)
+        with TagJournal(self.db_path, compact_every=3) as journal:
+            journal.append({"a": ["x"], "b": ["x"]})
+            self.assertNotIn("a", self.read_db())
+            journal.append({"c": ["x"]})
+            self.assertIn("c", self.read_db())
+            self.assertEqual(0, os.path.getsize(journal.journal_path))
+            journal.append({"d": ["x"]})
+        self.assertEqual(["long_hair", "a", "b", "c", "d"], list(self.read_db()))
+        # 書き直しても DB の権限は変わらない
+        self.assertEqual(0o640, os.stat(self.db_path).st_mode & 0o777)
+
+    def test_broken_journal(self):
+        with open(self.db_path + ".journal", "w", encoding="utf-8") as f:
+            f.write('{"a": ["x"\n{"b": ["x"]}\n')
+        with self.assertRaises(ValueError):
+            TagJournal(self.db_path).load()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# python -m unittest test_tag_metrics.py
+
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import threading
+import nodes
+import tag_metrics
+from tag_db import TagCategoryDB, LayeredTagCategory
+
+
+class TestTagMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original_parse_tags = nodes.parse_tags
+        self.original_get = TagCategoryDB.get
+        tag_metrics.reset()
+        tag_metrics.enable(nodes, (TagCategoryDB, LayeredTagCategory))
+
+    def tearDown(self):
+        tag_metrics.disable()
+        tag_metrics.reset()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_node_metrics(self):
+        self.assertTrue(tag_metrics.enabled())
+        nodes.TagSelector().tag("school_uniform, (sitting:1.5), attack, original_tag", "pose")
+        batch = nodes.NODE_CLASS_MAPPINGS["TagRemoverBatch"]()
+        batch.tag_batch(tags=["1girl, smile", "1girl, solo, watermark"], exclude_tags=["watermark"])
+        with self.assertRaises(AttributeError):
+            nodes.TagSelector().tag("1girl", None)
+
+        metrics = tag_metrics.snapshot()
+        selector = metrics["TagSelector"]
+        self.assertEqual(2, selector["calls"])
+        self.assertEqual(1, selector["errors"])
+        self.assertEqual(5, selector["input_tags"])
+        self.assertEqual(3, selector["output_tags"])
+        self.assertEqual(2, selector["stages"]["parse_tags"]["count"])
+        self.assertGreater(selector["stages"]["lookup"]["count"], 0)
+        self.assertEqual(2, selector["latency"]["buckets"]["+Inf"])
+
+        # バッチ版は全体で1回として数え、中で呼ぶ元のノードの分もバッチ版に含める
+        remover = metrics["TagRemoverBatch"]
+        self.assertEqual(1, remover["calls"])
+        self.assertEqual(7, remover["input_tags"])
+        self.assertEqual(4, remover["output_tags"])
+        self.assertEqual(4, remover["stages"]["parse_tags"]["count"])
+        self.assertNotIn("TagRemover", metrics)
+
+        tag_metrics.reset()
+        batch = nodes.NODE_CLASS_MAPPINGS["TagSelectorBatch"]()
+        batch.tag_batch(tags=["1girl, sitting", "standing, smile"], categorys=["pose"])
+        metrics = tag_metrics.snapshot()
+        self.assertEqual(["TagSelectorBatch"], list(metrics))
+        self.assertEqual(4, metrics["TagSelectorBatch"]["input_tags"])
+        self.assertGreater(metrics["TagSelectorBatch"]["stages"]["lookup"]["count"], 0)
+
+    def test_input_tags(self):
+        # 除外リストはキャッシュされていても毎回数え、ノードの中で作った文字列の parse は数えない
+        for _ in range(2):
+            nodes.TagRemover().tag("1girl, smile, solo", "smile, solo")
+        nodes.TagRandomCategory().tag("hair_style", "", count=3, seed=1)
+        metrics = tag_metrics.snapshot()
+        self.assertEqual(10, metrics["TagRemover"]["input_tags"])
+        self.assertEqual(0, metrics["TagRandomCategory"]["input_tags"])
+        self.assertEqual(3, metrics["TagRandomCategory"]["output_tags"])
+
+    def test_enable_concurrently(self):
+        tag_metrics.disable()
+        threads = [threading.Thread(target=tag_metrics.enable, args=(nodes, (TagCategoryDB,))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 二重に差し替えていない
+        self.assertIs(self.original_parse_tags, nodes.parse_tags.__wrapped__)
+        self.assertIs(self.original_get, TagCategoryDB.get.__wrapped__)
+
+    def test_dump(self):
+        nodes.TagRemover().tag("1girl, smile", "smile")
+
+        json_path = tag_metrics.dump(os.path.join(self.tmp_dir, "metrics.json"))
+        with open(json_path, encoding="utf-8") as f:
+            data = json.load(f)
+        self.assertEqual(1, data["nodes"]["TagRemover"]["calls"])
+
+        prom_path = tag_metrics.dump(os.path.join(self.tmp_dir, "metrics.prom"))
+        with open(prom_path, encoding="utf-8") as f:
+            text = f.read()
+        self.assertIn('tag_filter_node_calls_total{node="TagRemover"} 1', text)
+        self.assertIn('tag_filter_node_seconds_bucket{node="TagRemover",le="+Inf"} 1', text)
+        self.assertIn('tag_filter_stage_seconds_count{node="TagRemover",stage="tagdata_to_string"} 1', text)
+        self.assertIn('tag_filter_output_tags_total{node="TagRemover"} 1', text)
+        # 他のユーザー (node_exporter など) も読める権限で書く
+        with open(os.path.join(self.tmp_dir, "plain"), "wb"):
+            pass
+        self.assertEqual(os.stat(os.path.join(self.tmp_dir, "plain")).st_mode, os.stat(prom_path).st_mode)
+
+    def test_disable(self):
+        tag_metrics.disable()
+        self.assertFalse(tag_metrics.enabled())
+        # 差し替えたものが元に戻り、記録されない
+        self.assertIs(self.original_parse_tags, nodes.parse_tags)
+        self.assertIs(self.original_get, TagCategoryDB.get)
+        nodes.TagRemover().tag("1girl, smile", "smile")
+        self.assertEqual({}, tag_metrics.snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
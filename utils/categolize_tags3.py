@@ -11,6 +11,7 @@ from pmem.async_pmem import PersistentMemory
 from chat_assistant import ChatAssistant, ModelManager
 
 from json_repair import loads
+from tag_journal import TagJournal
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -116,10 +117,18 @@ async def main():
     sample_data = clean_data(await read_csv(sample_csv_file))
     sample_names = set([row['name'] for row in sample_data])
 
-    cached_tag_names = await cache.load('cached_tags', [])
-    print("cached_tag_names: ", cached_tag_names)
+    # タグごとの結果は categolize_tags3.json.journal に追記して、たまったら categolize_tags3.json に書き込む
+    journal = TagJournal(os.path.join(os.path.dirname(__file__), 'categolize_tags3.json'))
+    result_data = journal.load()
+
+    # 以前の形式 (cache の cached_tags) で保存した結果を引き継ぐ
+    legacy_names = [name for name in await cache.load('cached_tags', []) if name not in journal]
+    if legacy_names:
+        journal.append({name: await cache.load(name) for name in legacy_names})
+
+    print("cached_tag_names: ", len(result_data))
     data = names - sample_names
-    data = data - set(cached_tag_names)
+    data = data - set(result_data)
     data = list(data)
     sorted(data)
 
@@ -130,39 +139,32 @@ async def main():
     total_batches = len(batches)
     batch_tasks = []
 
-    result_data = {}
-    for cached_tag in cached_tag_names:
-        result_data[cached_tag] = await cache.load(cached_tag)
-
     for i, batch in enumerate(batches):
         print(f"Preparing batch {i+1}/{total_batches} ({len(batch)} tags)")
         key = f"tag_categorize : {batch}"
         
-        async def process_and_save_batch(num, batch, key, sample_data, result_data):
+        async def process_and_save_batch(num, batch, key, sample_data):
             result = await cache.load(key)
             if not result:
                 result = await process_batch(num, ai, batch, sample_data)
                 await cache.save(key, result)
             
+            batch_result = {}
             for row in result:
-                result_data[row['name']] = []
+                batch_result[row['name']] = []
                 for n in range(1, 8):
                     if f'category{n}' in row:
-                        result_data[row['name']].append(row[f'category{n}'])
-                rkey = row['name']
-                await cache.save(rkey, result_data[row['name']])
-
-                cached_tags = await cache.load('cached_tags', [])
-                cached_tags.append(rkey)
-                await cache.save('cached_tags', cached_tags)
+                        batch_result[row['name']].append(row[f'category{n}'])
+            journal.append(batch_result)
             
             return result
 
-        batch_task = asyncio.create_task(process_and_save_batch(i, batch, key, sample_data, result_data))
+        batch_task = asyncio.create_task(process_and_save_batch(i, batch, key, sample_data))
         batch_tasks.append(batch_task)
 
     # Wait for all batch tasks to complete
     results = await asyncio.gather(*batch_tasks)
+    journal.close()
 
     import json
 
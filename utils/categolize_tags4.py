@@ -2,8 +2,9 @@ import json
 import random
 import os
 import shutil
-import math
-from openai import OpenAI
+from tag_journal import TagJournal
+from categorize_engine import CategorizeEngine, ChatCompletionsBackend
+from sample_index import SampleIndex
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -15,8 +16,9 @@ with open("tag_category_v2.json", "r", encoding="utf-8") as f:
 print("tag_category_v3.jsonを読み込み中...")
 if not os.path.exists("tag_category_v3.json"):
     shutil.copyfile("tag_category_v2.json", "tag_category_v3.json")
-with open("tag_category_v3.json", "r", encoding="utf-8") as f:
-    tag_category_v3 = dict(json.load(f))
+# 結果は tag_category_v3.json.journal に追記して、たまったら tag_category_v3.json に書き込む
+journal = TagJournal("tag_category_v3.json")
+tag_category_v3 = journal.load()
 
 with open("new_danbooru_tags.json", "r", encoding="utf-8") as f:
     new_danbooru_tags = list(json.load(f))
@@ -27,31 +29,19 @@ print(f"tag_category_v3: {len(tag_category_v3)}")
 print(f"new_danbooru_tags: {len(new_danbooru_tags)}")
 
 
-sample_separate = {}
-for key, val in tag_category_v3.items():
-    key_separate = key.split("_")
-    for se in key_separate:
-        if se not in sample_separate:
-            sample_separate[se] = []
-        sample_separate[se].append(key)
+# プロンプトに載せる例を選ぶ索引 (前回の索引に増えたタグだけ追加する)
+sample_index = SampleIndex.load("tag_category_v3.sample_index.json", tag_category_v3)
 
 
 def releted_tags(tag:str, count:int=3) -> list[str]:
-    tag_separate = []
-    for se in tag.split("_"):
-        tag_separate.extend(se.split("-"))
-    tag_separate.reverse()
-    releted_tags = []
-    for se in tag_separate:
-        if se in sample_separate:
-            releted_tags.extend(sample_separate.get(se, []))
-    return releted_tags[:count]
-
-
-def categorize_tags(tags:list[str]):
+    return sample_index.top_k(tag, count)
+
+
+def build_prompt(tags:list[str]) -> tuple[str, str]:
     sample_keys = []
     for tag in tags:
         sample_keys.extend(releted_tags(tag))
+    sample_keys = list(dict.fromkeys(sample_keys))
 
     sample_tags = json.dumps({k: tag_category_v3[k] for k in sample_keys}, indent=2, ensure_ascii=True)
     input_tags = json.dumps(sample_keys, indent=2, ensure_ascii=True)
@@ -69,41 +59,34 @@ EXAMPLE JSON OUTPUT:
 {sample_tags}
     """.strip()
 
-    print("\n")
-    print(system_prompt)
-
     user_prompt = json.dumps(tags, indent=2, ensure_ascii=True)
 
-    print("\n")
-    print(user_prompt)
-
-    client = OpenAI(
-        api_key=os.getenv("DEEPSEEK_API_KEY"),
-        base_url="https://api.deepseek.com",
-    )
+    return system_prompt, user_prompt
 
-    messages = [{"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}]
 
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=messages,
-        response_format={
-            'type': 'json_object'
-        },
-        temperature=0.5
+if __name__ == "__main__":
+    # 前回までに分類したタグは飛ばす
+    remaining_tags = [tag for tag in new_danbooru_tags if tag not in journal]
+    print(f"remaining_tags: {len(remaining_tags)}")
+
+    # CATEGORIZE_BASE_URL に categorize_engine.py --serve-stub のサーバーを指定すると API キー無しで試せる
+    backend = ChatCompletionsBackend(
+        model=os.getenv("CATEGORIZE_MODEL", "deepseek-chat"),
+        base_url=os.getenv("CATEGORIZE_BASE_URL", "https://api.deepseek.com"),
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
     )
 
-    return json.loads(response.choices[0].message.content)
-
-
-if __name__ == "__main__":
-    slice_count = 30
+    def on_result(result):
+        journal.append(result)
+        # 分類できたタグは、続きのタグの例として使う
+        sample_index.add_all(result)
 
-    for i in range(math.floor(len(new_danbooru_tags) / slice_count)):
-        result = categorize_tags(new_danbooru_tags[i*slice_count:(i+1)*slice_count])
-        tag_category_v3.update(result)
+    engine = CategorizeEngine(backend, build_prompt, cache_dir=".categorize_cache", on_result=on_result)
 
-        with open("tag_category_v3.json", "w", encoding="utf-8") as f:
-            json.dump(tag_category_v3, f, indent=2, ensure_ascii=True)
+    with journal:
+        results, failed = engine.run(remaining_tags)
+    sample_index.save()
 
+    print(f"categorized: {len(results)}, failed: {len(failed)}")
+    if failed:
+        print(f"failed tags: {failed[:10]}")
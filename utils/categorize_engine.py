@@ -0,0 +1,413 @@
+"""
+LLM でタグをカテゴリ分けする処理をまとめたエンジン。
+
+    engine = CategorizeEngine(ChatCompletionsBackend("deepseek-chat", api_key=...), build_prompt,
+                              cache_dir=".categorize_cache", on_result=journal.append)
+    results, failed = engine.run(tags)
+
+- バックエンドは complete(system, user) -> str を持つクラス (OpenAI 互換の API、任意の関数、テスト用のスタブ)
+- 1回に送るタグの数と同時リクエスト数は、応答時間とエラーを見て自動で増減する
+  (target_latency より速ければ少しずつ増やし、遅い・エラーの場合は減らす)
+- エラーになったバッチは半分ずつに分けて送り直し、1つだけで max_attempts 回失敗したタグを failed として返す
+  (答えの無かったタグも max_attempts 回まで送り直す)
+- 応答は、バックエンドとプロンプトの内容のハッシュをキーにして cache_dir に保存し、同じプロンプトは送らない
+
+API キー無しで試す場合は、スタブのサーバーを起動して ChatCompletionsBackend の base_url に指定するか、
+--bench で StubBackend を相手に処理速度を測る。
+
+    python utils/categorize_engine.py --serve-stub --port 8765
+    python utils/categorize_engine.py --bench --tags 3000 --latency 0.5
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Deque, Dict, List, Mapping, Optional, Tuple
+
+try:
+    from tag_db import write_atomic
+except ImportError:
+    # utils/ のスクリプトとして実行した場合は、1つ上のフォルダから読み込む
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from tag_db import write_atomic
+
+
+class BackendError(Exception):
+    """バックエンドの呼び出しの失敗。retry_after は待つべき秒数 (429 の Retry-After など)"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Backend:
+    # キャッシュのキーに含める名前 (モデルや設定が違えば別の名前にする)
+    name = "backend"
+
+    def complete(self, system: str, user: str) -> str:
+        raise NotImplementedError
+
+
+class ChatCompletionsBackend(Backend):
+    """OpenAI 互換の /chat/completions (DeepSeek、OpenAI、serve_stub のサーバーなど)"""
+
+    def __init__(self, model: str, base_url: str = "https://api.deepseek.com", api_key: Optional[str] = None,
+                 temperature: float = 0.5, timeout: float = 120.0, json_mode: bool = True):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.temperature = temperature
+        self.timeout = timeout
+        self.json_mode = json_mode
+        self.name = f"chat_completions:{model}:{temperature}:{json_mode}"
+
+    def complete(self, system: str, user: str) -> str:
+        body = {
+            "model": self.model,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "temperature": self.temperature,
+        }
+        if self.json_mode:
+            body["response_format"] = {"type": "json_object"}
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(f"{self.base_url}/chat/completions", data=json.dumps(body).encode("utf-8"),
+                                         headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            retry_after = e.headers.get("Retry-After")
+            raise BackendError(f"HTTP {e.code}", float(retry_after) if retry_after else None) from e
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise BackendError(str(e)) from e
+        try:
+            return data["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise BackendError(f"unexpected response: {data!r:.200}") from e
+
+
+class FunctionBackend(Backend):
+    """complete(system, user) -> str の関数をそのまま使う (Cohere や ChatAssistant など)"""
+
+    def __init__(self, function: Callable[[str, str], str], name: str):
+        self.function = function
+        self.name = name
+
+    def complete(self, system: str, user: str) -> str:
+        return self.function(system, user)
+
+
+class StubBackend(Backend):
+    """
+    テスト用の偽の LLM。user が JSON のタグのリストのプロンプトに、categories の内容で答える。
+    categories に無いタグは、最後の単語が同じタグのカテゴリ (無ければ ["other"]) にする。
+    latency + latency_per_tag * タグ数 秒かかり、error_rate の割合で失敗し、max_tags より多いタグは失敗する。
+    """
+    name = "stub"
+
+    def __init__(self, categories: Optional[Mapping[str, List[str]]] = None, latency: float = 0.0,
+                 latency_per_tag: float = 0.0, error_rate: float = 0.0, max_tags: Optional[int] = None, seed: int = 0):
+        self.categories = dict(categories or {})
+        self.by_last_word = {tag.split("_")[-1]: value for tag, value in self.categories.items()}
+        self.latency = latency
+        self.latency_per_tag = latency_per_tag
+        self.error_rate = error_rate
+        self.max_tags = max_tags
+        self.myrand = random.Random(seed)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def answer(self, tag: str) -> List[str]:
+        if tag in self.categories:
+            return self.categories[tag]
+        return self.by_last_word.get(tag.split("_")[-1], ["other"])
+
+    def complete(self, system: str, user: str) -> str:
+        tags = json.loads(user)
+        with self._lock:
+            self.calls += 1
+            failed = self.myrand.random() < self.error_rate
+        time.sleep(self.latency + self.latency_per_tag * len(tags))
+        if failed:
+            raise BackendError("stub error", retry_after=0.0)
+        if self.max_tags is not None and len(tags) > self.max_tags:
+            raise BackendError("too many tags")
+        return json.dumps({tag: self.answer(tag) for tag in tags})
+
+
+def serve_stub(backend: StubBackend, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """backend に答えさせる /chat/completions のサーバーを起動する (止める時は shutdown)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            messages = {message["role"]: message["content"] for message in body["messages"]}
+            try:
+                content = backend.complete(messages.get("system", ""), messages.get("user", ""))
+            except BackendError:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                return
+            data = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_json_object(text: str) -> Dict[str, List[str]]:
+    """{"tag": ["category", ...]} の応答を読む (```json で囲まれていてもよい)"""
+    if "```" in text:
+        text = text.split("```")[1]
+        if text.startswith("json"):
+            text = text[len("json"):]
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    return {tag: [categories] if isinstance(categories, str) else list(categories or [])
+            for tag, categories in data.items()}
+
+
+def default_prompt(tags: List[str]) -> Tuple[str, str]:
+    system = ("Please categorize the tags into groups.\n"
+              "Please do not output your impressions or comments, only the final json result.\n"
+              'Output a JSON object such as {"long_hair": ["hair", "hair_style"]}.')
+    return system, json.dumps(tags, ensure_ascii=True)
+
+
+class ResponseCache:
+    """プロンプトのハッシュ -> 応答 をファイルに保存する"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(backend_name: str, system: str, user: str) -> str:
+        data = json.dumps([backend_name, system, user], ensure_ascii=True)
+        return hashlib.sha256(data.encode("ascii")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".txt")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, text: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, text.encode("utf-8"), ".txt")
+
+
+class CategorizeEngine:
+    def __init__(self, backend: Backend, build_prompt: Callable[[List[str]], Tuple[str, str]] = default_prompt,
+                 parse: Callable[[str], Dict[str, List[str]]] = parse_json_object, cache_dir: Optional[str] = None,
+                 batch_size: int = 30, min_batch_size: int = 1, max_batch_size: int = 100,
+                 concurrency: int = 4, max_concurrency: int = 16, target_latency: float = 30.0,
+                 max_attempts: int = 3, backoff: float = 1.0,
+                 on_result: Optional[Callable[[Dict[str, List[str]]], None]] = None, log: Callable[[str], None] = print):
+        self.backend = backend
+        self.build_prompt = build_prompt
+        self.parse = parse
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_result = on_result
+        self.log = log
+        self.stats = {"requests": 0, "cache_hits": 0, "errors": 0, "tags": 0}
+
+    def _request(self, batch: List[str]):
+        """(結果, 例外, 応答時間, キャッシュから読んだか)"""
+        system, user = self.build_prompt(batch)
+        key = self.cache.key(self.backend.name, system, user) if self.cache else None
+        if key:
+            text = self.cache.get(key)
+            if text is not None:
+                try:
+                    return self.parse(text), None, 0.0, True
+                except (ValueError, TypeError):
+                    pass
+        start = time.monotonic()
+        try:
+            text = self.backend.complete(system, user)
+            result = self.parse(text)
+        except (BackendError, ValueError, TypeError) as e:
+            # TypeError は parse で読めない形の応答
+            return None, e, time.monotonic() - start, False
+        # 読めた応答だけ保存する (保存できなくても結果は使う)
+        if key:
+            try:
+                self.cache.put(key, text)
+            except OSError as e:
+                self.log(f"failed to write cache: {e}")
+        return result, None, time.monotonic() - start, False
+
+    def _on_success(self, latency: float):
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size * 3 // 4)
+            return
+        self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.batch_size // 10))
+        self._successes += 1
+        if self._successes >= self.concurrency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self._successes = 0
+
+    def _on_error(self, error: Exception, size: int):
+        # 1つだけのタグが失敗した場合は、バッチの大きさのせいではない
+        if size > 1:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        self.concurrency = max(1, self.concurrency // 2)
+        self._successes = 0
+        self._errors_in_row += 1
+        delay = min(60.0, self.backoff * 2 ** (self._errors_in_row - 1))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(retry_after, self.backoff)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    def run(self, tags: List[str]) -> Tuple[Dict[str, List[str]], List[str]]:
+        """tags をカテゴリ分けして (タグ -> カテゴリ, 失敗したタグ) を返す"""
+        queue = deque(dict.fromkeys(tags))
+        # 失敗したバッチを半分に分けたもの。queue より先に送る
+        splits: Deque[List[str]] = deque()
+        attempts: Dict[str, int] = {}
+        results: Dict[str, List[str]] = {}
+        failed: List[str] = []
+        self._successes = 0
+        self._errors_in_row = 0
+        self._resume_at = 0.0
+        start = time.monotonic()
+
+        def retry(batch: List[str]):
+            # 答えの無かったタグは先頭に戻して、次のバッチで送り直す
+            for tag in reversed(batch):
+                attempts[tag] = attempts.get(tag, 0) + 1
+                if attempts[tag] >= self.max_attempts:
+                    failed.append(tag)
+                else:
+                    queue.appendleft(tag)
+
+        def split(batch: List[str]):
+            # 失敗したバッチは半分ずつ送り直して、失敗の原因のタグを探す。回数を数えるのは1つだけのタグ
+            if len(batch) == 1:
+                retry(batch)
+                return
+            half = len(batch) // 2
+            splits.appendleft(batch[half:])
+            splits.appendleft(batch[:half])
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            running = {}
+            while queue or splits or running:
+                while (queue or splits) and len(running) < self.concurrency and time.monotonic() >= self._resume_at:
+                    if splits:
+                        batch = splits.popleft()
+                    else:
+                        batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                    running[executor.submit(self._request, batch)] = batch
+                if not running:
+                    time.sleep(max(0.0, self._resume_at - time.monotonic()))
+                    continue
+                # 待っている間に送れるようになったら、結果を待たずに送る
+                timeout = (max(0.0, self._resume_at - time.monotonic())
+                           if (queue or splits) and len(running) < self.concurrency else None)
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    try:
+                        result, error, latency, cached = future.result()
+                    except Exception as e:
+                        # バックエンドの想定外の例外も、そのバッチの失敗として扱う
+                        result, error, latency, cached = None, e, 0.0, False
+                    self.stats["cache_hits" if cached else "requests"] += 1
+                    if error is not None:
+                        self.stats["errors"] += 1
+                        self.log(f"batch of {len(batch)} failed: {error}")
+                        self._on_error(error, len(batch))
+                        split(batch)
+                        continue
+                    self._errors_in_row = 0
+                    if not cached:
+                        self._on_success(latency)
+                    # 頼んでいないタグの答えは使わず、答えの無かったタグは送り直す
+                    answered = {tag: result[tag] for tag in batch if tag in result}
+                    retry([tag for tag in batch if tag not in answered])
+                    if answered:
+                        results.update(answered)
+                        if self.on_result is not None:
+                            self.on_result(answered)
+                    self.stats["tags"] = len(results)
+                    remaining = len(queue) + sum(len(batch) for batch in splits)
+                    self.log(f"{len(results)}/{len(results) + remaining + len(failed)} tags "
+                             f"(batch {self.batch_size}, concurrency {self.concurrency})")
+        self.stats["seconds"] = time.monotonic() - start
+        return results, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub LLM server and offline throughput benchmark for the categorize engine")
+    parser.add_argument("--serve-stub", action="store_true", help="run a fake /chat/completions server")
+    parser.add_argument("--bench", action="store_true", help="categorize synthetic tags with the stub backend")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub seconds per request")
+    parser.add_argument("--latency-per-tag", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--max-tags", type=int, default=80, help="stub fails for larger batches")
+    args = parser.parse_args(argv)
+
+    backend = StubBackend({"long_hair": ["hair", "hair_style"], "red_eyes": ["eyes", "color"]}, args.latency,
+                          args.latency_per_tag, args.error_rate, args.max_tags)
+    if args.serve_stub:
+        server = serve_stub(backend, port=args.port)
+        print(f"stub server: http://127.0.0.1:{server.server_address[1]}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+    if args.bench:
+        engine = CategorizeEngine(backend, target_latency=args.latency * 4, backoff=0.1, log=lambda message: None)
+        tags = [f"tag_{i}_{random.choice(['hair', 'eyes', 'dress'])}" for i in range(args.tags)]
+        results, failed = engine.run(tags)
+        print(f"{len(results)} tags in {engine.stats['seconds']:.2f}s ({len(results) / engine.stats['seconds']:.1f} tags/s), "
+              f"{engine.stats['requests']} requests, {engine.stats['errors']} errors, {len(failed)} failed, "
+              f"final batch {engine.batch_size}, concurrency {engine.concurrency}")
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
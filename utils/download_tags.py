@@ -1,61 +1,215 @@
-import requests
+"""
+Danbooru のタグ一覧 (tags.json) を全ページ取得して NDJSON (1行に1タグ) で保存する。
+
+    python utils/download_tags.py
+    python utils/download_tags.py --workers 8 --rate 4
+
+複数のページを並列に取得し (--workers)、リクエストの間隔は --rate 回/秒までに抑える。
+429 や 5xx、通信エラーの場合は間隔を空けて再試行する。
+取得したページは順番通りに追記して、次のページ番号とファイルの位置を .checkpoint に保存するので、
+中断してもう一度実行すると続きから取得する。全て取得済みの一覧は取得し直さない (--restart で最初から)。
+"""
+
+import os
+import sys
 import json
 import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+try:
+    from tag_db import write_json_atomic
+except ImportError:
+    # utils/ のスクリプトとして実行した場合は、1つ上のフォルダから読み込む
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from tag_db import write_json_atomic
+
+
+BASE_URL = "https://danbooru.donmai.us"
+USER_AGENT = "comfyui_tag_fillter/download_tags"
+CATEGORIES = [0, 1, 3, 4, 5]
+
+
+class RateLimiter:
+    """全スレッド合わせて1秒に rate 回までになるように待つ"""
+
+    def __init__(self, rate: float, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+    def defer(self, seconds: float):
+        """Retry-After などで、全スレッドのリクエストを seconds 秒止める"""
+        with self._lock:
+            self._next = max(self._next, self.clock() + seconds)
+
+
+def _retry_after(error: urllib.error.HTTPError) -> float:
+    try:
+        return float(error.headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def fetch_json(url: str, limiter: RateLimiter, retries: int = 5, timeout: float = 30.0, backoff: float = 1.0):
+    """url の JSON を取得する。429 / 5xx / 通信エラーは retries 回まで再試行し、それ以外の HTTP エラーはそのまま送出する"""
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT, "Accept": "application/json"})
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            if e.code != 429 and e.code < 500 or attempt == retries:
+                raise
+            delay = _retry_after(e)
+        except (urllib.error.URLError, OSError, ValueError):
+            # 接続の失敗や、途中で切れたレスポンス
+            if attempt == retries:
+                raise
+            delay = 0.0
+        delay = max(delay, min(60.0, backoff * 2 ** attempt) + random.uniform(0, backoff))
+        limiter.defer(delay)
+
+
+def page_url(base_url: str, params: dict, limit: int, page: int) -> str:
+    query = urllib.parse.urlencode({"limit": limit, **params, "page": page})
+    return f"{base_url.rstrip('/')}/tags.json?{query}"
+
+
+def checkpoint_path(output_path: str) -> str:
+    return output_path + ".checkpoint"
+
+
+def load_checkpoint(output_path: str) -> Optional[dict]:
+    try:
+        with open(checkpoint_path(output_path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 
+def save_checkpoint(output_path: str, state: dict):
+    write_json_atomic(checkpoint_path(output_path), state)
 
 
-page = 0
-tags = []
+def _resume_state(output_path: str, source: str, restart: bool) -> dict:
+    state = None if restart else load_checkpoint(output_path)
+    if state is not None and state.get("source") == source:
+        size = os.path.getsize(output_path) if os.path.exists(output_path) else -1
+        if size >= state["offset"]:
+            # チェックポイントより後ろに書きかけの行があれば捨てる
+            with open(output_path, "r+b") as f:
+                f.truncate(state["offset"])
+            return state
+    with open(output_path, "wb"):
+        pass
+    return {"source": source, "next_page": 1, "offset": 0, "count": 0, "done": False}
 
-while True:
-    url = f"https://danbooru.donmai.us/tags.json?limit=1000&page={page}"
-    response = requests.get(url)
-    if response.status_code != 200 or not response.json():
-        print(f"response.status_code = {response.status_code}")
-        print(f"response.json() = {response.json()}")
-        print(f"url = {url}")
-        break
-    data = response.json()
-    tags.extend(data)
-    print(f"ページ {page} 取得: {len(data)} 件（合計 {len(tags)} 件）")
-    page += 1
-    time.sleep(0.3)  # レートリミット回避のため少し待機
 
-    if page % 100 == 0:
-        # ファイル保存
-        with open(f"danbooru_all_tags.json", "w", encoding="utf-8") as f:
-            json.dump(tags, f, ensure_ascii=True, indent=2)
+def download(output_path: str, base_url: str = BASE_URL, params: Optional[dict] = None, limit: int = 1000,
+             workers: int = 4, rate: float = 2.0, retries: int = 5, timeout: float = 30.0, backoff: float = 1.0,
+             max_pages: Optional[int] = None, restart: bool = False, log: Callable[[str], None] = print) -> dict:
+    """
+    空のページが返るまで tags.json を取得して output_path に追記する。
+    max_pages を指定すると、その数のページを取得したところで止める (続きは次の呼び出しで取得する)。
+    最後に保存したチェックポイントの内容を返す。
+    """
+    params = dict(params or {})
+    source = page_url(base_url, params, limit, 0)
+    state = _resume_state(output_path, source, restart)
+    if state["done"]:
+        log(f"{output_path} は取得済み ({state['count']} 件)")
+        return state
 
-with open(f"danbooru_all_tags.json", "w", encoding="utf-8") as f:
-    json.dump(tags, f, ensure_ascii=True, indent=2)
+    limiter = RateLimiter(rate)
+    end_page = None if max_pages is None else state["next_page"] + max_pages
+    pending = {}
+    next_submit = state["next_page"]
+    with open(output_path, "ab") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while len(pending) < workers and (end_page is None or next_submit < end_page):
+                    url = page_url(base_url, params, limit, next_submit)
+                    pending[next_submit] = executor.submit(fetch_json, url, limiter, retries, timeout, backoff)
+                    next_submit += 1
+                page = state["next_page"]
+                if page not in pending:
+                    break
+                try:
+                    data = pending.pop(page).result()
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    # ページ数の上限や、再試行しても取得できない場合は、ここまでで止める (次はこのページから)
+                    state["error"] = e.code if isinstance(e, urllib.error.HTTPError) else f"{type(e).__name__}: {e}"
+                    log(f"{state['error']}: {page_url(base_url, params, limit, page)}")
+                    save_checkpoint(output_path, state)
+                    break
+                if not data:
+                    state["done"] = True
+                    state.pop("error", None)
+                    save_checkpoint(output_path, state)
+                    break
 
+                out.write(b"".join(json.dumps(tag, ensure_ascii=True).encode("ascii") + b"\n" for tag in data))
+                out.flush()
+                os.fsync(out.fileno())
+                state["offset"] = out.tell()
+                state["count"] += len(data)
+                state["next_page"] = page + 1
+                state.pop("error", None)
+                save_checkpoint(output_path, state)
+                log(f"ページ {page} 取得: {len(data)} 件（合計 {state['count']} 件）")
+        finally:
+            for future in pending.values():
+                future.cancel()
+    return state
 
-categories = [0, 1, 3, 4, 5]
 
+def iter_tags(path: str) -> Iterator[dict]:
+    """download で保存した NDJSON のタグを順番に返す"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
 
-for cate in categories:
-    page = 0
-    tags = []
 
-    while True:
-        url = f"https://danbooru.donmai.us/tags.json?limit=1000&page={page}&search[category]={cate}"
-        response = requests.get(url)
-        if response.status_code != 200 or not response.json():
-            print(f"response.status_code = {response.status_code}")
-            print(f"response.json() = {response.json()}")
-            print(f"url = {url}")
-            break
-        data = response.json()
-        tags.extend(data)
-        print(f"ページ {page} 取得: {len(data)} 件（合計 {len(tags)} 件）")
-        page += 1
-        time.sleep(0.3)  # レートリミット回避のため少し待機
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download the Danbooru tag list as NDJSON")
+    parser.add_argument("--output-dir", default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--categories", type=int, nargs="*", default=CATEGORIES,
+                        help="also download per-category lists (danbooru_all_tags_<category>.ndjson)")
+    parser.add_argument("--limit", type=int, default=1000, help="tags per page")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent page fetches")
+    parser.add_argument("--rate", type=float, default=2.0, help="max requests per second")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and download again")
+    args = parser.parse_args(argv)
 
-        if page % 100 == 0:
-            # ファイル保存
-            with open(f"danbooru_all_tags_{cate}.json", "w", encoding="utf-8") as f:
-                json.dump(tags, f, ensure_ascii=True, indent=2)
+    jobs = [("", {})] + [(f"_{category}", {"search[category]": category}) for category in args.categories]
+    for suffix, params in jobs:
+        output_path = os.path.join(args.output_dir, f"danbooru_all_tags{suffix}.ndjson")
+        download(output_path, args.base_url, params, args.limit, args.workers, args.rate,
+                 args.retries, args.timeout, restart=args.restart)
+    return 0
 
-    with open(f"danbooru_all_tags_{cate}.json", "w", encoding="utf-8") as f:
-        json.dump(tags, f, ensure_ascii=True, indent=2)
 
+if __name__ == "__main__":
+    sys.exit(main())
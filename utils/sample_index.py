@@ -0,0 +1,127 @@
+"""
+分類済みのタグから、新しいタグのプロンプトに載せる例を選ぶための索引。
+
+タグを単語 (_ や - や括弧で区切ったもの) に分けて、単語 -> タグの転置索引を作る。
+新しいタグと共通する単語の IDF の合計 (最後の単語は重く、例のタグの単語数で割る) が大きい順に例を返すので、
+どこにでもある単語 (on, hair など) より、珍しい単語を共有するタグが選ばれる。
+索引は JSON で保存しておき、次回は増えたタグだけを追加する。
+
+    index = SampleIndex.load("tag_category_v3.sample_index.json", tag_category)
+    index.top_k("red_sailor_collar", 3)
+    index.save()
+"""
+
+import os
+import sys
+import re
+import json
+import math
+import heapq
+import threading
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from tag_db import write_json_atomic
+except ImportError:
+    # utils/ のスクリプトとして実行した場合は、1つ上のフォルダから読み込む
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from tag_db import write_json_atomic
+
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+# 最後の単語 (英語のタグでは主語にあたることが多い: red_dress の dress) の重み
+LAST_WORD_WEIGHT = 1.5
+
+INDEX_VERSION = 1
+
+
+def tag_words(tag: str) -> List[str]:
+    return _WORD_RE.findall(tag.lower())
+
+
+class SampleIndex:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.tags: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+        self.lengths: List[int] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, tags: Iterable[str]) -> "SampleIndex":
+        """path の索引を読み込んで、tags と同じ内容にする (消えたタグがあれば作り直す)"""
+        tags = list(tags)
+        index = cls(path)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION:
+                index._restore(data)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        current = set(tags)
+        if any(tag not in current for tag in index.tags):
+            index = cls(path)
+        index.add_all(tags)
+        return index
+
+    def _restore(self, data: dict):
+        self.tags = list(data["tags"])
+        self.ids = {tag: i for i, tag in enumerate(self.tags)}
+        self.postings = {word: list(ids) for word, ids in data["postings"].items()}
+        self.lengths = [len(tag_words(tag)) for tag in self.tags]
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.ids
+
+    def add(self, tag: str):
+        with self._lock:
+            if tag in self.ids:
+                return
+            words = tag_words(tag)
+            tag_id = len(self.tags)
+            self.tags.append(tag)
+            self.ids[tag] = tag_id
+            self.lengths.append(len(words))
+            for word in dict.fromkeys(words):
+                self.postings.setdefault(word, []).append(tag_id)
+
+    def add_all(self, tags: Iterable[str]):
+        for tag in tags:
+            self.add(tag)
+
+    def idf(self, word: str) -> float:
+        df = len(self.postings.get(word, ()))
+        return math.log((len(self.tags) + 1) / (df + 1)) + 1.0 if df else 0.0
+
+    def top_k(self, tag: str, k: int = 3, exclude: Iterable[str] = ()) -> List[str]:
+        """tag と関係の深い順に k 個のタグを返す (tag 自身と exclude は除く)"""
+        all_words = tag_words(tag)
+        if not all_words or k <= 0:
+            return []
+        words = list(dict.fromkeys(all_words))
+        last = all_words[-1]
+        excluded = {self.ids[t] for t in (tag, *exclude) if t in self.ids}
+        scores: Dict[int, float] = {}
+        with self._lock:
+            for word in words:
+                postings = self.postings.get(word)
+                if not postings:
+                    continue
+                weight = self.idf(word) * (LAST_WORD_WEIGHT if word == last else 1.0)
+                for tag_id in postings:
+                    scores[tag_id] = scores.get(tag_id, 0.0) + weight
+            best = heapq.nlargest(k + len(excluded), scores.items(),
+                                  key=lambda item: (item[1] / math.sqrt(self.lengths[item[0]]), -item[0]))
+            return [self.tags[tag_id] for tag_id, _ in best if tag_id not in excluded][:k]
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        with self._lock:
+            data = {"version": INDEX_VERSION, "tags": self.tags, "postings": self.postings}
+            write_json_atomic(path, data, separators=(",", ":"))
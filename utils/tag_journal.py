@@ -0,0 +1,119 @@
+"""
+タグのカテゴリ分けの結果を、DB (tag_category_v3.json など) を毎回書き直さずに保存するジャーナル。
+
+結果はバッチごとに <DB>.journal に1行の JSON として追記し、compact_every 件たまったら
+(と close の時に) DB にまとめて書き込んでジャーナルを空にする。
+途中で止まった場合も、次に load した時に DB の上にジャーナルの内容を重ねて続きから処理できる。
+
+    with TagJournal("tag_category_v3.json") as journal:
+        tag_category = journal.load()
+        for batch in batches:
+            journal.append(categorize(batch))
+"""
+
+import os
+import sys
+import json
+import threading
+from typing import Dict, List, Optional
+
+try:
+    from tag_db import write_json_atomic
+except ImportError:
+    # utils/ のスクリプトとして実行した場合は、1つ上のフォルダから読み込む
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from tag_db import write_json_atomic
+
+
+JOURNAL_SUFFIX = ".journal"
+
+
+class TagJournal:
+    def __init__(self, db_path: str, journal_path: Optional[str] = None, compact_every: int = 1000):
+        self.db_path = db_path
+        self.journal_path = journal_path or db_path + JOURNAL_SUFFIX
+        self.compact_every = compact_every
+        self.tags: Dict[str, List[str]] = {}
+        self.pending = 0  # DB に書き込んでいない件数
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.tags
+
+    def load(self) -> Dict[str, List[str]]:
+        """DB を読み込んで、ジャーナルに残っている結果を重ねる"""
+        self.tags = {}
+        if os.path.exists(self.db_path):
+            with open(self.db_path, encoding="utf-8") as f:
+                self.tags.update(json.load(f))
+        self.pending = 0
+        good_offset = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                lines = f.readlines()
+            for i, line in enumerate(lines):
+                try:
+                    entry = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    entry = None
+                if entry is None:
+                    if i < len(lines) - 1:
+                        raise ValueError(f"{self.journal_path}: broken entry at line {i + 1}")
+                    # 書き込みの途中で止まった最後の行は捨てる
+                    break
+                self.tags.update(entry)
+                self.pending += len(entry)
+                good_offset += len(line)
+        self._open(good_offset)
+        return self.tags
+
+    def _open(self, offset: int):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, "ab")
+        self._file.truncate(offset)
+
+    def append(self, result: Dict[str, List[str]]):
+        """1バッチ分の結果 (タグ -> カテゴリのリスト) を追記する"""
+        if not result:
+            return
+        with self._lock:
+            if self._file is None:
+                # DB を読まずに書き込むと、compact で DB の内容が消えてしまう
+                self.load()
+            self._file.write(json.dumps(result, ensure_ascii=True).encode("ascii") + b"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.tags.update(result)
+            self.pending += len(result)
+            if self.pending >= self.compact_every:
+                self._compact()
+
+    def compact(self):
+        """DB をジャーナルを反映した内容で書き直して、ジャーナルを空にする"""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        if not self.pending:
+            return
+        # ノードが読む DB なので、元のファイルの権限のまま置き換える
+        write_json_atomic(self.db_path, self.tags, indent=2)
+        # ここで止まっても、次の load でジャーナルを重ね直すだけなので結果は変わらない
+        self._open(0)
+        self.pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._compact()
+            self._file.close()
+            self._file = None